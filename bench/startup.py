@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark of the npyzutils commands.
+
+Each command is run on paths that shouldn't need anything heavy: ``-h``, an
+argument error, and for ``npyzshape`` reading headers only. For each run,
+the median wall time in excess of a bare interpreter and the number of
+modules imported in excess of a bare interpreter (as reported by
+``-X importtime``) are checked against ``BUDGETS``. None of
+``HEAVY_MODULES`` may be imported at all. The exit status is 1 if any
+budget is exceeded, so that import-time regressions get caught.
+
+The commands are run with the bytecode cache enabled, as they would be once
+installed, after one warm-up run each.
+"""
+import argparse
+import json
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src')
+
+HEAVY_MODULES = ('numpy', 'matplotlib', 'PIL', 'pdb')
+
+# command -> (milliseconds, number of modules) allowed over a bare
+# interpreter. The module counts are deterministic and tight; the times are
+# loose enough to absorb machine noise but not importing numpy
+BUDGETS = {
+    'flo2npy': (100, 80),
+    'npycat': (100, 80),
+    'npyz2img': (180, 100),
+    'npyzindex': (140, 90),
+    'npyzserver': (100, 75),
+    'npyzshape': (100, 80),
+    'npzcat': (100, 80),
+}
+
+
+def make_dataset(todir):
+    """
+    Write tiny npy, npz and flo files under ``todir``.
+
+    :return: dict of their paths by extension
+    """
+    import numpy as np
+    data = np.zeros((8, 8, 2), dtype=np.float32)
+    paths = {ext: os.path.join(todir, 'a.' + ext)
+             for ext in ('npy', 'npz', 'flo')}
+    np.save(paths['npy'], data)
+    np.savez(paths['npz'], a=data, b=data[0])
+    with open(paths['flo'], 'wb') as outfile:
+        outfile.write(struct.pack('<fii', 202021.25, 8, 8))
+        outfile.write(data.tobytes())
+    return paths
+
+
+def make_scenarios(paths):
+    """
+    :return: list of (command, scenario name, arguments)
+    """
+    scenarios = []
+    for prog in sorted(BUDGETS):
+        scenarios.append((prog, 'help', ['-h']))
+        scenarios.append((prog, 'bad-args', ['--no-such-option']))
+    for ext in ('npy', 'npz', 'flo'):
+        scenarios.append(('npyzshape', 'header-' + ext, [paths[ext]]))
+    return scenarios
+
+
+def run(cmd, env, stderr=subprocess.DEVNULL):
+    return subprocess.run(cmd, stdin=subprocess.DEVNULL,
+                          stdout=subprocess.DEVNULL, stderr=stderr,
+                          env=env)
+
+
+def wall_time(cmd, env, repeat):
+    """The median wall time of ``cmd`` in milliseconds."""
+    run(cmd, env)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(cmd, env)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def imported_modules(cmd, env):
+    """The names of the modules imported by ``cmd``."""
+    proc = run(cmd[:1] + ['-X', 'importtime'] + cmd[1:], env,
+               stderr=subprocess.PIPE)
+    names = []
+    for line in proc.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        name = line.rsplit('|', 1)[-1].strip()
+        if name != 'imported package':
+            names.append(name)
+    return names
+
+
+def measure(python, scenarios, repeat):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    bare = [python, '-c', 'pass']
+    bare_ms = wall_time(bare, env, repeat)
+    bare_modules = len(imported_modules(bare, env))
+    results = []
+    for prog, name, args in scenarios:
+        cmd = [python, os.path.join(SRC_DIR, prog + '.py')] + args
+        ms = wall_time(cmd, env, repeat) - bare_ms
+        modules = imported_modules(cmd, env)
+        heavy = sorted({x.split('.')[0] for x in modules
+                        if x.split('.')[0] in HEAVY_MODULES})
+        max_ms, max_modules = BUDGETS[prog]
+        results.append({
+            'command': prog,
+            'scenario': name,
+            'ms': round(ms, 1),
+            'modules': len(modules) - bare_modules,
+            'heavy': heavy,
+            'ok': (ms <= max_ms and len(modules) - bare_modules <= max_modules
+                   and not heavy),
+        })
+    return {'bare_ms': round(bare_ms, 1), 'bare_modules': bare_modules,
+            'results': results}
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description=('Measure the startup time and imported modules of each '
+                     'command against its budget.'))
+    parser.add_argument(
+        '-n',
+        '--repeat',
+        type=int,
+        default=10,
+        help='runs per scenario to take the median of, default to '
+             '%(default)s')
+    parser.add_argument(
+        '--python',
+        default=sys.executable,
+        help='the interpreter to run the commands, default to %(default)s')
+    parser.add_argument(
+        '-o',
+        '--output',
+        metavar='JSONFILE',
+        help='also write the results to JSONFILE')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        report = measure(args.python, make_scenarios(make_dataset(tmpdir)),
+                         args.repeat)
+    print('bare interpreter: {:.1f} ms, {} modules'.format(
+        report['bare_ms'], report['bare_modules']))
+    print('{:<11} {:<11} {:>8} {:>8}  {}'.format(
+        'command', 'scenario', '+ms', '+modules', 'status'))
+    for r in report['results']:
+        max_ms, max_modules = BUDGETS[r['command']]
+        status = 'ok'
+        if not r['ok']:
+            status = 'OVER BUDGET ({} ms, {} modules{})'.format(
+                max_ms, max_modules,
+                ', heavy: ' + ' '.join(r['heavy']) if r['heavy'] else '')
+        print('{:<11} {:<11} {:>8.1f} {:>8}  {}'.format(
+            r['command'], r['scenario'], r['ms'], r['modules'], status))
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+    return 0 if all(r['ok'] for r in report['results']) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite of the npyzutils commands.
+
+``run`` generates synthetic npy, npz and flo datasets of configurable sizes,
+dtype, npz member count and compression, runs the main scenario of each
+command on them several times, and writes the median wall and CPU time, the
+throughput over the input bytes and the peak RSS to a JSON results file.
+The peak RSS, taken from ``os.wait4``, is that of the largest process of
+the command, including any worker it waited for.
+
+``compare`` compares two results files scenario by scenario, and exits
+with 1 if any scenario of the new one is slower or takes more memory than
+the old one by more than a threshold.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src')
+
+TAG_FLOAT = 202021.25
+
+MB = 1 << 20
+
+
+def positive_int(string):
+    try:
+        value = int(string)
+        if value <= 0:
+            raise ValueError
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            'expecting positive integer but got `{}\''.format(string)) \
+            from err
+    return value
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the npyzutils commands on synthetic data.')
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+
+    run_parser = subparsers.add_parser(
+        'run', help='generate the datasets and run the scenarios')
+    run_parser.add_argument(
+        '-s',
+        '--size',
+        type=positive_int,
+        default=64,
+        metavar='MB',
+        help=('the approximate payload size of each dataset in MiB, '
+              'default to %(default)s'))
+    run_parser.add_argument(
+        '--files',
+        type=positive_int,
+        default=8,
+        metavar='N',
+        help=('the number of files each dataset is split into, default to '
+              '%(default)s'))
+    run_parser.add_argument(
+        '--dtype',
+        default='float32',
+        help='the dtype of the npy/npz arrays, default to %(default)s')
+    run_parser.add_argument(
+        '--members',
+        type=positive_int,
+        default=4,
+        metavar='N',
+        help='the number of members per npz file, default to %(default)s')
+    run_parser.add_argument(
+        '--compress',
+        action='store_true',
+        help='write the npz files compressed')
+    run_parser.add_argument(
+        '--many',
+        type=positive_int,
+        default=500,
+        metavar='N',
+        help=('the number of small npy files to inspect by npyzshape, '
+              'default to %(default)s'))
+    run_parser.add_argument(
+        '--image-size',
+        type=positive_int,
+        default=256,
+        metavar='PIXELS',
+        help=('the height and width of the images rendered by npyz2img, '
+              'default to %(default)s'))
+    run_parser.add_argument(
+        '-n',
+        '--repeat',
+        type=positive_int,
+        default=3,
+        help='runs per scenario to take the median of, default to '
+             '%(default)s')
+    run_parser.add_argument(
+        '-k',
+        '--only',
+        metavar='SUBSTRING',
+        action='append',
+        help=('run only the scenarios whose names contain SUBSTRING; may be '
+              'given several times'))
+    run_parser.add_argument(
+        '--python',
+        default=sys.executable,
+        help='the interpreter to run the commands, default to %(default)s')
+    run_parser.add_argument(
+        '--workdir',
+        metavar='DIR',
+        help=('generate the datasets and outputs under DIR and keep them, '
+              'rather than under a temporary directory'))
+    run_parser.add_argument(
+        '-o',
+        '--output',
+        metavar='JSONFILE',
+        default='bench-results.json',
+        help='the results file to write, default to %(default)s')
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare two results files')
+    compare_parser.add_argument('old', metavar='OLD_JSONFILE')
+    compare_parser.add_argument('new', metavar='NEW_JSONFILE')
+    compare_parser.add_argument(
+        '-t',
+        '--threshold',
+        type=float,
+        default=10.0,
+        metavar='PERCENT',
+        help=('the increase of wall time or peak RSS counted as a '
+              'regression, default to %(default)s'))
+    return parser
+
+
+def _rows_for(nbytes, row_nbytes):
+    return max(1, nbytes // max(1, row_nbytes))
+
+
+def make_datasets(args, datadir):
+    """
+    Write the synthetic datasets under ``datadir``.
+
+    :return: dict of lists of file paths by dataset name
+    """
+    import numpy as np
+    rng = np.random.default_rng(0)
+    dtype = np.dtype(args.dtype)
+    per_file = args.size * MB // args.files
+
+    def random_array(shape):
+        if dtype.kind == 'f':
+            return rng.random(shape, dtype=np.float64).astype(dtype)
+        if dtype.kind in 'iu':
+            return rng.integers(0, 100, size=shape).astype(dtype)
+        return np.zeros(shape, dtype=dtype)
+
+    def path(name, i, ext):
+        return os.path.join(datadir, '{}-{:04d}.{}'.format(name, i, ext))
+
+    datasets = {'npy': [], 'npz': [], 'flo': [], 'many': []}
+    cols = 256
+    rows = _rows_for(per_file, cols * dtype.itemsize)
+    for i in range(args.files):
+        filename = path('npy', i, 'npy')
+        np.save(filename, random_array((rows, cols)))
+        datasets['npy'].append(filename)
+
+    length = _rows_for(per_file // args.members, dtype.itemsize)
+    savez = np.savez_compressed if args.compress else np.savez
+    for i in range(args.files):
+        filename = path('npz', i, 'npz')
+        savez(filename, **{'m{}'.format(j): random_array((length,))
+                           for j in range(args.members)})
+        datasets['npz'].append(filename)
+
+    w = 512
+    h = _rows_for(per_file, w * 8)
+    for i in range(args.files):
+        filename = path('flo', i, 'flo')
+        with open(filename, 'wb') as outfile:
+            outfile.write(struct.pack('<fii', TAG_FLOAT, w, h))
+            outfile.write(rng.random((h, w, 2), dtype=np.float32).tobytes())
+        datasets['flo'].append(filename)
+
+    for i in range(args.many):
+        filename = path('many', i, 'npy')
+        np.save(filename, random_array((4, 4)))
+        datasets['many'].append(filename)
+
+    size = args.image_size
+    frames = _rows_for(args.size * MB, size * size)
+    frames = min(frames, 256)
+    filename = os.path.join(datadir, 'frames.npy')
+    np.save(filename, rng.integers(0, 256, size=(frames, size, size),
+                                   dtype=np.uint8))
+    datasets['frames'] = [filename]
+    return datasets
+
+
+DATASET_PARAMS = ('size', 'files', 'dtype', 'members', 'compress', 'many',
+                  'image_size')
+
+GENERATE = '''\
+import argparse, json, sys
+sys.path.insert(0, {bench!r})
+import numpy as np
+import suite
+datasets = suite.make_datasets(argparse.Namespace(**json.loads(sys.argv[1])),
+                               sys.argv[2])
+n_rows = np.load(datasets['npy'][0], mmap_mode='r').shape[0]
+json.dump({{'datasets': datasets, 'n_rows': n_rows}}, sys.stdout)
+'''
+
+
+def generate_datasets(args, datadir):
+    """
+    Run ``make_datasets`` in a child process, as the peak RSS of each command
+    counts that of this process at exec, which must not grow by numpy and
+    the arrays generated.
+
+    :return: (the datasets as returned by ``make_datasets``, the number of
+             rows of the first npy file)
+    """
+    params = {name: getattr(args, name) for name in DATASET_PARAMS}
+    proc = subprocess.run(
+        [sys.executable, '-c',
+         GENERATE.format(bench=os.path.dirname(os.path.abspath(__file__))),
+         json.dumps(params), datadir],
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, check=True)
+    result = json.loads(proc.stdout)
+    return result['datasets'], result['n_rows']
+
+
+def make_scenarios(datasets, n_rows, outdir):
+    """
+    :param n_rows: the number of rows of the first npy file
+    :return: list of dicts of ``name``, ``args`` to the command, ``inputs``
+             whose bytes count towards the throughput, and ``stdout`` to
+             redirect stdout to, if any
+    """
+    def out(name):
+        return os.path.join(outdir, name)
+
+    npy, npz = datasets['npy'], datasets['npz']
+    first = npy[0]
+    # gather about 585 rows spread over the whole of the first file
+    gathered = range(0, n_rows, max(1, n_rows // 585))
+    return [
+        {'name': 'npycat-axis0',
+         'args': ['npycat.py', '-O', out('cat0.npy')] + npy,
+         'inputs': npy},
+        {'name': 'npycat-axisN',
+         'args': ['npycat.py', '-d', '-1', '-O', out('catn.npy')] + npy,
+         'inputs': npy},
+        {'name': 'npzcat',
+         'args': ['npzcat.py', '-O', out('cat.npz')] + npz,
+         'inputs': npz},
+        {'name': 'npzcat-csv',
+         'args': ['npzcat.py', '-H', '--csv', '-O', out('cat.csv')] + npz,
+         'inputs': npz},
+        {'name': 'npyzindex-slice',
+         'args': ['npyzindex.py', '-e', '::2', '-O', '-', first],
+         'inputs': [first],
+         'stdout': out('slice.npy')},
+        {'name': 'npyzindex-gather',
+         'args': ['npyzindex.py', '-e',
+                  '[{}]'.format(','.join(map(str, gathered))),
+                  '-O', '-', first],
+         'inputs': [first],
+         'stdout': out('gather.npy')},
+        {'name': 'npyz2img-batch',
+         'args': ['npyz2img.py', '-C', 'NHW', '-d', outdir,
+                  datasets['frames'][0]],
+         'inputs': datasets['frames']},
+        {'name': 'npyzshape-many',
+         'args': ['npyzshape.py'] + datasets['many'],
+         'inputs': datasets['many']},
+        {'name': 'flo2npy-batch',
+         'args': ['flo2npy.py', '-O', outdir] + datasets['flo'],
+         'inputs': datasets['flo']},
+    ]
+
+
+def run_once(cmd, env, stdout, stderr):
+    """
+    :return: (exit code, wall time, CPU time, peak RSS in bytes)
+    """
+    with open(stdout or os.devnull, 'wb') as outfile:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                                stdout=outfile, stderr=stderr, env=env)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    max_rss = rusage.ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+    return proc.returncode, wall, rusage.ru_utime + rusage.ru_stime, max_rss
+
+
+def run_scenario(scenario, python, env, outdir, repeat):
+    cmd = [python, os.path.join(SRC_DIR, scenario['args'][0])] \
+        + scenario['args'][1:]
+    walls, cpus, rsss, codes = [], [], [], []
+    errname = os.path.join(outdir, '..', scenario['name'] + '.err')
+    for _ in range(repeat):
+        shutil.rmtree(outdir)
+        os.mkdir(outdir)
+        with open(errname, 'wb') as errfile:
+            code, wall, cpu, rss = run_once(cmd, env, scenario.get('stdout'),
+                                            errfile)
+        walls.append(wall)
+        cpus.append(cpu)
+        rsss.append(rss)
+        codes.append(code)
+    if any(codes):
+        with open(errname, 'rb') as errfile:
+            sys.stderr.write(errfile.read()[-2000:].decode('utf-8',
+                                                           'replace'))
+    input_bytes = sum(os.path.getsize(x) for x in scenario['inputs'])
+    wall = statistics.median(walls)
+    return {
+        'name': scenario['name'],
+        'args': scenario['args'],
+        'returncodes': codes,
+        'wall_s': wall,
+        'wall_all_s': walls,
+        'cpu_s': statistics.median(cpus),
+        'max_rss_bytes': max(rsss),
+        'input_bytes': input_bytes,
+        'input_files': len(scenario['inputs']),
+        'throughput_mbps': input_bytes / MB / wall if wall else None,
+    }
+
+
+def run(args):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        datadir = os.path.join(workdir, 'data')
+        outdir = os.path.join(workdir, 'out')
+        os.makedirs(datadir, exist_ok=True)
+        os.makedirs(outdir, exist_ok=True)
+        print('generating datasets under "{}"'.format(datadir),
+              file=sys.stderr)
+        datasets, n_rows = generate_datasets(args, datadir)
+        results = []
+        for scenario in make_scenarios(datasets, n_rows, outdir):
+            if args.only and not any(x in scenario['name']
+                                     for x in args.only):
+                continue
+            result = run_scenario(scenario, args.python, env, outdir,
+                                  args.repeat)
+            results.append(result)
+            print('{:<18} {:>9.3f} s {:>9.1f} MiB/s {:>9.1f} MiB RSS{}'.format(
+                result['name'], result['wall_s'], result['throughput_mbps'],
+                result['max_rss_bytes'] / MB,
+                '' if not any(result['returncodes'])
+                else '  exit {}'.format(result['returncodes'])))
+    report = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': args.python,
+            'platform': platform.platform(),
+            'dataset': {
+                'size_mb': args.size,
+                'files': args.files,
+                'dtype': args.dtype,
+                'members': args.members,
+                'compress': args.compress,
+                'many': args.many,
+                'image_size': args.image_size,
+            },
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+    return 1 if any(any(r['returncodes']) for r in results) else 0
+
+
+def _change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+
+def compare(args):
+    with open(args.old) as infile:
+        old = json.load(infile)
+    with open(args.new) as infile:
+        new = json.load(infile)
+    if old['meta']['dataset'] != new['meta']['dataset']:
+        print('warning: the results are of different datasets',
+              file=sys.stderr)
+    old_results = {r['name']: r for r in old['results']}
+    regressed = False
+    print('{:<18} {:>9} {:>9} {:>8} {:>9} {:>9} {:>8}'.format(
+        'scenario', 'old s', 'new s', 'time', 'old MiB', 'new MiB', 'rss'))
+    for r in new['results']:
+        o = old_results.get(r['name'])
+        if o is None:
+            print('{:<18} (new)'.format(r['name']))
+            continue
+        time_change = _change(o['wall_s'], r['wall_s'])
+        rss_change = _change(o['max_rss_bytes'], r['max_rss_bytes'])
+        mark = ''
+        if time_change > args.threshold or rss_change > args.threshold:
+            mark = '  REGRESSED'
+            regressed = True
+        print('{:<18} {:>9.3f} {:>9.3f} {:>+7.1f}% {:>9.1f} {:>9.1f} '
+              '{:>+7.1f}%{}'.format(
+                  r['name'], o['wall_s'], r['wall_s'], time_change,
+                  o['max_rss_bytes'] / MB, r['max_rss_bytes'] / MB,
+                  rss_change, mark))
+    return 1 if regressed else 0
+
+
+def main():
+    args = make_parser().parse_args()
+    if args.mode == 'run':
+        return run(args)
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,28 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
 import os
 import sys
-import io
-import shutil
+import stat
+import struct
 import logging
+import zipfile
+import errno as errno_module
 
-import numpy as np
+import npyzcore
+
+np = npyzcore.lazy_import('numpy')
+multiprocessing = npyzcore.lazy_import('multiprocessing')
 
 TAG_FLOAT = 202021.25
+FLO_MAGIC = struct.pack('<f', TAG_FLOAT)
+FLO_HEADER_SIZE = 12
+COPY_CHUNK_SIZE = 1 << 24
+ENCODINGS = ('float32', 'float16', 'int16')
+UNKNOWN_FLOW_THRESH = 1e9
+INT16_UNKNOWN = -32768
+INT16_MAX = 32767
+FLOAT16_MAX = 65504.0
 
 LOGGING_LEVEL = logging.WARNING
 
@@ -18,6 +32,10 @@ ERRNO_DATA = 4
 ERRNO_WRITE = 8
 ERRNO_INT = 130
 
+errno = 0
+
+stats = npyzcore.Stats('flo2npy')
+
 
 class ArgumentParser(argparse.ArgumentParser):
     def error(self, message):
@@ -40,61 +58,679 @@ def make_parser():
         type=os.path.normpath,
         help=('write to OUTFILE rather than FLOWFILE.npy; '
               'or `-\' to write raw bytes of the result npy '
-              'to stdout'))
+              'to stdout. If there are several FLOFILEs, or if '
+              'OUTFILE is an existing directory, OUTFILE is '
+              'the directory under which to write '
+              '`basename(FLOFILE).npy\' instead, or '
+              '`RELPATH.npy\' for the .flo files found under '
+              'a directory FLOFILE at RELPATH'))
+    parser.add_argument(
+        '-T',
+        '--from-file',
+        dest='from_file',
+        metavar='FILE',
+        help=('read FLOFILEs from FILE; use `-\' to denote '
+              'stdin. In either case the filenames should be '
+              'placed one per line'))
     parser.add_argument(
-        'flofile', metavar='FLOFILE', help='the .flo file to convert')
+        '-j',
+        '--jobs',
+        metavar='N',
+        type=positive_int,
+        default=1,
+        help=('convert files in parallel using a pool of N '
+              'worker processes. Default to %(default)s'))
+    parser.add_argument(
+        '-E',
+        '--encoding',
+        choices=ENCODINGS,
+        default='float32',
+        help=('the encoding of the output flow. `float16\' '
+              'writes an npy of half floats, failing if the '
+              'known flow goes beyond their range of %g; '
+              '`int16\' writes '
+              'an npz of the fixed-point flow under key '
+              '`flow\' and the float32 SCALE under key '
+              '`scale\', so that the flow is `flow * scale\', '
+              'with the unknown flow (NaN, or magnitude above '
+              '%g) stored as %d. The default output files are '
+              'then FLOFILE.npy and FLOFILE.npz respectively. '
+              'The flow is converted in bounded chunks of rows, '
+              'and the max quantization error of the known flow '
+              'of each FLOFILE is printed to stderr. Default '
+              'to %%(default)s' % (FLOAT16_MAX, UNKNOWN_FLOW_THRESH,
+                                    INT16_UNKNOWN)))
+    parser.add_argument(
+        '--scale',
+        type=positive_float,
+        help=('the SCALE of `int16\' encoding. Default to the '
+              'max magnitude of the known flow of each FLOFILE '
+              'divided by %d' % INT16_MAX))
+    parser.add_argument(
+        '--stack',
+        metavar='OUTFILE',
+        type=os.path.normpath,
+        help=('stack all FLOFILEs, which must be of the same '
+              'size, into one npy array of shape (N, H, W, 2) '
+              'at OUTFILE instead, in the order given. The '
+              'headers of all FLOFILEs are checked before '
+              'OUTFILE is preallocated, and then the slot of '
+              'each FLOFILE is filled in place, in parallel '
+              'if `-j\' is specified. The stack is built in a '
+              'temporary file that replaces OUTFILE only once '
+              'all FLOFILEs are stacked. Not applicable with '
+              '`-O\' or `-E\''))
+    parser.add_argument(
+        '--stack-index',
+        metavar='FILE',
+        help=('with `--stack\', also write to FILE the slot '
+              'number and the name of the FLOFILE of each '
+              'slot, separated by a tab, one slot per line'))
+    npyzcore.add_stats_argument(parser)
+    parser.add_argument(
+        'flofiles',
+        nargs='*',
+        metavar='FLOFILE',
+        help=('the .flo files to convert, or directories under '
+              'which all .flo files are converted recursively. '
+              'If both FLOFILE and `-T\' are provided, then the '
+              'union of them will be used'))
     return parser
 
 
+def positive_float(string):
+    try:
+        value = float(string)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            'illegal float `%s\'' % string) from err
+    if not value > 0:
+        raise argparse.ArgumentTypeError(
+            'expecting positive float but got `%s\'' % string)
+    return value
+
+
+def positive_int(string):
+    try:
+        value = int(string)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            'illegal integer `%s\'' % string) from err
+    if value <= 0:
+        raise argparse.ArgumentTypeError(
+            'expecting positive integer but got `%s\'' % string)
+    return value
+
+
 class IllegalFloFileError(Exception):
     pass
 
 
+class TruncatedFloFileError(IllegalFloFileError):
+    pass
+
+
+class IncompleteStackError(Exception):
+    pass
+
+
+def read_header(infile):
+    """
+    Read and validate the header of the .flo file opened as ``infile``,
+    and check the file size against it if it's a regular file.
+
+    :return: (height, width)
+    :raise IllegalFloFileError: if the flow number is incorrect
+    :raise TruncatedFloFileError: if the payload size doesn't match
+    """
+    header = infile.read(FLO_HEADER_SIZE)
+    if len(header) < FLO_HEADER_SIZE:
+        raise TruncatedFloFileError
+    tag, w, h = struct.unpack('<fii', header)
+    if tag != TAG_FLOAT:
+        raise IllegalFloFileError
+    if w < 0 or h < 0:
+        raise TruncatedFloFileError
+    try:
+        st = os.fstat(infile.fileno())
+    except (AttributeError, OSError):
+        return h, w
+    if (stat.S_ISREG(st.st_mode)
+            and st.st_size != FLO_HEADER_SIZE + w * h * 8):
+        raise TruncatedFloFileError
+    return h, w
+
+
+def is_flo(infile):
+    """
+    Tell whether the seekable ``infile`` starts with the .flo magic, leaving
+    its position unchanged.
+    """
+    pos = infile.tell()
+    try:
+        return infile.read(len(FLO_MAGIC)) == FLO_MAGIC
+    finally:
+        infile.seek(pos)
+
+
+def read_flo(infile):
+    """
+    Read the flow of shape (h, w, 2) from the .flo file opened as
+    ``infile``, which may be an in-memory buffer.
+
+    :raise IllegalFloFileError: if the header is invalid
+    :raise TruncatedFloFileError: if the payload is incomplete
+    """
+    h, w = read_header(infile)
+    payload = bytearray(w * h * 8)
+    if infile.readinto(payload) != len(payload):
+        raise TruncatedFloFileError
+    return np.frombuffer(payload, dtype=np.dtype('<f4')).reshape((h, w, 2))
+
+
+def memmap_flo(filename):
+    """
+    Memory-map the flow of .flo file ``filename`` as a read-only array of
+    shape (h, w, 2), after validating its header and size, so that only the
+    rows indexed are ever read.
+
+    :raise IllegalFloFileError: if the header is invalid
+    :raise TruncatedFloFileError: if the file size doesn't match
+    """
+    with open(filename, 'rb') as infile:
+        h, w = read_header(infile)
+    if not h * w:
+        return np.zeros((h, w, 2), dtype=np.dtype('<f4'))
+    return np.memmap(filename, dtype=np.dtype('<f4'), mode='r',
+                     offset=FLO_HEADER_SIZE, shape=(h, w, 2))
+
+
+def splice(infile, outfile, offset, count):
+    """
+    Copy ``count`` bytes of ``infile`` from ``offset`` to the current
+    position of ``outfile`` in the kernel via ``os.copy_file_range``, or
+    ``os.sendfile`` if not supported between the two files (e.g. if
+    ``outfile`` is a pipe), or otherwise by reading and writing chunks.
+    """
+    outfile.flush()
+    in_fd, out_fd = infile.fileno(), outfile.fileno()
+    for copy in ('copy_file_range', 'sendfile'):
+        try:
+            while count > 0:
+                if copy == 'copy_file_range':
+                    n = os.copy_file_range(in_fd, out_fd, count, offset)
+                else:
+                    n = os.sendfile(out_fd, in_fd, offset, count)
+                if not n:
+                    raise TruncatedFloFileError
+                offset += n
+                count -= n
+            return
+        except (AttributeError, OSError) as err:
+            if isinstance(err, OSError) and err.errno not in (
+                    errno_module.EXDEV, errno_module.EINVAL,
+                    errno_module.ENOSYS, errno_module.EOPNOTSUPP,
+                    errno_module.EBADF):
+                raise
+    infile.seek(offset)
+    while count > 0:
+        buf = infile.read(min(count, COPY_CHUNK_SIZE))
+        if not buf:
+            raise TruncatedFloFileError
+        outfile.write(buf)
+        count -= len(buf)
+
+
 def convert(flofile):
     with open(flofile, 'rb') as infile:
-        if np.fromfile(infile, np.float32, count=1)[0] != TAG_FLOAT:
-            raise IllegalFloFileError
-        w, h = np.fromfile(infile, np.int32, count=2)
-        data = np.fromfile(infile, np.float32, 2 * w * h)
-        flow = data.reshape((h, w, 2))
-    return flow
+        return read_flo(infile)
 
 
-def main():
-    logging.basicConfig(
-        format='%(filename)s: %(levelname)s: %(message)s', level=LOGGING_LEVEL)
-    args = make_parser().parse_args()
+def decide_input_files(args):
+    global errno
+    filenames = []
+    if args.from_file:
+        try:
+            filenames.extend(npyzcore.read_filenames(args.from_file))
+        except OSError as err:
+            logging.warning('failed to load FLOFILEs from "%s" due to %s',
+                            args.from_file, err)
+            errno |= ERRNO_READ
+    filenames.extend(args.flofiles)
+    return filenames
+
+
+def find_flo_files(filenames):
+    """
+    Expand directories in ``filenames`` to the .flo files under them.
+
+    :return: list of (flo file, its path relative to the directory it's
+             found under, or its basename if it's not found in a directory)
+    """
+    flofiles = []
+    for filename in filenames:
+        if not os.path.isdir(filename):
+            flofiles.append((filename, os.path.basename(filename)))
+            continue
+        found = []
+        for dirpath, dirnames, names in os.walk(filename):
+            dirnames.sort()
+            found.extend(os.path.join(dirpath, name) for name in sorted(names)
+                         if name.endswith('.flo'))
+        flofiles.extend((x, os.path.relpath(x, filename)) for x in found)
+    return flofiles
+
+
+def iter_row_chunks(flow, chunk_size=COPY_CHUNK_SIZE):
+    """
+    Yield consecutive chunks of rows of ``flow`` of about ``chunk_size``
+    bytes each.
+    """
+    step = max(1, chunk_size // max(1, flow.nbytes // max(1, len(flow))))
+    for start in range(0, len(flow), step):
+        yield flow[start:start + step]
+
+
+def known_flow(chunk):
+    """Mask of the known flow, i.e. finite and below the threshold."""
+    with np.errstate(invalid='ignore'):
+        return np.abs(chunk) < UNKNOWN_FLOW_THRESH
+
+
+def int16_scale(flow, chunk_size=COPY_CHUNK_SIZE):
+    """
+    The scale mapping the max magnitude of known ``flow`` to ``INT16_MAX``.
+    """
+    peak = 0.0
+    for chunk in iter_row_chunks(flow, chunk_size):
+        known = np.abs(chunk[known_flow(chunk)])
+        if known.size:
+            peak = max(peak, float(known.max()))
+    return np.float32(peak / INT16_MAX if peak else 1.0)
+
+
+def encode_chunk(chunk, encoding, scale=None):
+    """
+    Encode ``chunk`` of flow.
+
+    :return: (the encoded chunk, the max quantization error of its known
+             flow)
+    :raise OverflowError: if known flow is out of the range of float16
+    """
+    known = known_flow(chunk)
+    if encoding == 'float16':
+        with np.errstate(over='ignore'):
+            encoded = chunk.astype(np.dtype('<f2'))
+        decoded = encoded.astype(np.float32)
+        if np.isinf(decoded[known]).any():
+            raise OverflowError
+    else:
+        levels = np.rint(np.where(known, chunk, 0) / scale)
+        np.clip(levels, -INT16_MAX, INT16_MAX, out=levels)
+        encoded = levels.astype(np.dtype('<i2'))
+        encoded[~known] = INT16_UNKNOWN
+        decoded = encoded * np.float32(scale)
+    errors = np.abs(decoded - chunk)[known]
+    return encoded, float(errors.max()) if errors.size else 0.0
+
+
+def write_encoded(fp, flow, encoding, scale=None,
+                  chunk_size=COPY_CHUNK_SIZE):
+    """
+    Write ``flow`` as npy to ``fp`` in ``encoding``, chunk by chunk of
+    rows.
+
+    :return: the max quantization error of the known flow
+    """
+    dtype = np.dtype('<f2' if encoding == 'float16' else '<i2')
+    npyzcore.write_npy_header(fp, flow.shape, dtype)
+    max_error = 0.0
+    for chunk in iter_row_chunks(flow, chunk_size):
+        encoded, error = encode_chunk(np.asarray(chunk), encoding, scale)
+        fp.write(encoded.tobytes())
+        max_error = max(max_error, error)
+    return max_error
+
+
+def encode_file(flofile, output, encoding, scale=None):
+    """
+    Same as ``convert_file`` but encode the flow of ``flofile``, mapped
+    rather than read, in ``encoding`` other than float32.
+
+    :return: the error number
+    """
     try:
-        flow = convert(args.flofile)
+        flow = memmap_flo(flofile)
+    except FileNotFoundError:
+        logging.error('cannot open "%s", no such file', flofile)
+        return ERRNO_READ
+    except TruncatedFloFileError:
+        logging.error('truncated flow file "%s"', flofile)
+        return ERRNO_READ | ERRNO_DATA
     except IllegalFloFileError:
         logging.error('illegal flow file "%s" as flow number is incorrect',
-                      args.flofile)
+                      flofile)
         return ERRNO_READ | ERRNO_DATA
+    except IOError:
+        logging.error('cannot open "%s"', flofile)
+        return ERRNO_READ
+    if encoding == 'int16' and scale is None:
+        scale = int16_scale(flow)
+    try:
+        with contextlib.ExitStack() as stack:
+            if output == '-':
+                outfile = stats.counting_writer(sys.stdout.buffer)
+            else:
+                outfile = stack.enter_context(npyzcore.atomic_open(output))
+            if encoding == 'int16':
+                with zipfile.ZipFile(outfile, 'w', allowZip64=True) as zf:
+                    with zf.open('flow.npy', 'w',
+                                 force_zip64=True) as member:
+                        max_error = write_encoded(member, flow, encoding,
+                                                  scale)
+                    with zf.open('scale.npy', 'w') as member:
+                        npyzcore.write_npy(member, np.float32(scale))
+            else:
+                max_error = write_encoded(outfile, flow, encoding)
+    except OverflowError:
+        logging.error('flow of "%s" is out of the range of %s (%g); try '
+                      '`-E int16\' instead', flofile, encoding, FLOAT16_MAX)
+        return ERRNO_DATA
+    except IOError:
+        logging.error('cannot write to "%s"', output)
+        return ERRNO_WRITE
+    stats.add_read_file(flofile)
+    if output != '-':
+        stats.add_written_file(output)
+    # the report asked for by `-E', so it's printed regardless of the
+    # logging level, in the same format as the log messages
+    print('{}: "{}": max quantization error {:g}'.format(
+        os.path.basename(sys.argv[0]), flofile, max_error), file=sys.stderr)
+    return 0
+
+
+def convert_file(flofile, output, encoding='float32', scale=None):
+    """
+    Convert ``flofile`` and write the result to ``output``, logging any
+    error. The header is validated before ``output`` is opened, and the
+    payload is copied as is, since it's already laid out as the npy
+    payload. Other encodings than float32 are delegated to
+    ``encode_file``.
+
+    :return: the error number
+    """
+    if encoding != 'float32':
+        return encode_file(flofile, output, encoding, scale)
+    try:
+        infile = open(flofile, 'rb')
     except FileNotFoundError:
-        logging.error('cannot open "%s", no such file', args.flofile)
+        logging.error('cannot open "%s", no such file', flofile)
         return ERRNO_READ
     except IOError:
-        logging.error('cannot open "%s"', args.flofile)
+        logging.error('cannot open "%s"', flofile)
         return ERRNO_READ
-    except KeyboardInterrupt:
-        return ERRNO_INT
-
-    output = args.output or (args.flofile + '.npy')
-    if output != '-':
+    with infile:
+        try:
+            h, w = read_header(infile)
+        except TruncatedFloFileError:
+            logging.error('truncated flow file "%s"', flofile)
+            return ERRNO_READ | ERRNO_DATA
+        except IllegalFloFileError:
+            logging.error('illegal flow file "%s" as flow number is '
+                          'incorrect', flofile)
+            return ERRNO_READ | ERRNO_DATA
+        except IOError:
+            logging.error('cannot read "%s"', flofile)
+            return ERRNO_READ
+        header = npyzcore.npy_header_bytes((h, w, 2), '<f4')
+        payload_size = w * h * 8
+        if output == '-':
+            sys.stdout.buffer.write(header)
+            try:
+                splice(infile, sys.stdout.buffer, FLO_HEADER_SIZE,
+                       payload_size)
+            except TruncatedFloFileError:
+                logging.error('truncated flow file "%s"', flofile)
+                return ERRNO_READ | ERRNO_DATA
+            stats.add_read_file(flofile)
+            stats.add_written(len(header) + payload_size)
+            return 0
         try:
-            with open(output, 'wb') as outfile:
-                np.save(outfile, flow)
+            with npyzcore.atomic_open(output) as outfile:
+                outfile.write(header)
+                splice(infile, outfile, FLO_HEADER_SIZE, payload_size)
+        except TruncatedFloFileError:
+            logging.error('truncated flow file "%s"', flofile)
+            return ERRNO_READ | ERRNO_DATA
         except IOError:
             logging.error('cannot write to "%s"', output)
             return ERRNO_WRITE
-    else:
-        with io.BytesIO() as cbuf:
-            np.save(cbuf, flow)
-            cbuf.seek(0)
-            shutil.copyfileobj(cbuf, sys.stdout.buffer)
+    stats.add_read_file(flofile)
+    stats.add_written_file(output)
+    return 0
+
+
+def _convert_job(job):
+    """
+    :return: tuple of (the error number, the ``Stats`` of the job)
+    """
+    global stats
+    stats = npyzcore.Stats(stats.prog)
+    try:
+        with stats.phase('convert'):
+            return convert_file(*job), stats
+    except KeyboardInterrupt:
+        return ERRNO_INT, stats
+
 
+def decide_jobs(args, flofiles):
+    """
+    Pair each .flo file with its output file.
+
+    :return: list of (flo file, output file)
+    """
+    global errno
+    suffix = '.npz' if args.encoding == 'int16' else '.npy'
+    if len(flofiles) == 1 and not (args.output
+                                   and os.path.isdir(args.output)):
+        flofile = flofiles[0][0]
+        return [(flofile, args.output or (flofile + suffix))]
+    if args.output == '-':
+        logging.error('more than one FLOFILE occur but outputing via stdout')
+        sys.exit(errno | ERRNO_ARGS)
+    if not args.output:
+        return [(flofile, flofile + suffix) for flofile, _ in flofiles]
+    jobs = []
+    for flofile, relpath in flofiles:
+        output = os.path.join(args.output, relpath + suffix)
+        try:
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        except OSError as err:
+            logging.error('cannot make directory for "%s" due to %s',
+                          output, err)
+            errno |= ERRNO_WRITE
+            continue
+        jobs.append((flofile, output))
+    return jobs
+
+
+def read_stack_headers(flofiles):
+    """
+    Read the headers of all ``flofiles`` to stack, logging any error.
+
+    :return: (height, width) shared by all ``flofiles``, or ``None`` on
+             error
+    """
+    global errno
+    if not flofiles:
+        logging.error('no FLOFILE to stack')
+        errno |= ERRNO_ARGS
+        return None
+    shapes = {}
+    for flofile in flofiles:
+        try:
+            with open(flofile, 'rb') as infile:
+                shapes[flofile] = read_header(infile)
+        except TruncatedFloFileError:
+            logging.error('truncated flow file "%s"', flofile)
+            errno |= ERRNO_READ | ERRNO_DATA
+        except IllegalFloFileError:
+            logging.error('illegal flow file "%s" as flow number is '
+                          'incorrect', flofile)
+            errno |= ERRNO_READ | ERRNO_DATA
+        except IOError:
+            logging.error('cannot open "%s"', flofile)
+            errno |= ERRNO_READ
+    if len(shapes) < len(flofiles):
+        return None
+    distinct = set(shapes.values())
+    if len(distinct) > 1:
+        logging.error('cannot stack FLOFILEs of different sizes %s',
+                      ', '.join(map(str, sorted(distinct))))
+        errno |= ERRNO_DATA
+        return None
+    return distinct.pop()
+
+
+def fill_slot(flofile, outfilename, offset, payload_size):
+    """
+    Copy the payload of ``flofile`` into ``outfilename`` at ``offset``.
+
+    :return: the error number
+    """
+    try:
+        with open(flofile, 'rb') as infile, \
+                open(outfilename, 'r+b') as outfile:
+            outfile.seek(offset)
+            splice(infile, outfile, FLO_HEADER_SIZE, payload_size)
+    except TruncatedFloFileError:
+        logging.error('truncated flow file "%s"', flofile)
+        return ERRNO_READ | ERRNO_DATA
+    except IOError as err:
+        logging.error('failed to copy "%s" to "%s" due to %s', flofile,
+                      outfilename, err)
+        return ERRNO_READ | ERRNO_WRITE
+    stats.add_read_file(flofile)
     return 0
 
 
+def _fill_slot_job(job):
+    """
+    :return: tuple of (the error number, the ``Stats`` of the job)
+    """
+    global stats
+    stats = npyzcore.Stats(stats.prog)
+    try:
+        with stats.phase('convert'):
+            return fill_slot(*job), stats
+    except KeyboardInterrupt:
+        return ERRNO_INT, stats
+
+
+def stack_files(args, flofiles):
+    """
+    Stack ``flofiles`` into ``args.stack``, preallocated as a memory-mapped
+    npy file whose slots are then filled in place. The stack is built in a
+    temporary file that replaces ``args.stack`` only if all slots are
+    filled, and only then is ``args.stack_index`` written.
+    """
+    global errno
+    with stats.phase('read'):
+        shape = read_stack_headers(flofiles)
+    if shape is None:
+        return
+    h, w = shape
+    slots_errno = 0
+    try:
+        with npyzcore.atomic_path(args.stack) as tmpname:
+            stacked = np.lib.format.open_memmap(
+                tmpname, mode='w+', dtype=np.dtype('<f4'),
+                shape=(len(flofiles), h, w, 2))
+            start, payload_size = stacked.offset, w * h * 8
+            del stacked
+            jobs = [(flofile, tmpname, start + i * payload_size,
+                     payload_size)
+                    for i, flofile in enumerate(flofiles)]
+            if args.jobs > 1 and len(jobs) > 1:
+                with multiprocessing.Pool(args.jobs) as pool:
+                    for job_errno, job_stats in pool.imap_unordered(
+                            _fill_slot_job, jobs):
+                        slots_errno |= job_errno
+                        stats.merge(job_stats)
+            else:
+                for job in jobs:
+                    with stats.phase('convert'):
+                        slots_errno |= fill_slot(*job)
+            if slots_errno:
+                raise IncompleteStackError
+    except IncompleteStackError:
+        logging.error('not all FLOFILEs are stacked; "%s" is left as is',
+                      args.stack)
+        errno |= slots_errno
+        return
+    except (IOError, ValueError) as err:
+        logging.error('cannot write to "%s" due to %s', args.stack, err)
+        errno |= ERRNO_WRITE
+        return
+    stats.add_written_file(args.stack)
+    if args.stack_index:
+        try:
+            with stats.phase('write'), \
+                    npyzcore.atomic_open(args.stack_index, 'w') as outfile:
+                for i, flofile in enumerate(flofiles):
+                    outfile.write('{}\t{}\n'.format(i, flofile))
+        except IOError:
+            logging.error('cannot write to "%s"', args.stack_index)
+            errno |= ERRNO_WRITE
+        else:
+            stats.add_written_file(args.stack_index)
+
+
+def main():
+    global errno
+    logging.basicConfig(
+        format='%(filename)s: %(levelname)s: %(message)s', level=LOGGING_LEVEL)
+    parser = make_parser()
+    args = parser.parse_args(npyzcore.expand_stats_option(sys.argv[1:]))
+    stats.enable(args.stats)
+    try:
+        with stats.phase('decide_inputs'):
+            filenames = decide_input_files(args)
+        if not filenames and not args.from_file:
+            parser.error('no FLOFILE is specified')
+        if args.stack:
+            if args.output or args.encoding != 'float32':
+                parser.error('`--stack\' is not applicable with `-O\' or '
+                             '`-E\'')
+            with stats.phase('decide_inputs'):
+                flofiles = [x for x, _ in find_flo_files(filenames)]
+            stack_files(args, flofiles)
+            return errno
+        if args.stack_index:
+            parser.error('`--stack-index\' requires `--stack\'')
+        with stats.phase('decide_inputs'):
+            jobs = decide_jobs(args, find_flo_files(filenames)) \
+                if filenames else []
+        jobs = [job + (args.encoding, args.scale) for job in jobs]
+        if args.jobs > 1 and len(jobs) > 1:
+            # the phases are summed over the workers
+            with multiprocessing.Pool(args.jobs) as pool:
+                for job_errno, job_stats in pool.imap_unordered(_convert_job,
+                                                                jobs):
+                    errno |= job_errno
+                    stats.merge(job_stats)
+        else:
+            for job in jobs:
+                with stats.phase('convert'):
+                    errno |= convert_file(*job)
+    except KeyboardInterrupt:
+        errno |= ERRNO_INT
+    return errno
+
+
 if __name__ == '__main__':
-    sys.exit(main())
+    try:
+        sys.exit(main())
+    except SystemExit as err:
+        stats.dump(err.code)
+        raise
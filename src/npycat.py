@@ -5,7 +5,9 @@ import shutil
 import argparse
 import logging
 
-import numpy as np
+import npyzcore
+
+np = npyzcore.lazy_import('numpy')
 
 ERRNO_ARGS = 1
 ERRNO_READ = 2
@@ -15,6 +17,8 @@ ERRNO_INT = 130
 
 errno = 0
 
+stats = npyzcore.Stats('npycat')
+
 LOGGING_LEVEL = logging.WARNING
 
 
@@ -65,6 +69,7 @@ def make_parser():
         help=('read filenames to concatenate/stack from FILE; use `-\' '
               'to denote stdin. In either case the filenames '
               'should be placed one per line'))
+    npyzcore.add_stats_argument(parser)
     parser.add_argument(
         'npyfiles',
         nargs='*',
@@ -82,15 +87,9 @@ def make_parser():
 def decide_input_files(args):
     global errno
     filenames = []
-    if args.from_file == '-':
-        filenames.extend(x.rstrip('\n') for x in sys.stdin)
-        if not filenames and not args.npyfiles:
-            logging.info('nothing to load; aborted')
-            sys.exit(errno)
-    elif args.from_file:
+    if args.from_file:
         try:
-            with open(args.from_file) as infile:
-                filenames.extend(x.rstrip('\n') for x in infile)
+            filenames.extend(npyzcore.read_filenames(args.from_file))
         except OSError as err:
             logging.warning('failed to load NPYFILEs from "%s" due to %s',
                             args.from_file, err)
@@ -108,33 +107,31 @@ def read_data(filenames):
     if filenames:
         for filename in filenames:
             try:
-                data = np.load(filename)
-            except OSError as err:
-                logging.error('failed to load "%s" due to %s', filename, err)
-                sys.exit(errno | ERRNO_READ)
-            if hasattr(data, 'keys'):
-                data.close()
+                data = npyzcore.load_npy(filename)
+            except npyzcore.NotNpyFileError:
                 logging.error('failed to load "%s" as npy file', filename)
                 sys.exit(errno | ERRNO_READ)
+            except (OSError, ValueError) as err:
+                logging.error('failed to load "%s" due to %s', filename, err)
+                sys.exit(errno | ERRNO_READ)
             logging.debug('loaded data of shape %s from "%s"', data.shape,
                           filename)
+            stats.add_read_file(filename)
             all_data.append(data)
     else:
-        with io.BytesIO() as cbuf:
-            shutil.copyfileobj(sys.stdin.buffer, cbuf)
-            cbuf.seek(0)
+        with npyzcore.read_stdin() as cbuf:
             try:
-                data = np.load(cbuf)
-            except OSError as err:
+                data = npyzcore.read_npy(cbuf)
+            except npyzcore.NotNpyFileError:
+                logging.error('failed to load "/dev/stdin" as npy file')
+                sys.exit(errno | ERRNO_READ)
+            except ValueError as err:
                 logging.error('failed to load from "/dev/stdin" due to %s',
                               err)
                 sys.exit(errno | ERRNO_READ)
-            if hasattr(data, 'keys'):
-                data.close()
-                logging.error('failed to load "/dev/stdin" as npy file')
-                sys.exit(errno | ERRNO_READ)
             logging.debug('loaded data of shape %s from "/dev/stdin"',
                           data.shape)
+            stats.add_read(cbuf.getbuffer().nbytes)
             all_data.append(data)
     return all_data
 
@@ -158,21 +155,23 @@ def write_data(args, result):
     if args.output:
         if args.textwrite:
             try:
-                with open(args.output, 'w') as outfile:
+                with npyzcore.atomic_open(args.output, 'w') as outfile:
                     np.savetxt(outfile, result)
             except (OSError, ValueError) as err:
                 logging.error('failed to write result to "%s" due to %s',
                               args.output, err)
                 sys.exit(errno | ERRNO_WRITE)
+            stats.add_written_file(args.output)
             logging.info('written result to "%s"', args.output)
         else:
             try:
-                with open(args.output, 'wb') as outfile:
-                    np.save(outfile, result)
+                with npyzcore.atomic_open(args.output) as outfile:
+                    npyzcore.write_npy(outfile, result)
             except OSError as err:
                 logging.error('failed to write result to "%s" due to %s',
                               args.output, err)
                 sys.exit(errno | ERRNO_WRITE)
+            stats.add_written_file(args.output)
             logging.info('written result to "%s"', args.output)
     else:
         if args.textwrite:
@@ -184,29 +183,34 @@ def write_data(args, result):
                         'failed to write result to "/dev/stdout" '
                         'due to %s', err)
                     sys.exit(errno | ERRNO_WRITE)
+                stats.add_written(cbuf.tell())
                 cbuf.seek(0)
                 shutil.copyfileobj(cbuf, sys.stdout)
                 logging.info('written result to "/dev/stdout"')
         else:
-            with io.BytesIO() as cbuf:
-                np.save(cbuf, result)
-                cbuf.seek(0)
-                shutil.copyfileobj(cbuf, sys.stdout.buffer)
+            npyzcore.write_npy(stats.counting_writer(sys.stdout.buffer),
+                               result)
             logging.info('written result to "/dev/stdout"')
 
 
 def main():
     logging.basicConfig(
         format='%(filename)s: %(levelname)s: %(message)s', level=LOGGING_LEVEL)
-    args = make_parser().parse_args()
-    filenames = decide_input_files(args)
+    args = make_parser().parse_args(
+        npyzcore.expand_stats_option(sys.argv[1:]))
+    stats.enable(args.stats)
+    with stats.phase('decide_inputs'):
+        filenames = decide_input_files(args)
     logging.debug('input filenames = %s', filenames or '/dev/stdin')
-    all_data = read_data(filenames)
+    with stats.phase('read'):
+        all_data = read_data(filenames)
     if not all_data:
         logging.debug('loaded nothing; aborted')
         return
-    result = merge_data(args, all_data)
-    write_data(args, result)
+    with stats.phase('merge'):
+        result = merge_data(args, all_data)
+    with stats.phase('write'):
+        write_data(args, result)
 
 
 if __name__ == '__main__':
@@ -220,4 +224,5 @@ if __name__ == '__main__':
         sys.stderr.close()
         errno |= ERRNO_WRITE
     finally:
+        stats.dump(errno)
         sys.exit(errno)
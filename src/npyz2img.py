@@ -1,29 +1,50 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+
 import argparse
 import sys
 import os
 import re
+import string
 import io
 import shutil
 import itertools
+import contextlib
+import functools
+import hashlib
+import json
+import tempfile
+import collections
+import zipfile
+import struct
+import zlib
 import typing
 import logging
 
-import numpy as np
-import matplotlib
+import npyzcore
 
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+np = npyzcore.lazy_import('numpy')
+multiprocessing = npyzcore.lazy_import('multiprocessing')
 
 ERROR_ARGS = 1
 ERROR_READ = 2
 ERROR_DATA = 4
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+PNG_COMPRESS_LEVEL = 6
+LUT_SIZE = 256
+AUTO_CONTRAST_SAMPLES = 1 << 16
+CHUNK_SIZE = 1 << 24
+FRAME_FORMATS = ('y4m', 'rgb24', 'apng', 'gif')
+
+stats = npyzcore.Stats('npyz2img')
+
 SliceExpr = typing.Tuple[typing.Union[
                              slice,
                              typing.Tuple[int, ...],
                              type(...)], ...]
-NpyzData = typing.Union[np.ndarray, typing.Dict[str, np.ndarray]]
+NpyzData = typing.Union['np.ndarray', typing.Dict[str, 'np.ndarray']]
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -64,6 +85,63 @@ def channel_order(string: str) -> str:
     return string
 
 
+def grid_shape(string: str) -> typing.Tuple[int, int]:
+    matched = re.fullmatch(r'\s*(\d+)\s*[xX]\s*(\d+)\s*', string)
+    if not matched or not all(map(int, matched.groups())):
+        raise argparse.ArgumentTypeError(
+            'expecting ROWSxCOLS of positive integers but got `%s\''
+            % string)
+    return int(matched.group(1)), int(matched.group(2))
+
+
+def nonnegative_int(string: str) -> int:
+    try:
+        value = int(string)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            'illegal integer `%s\'' % string) from err
+    if value < 0:
+        raise argparse.ArgumentTypeError(
+            'expecting non-negative integer but got `%s\'' % string)
+    return value
+
+
+def scale_factor(string: str) -> float:
+    try:
+        value = float(string)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            'illegal factor `%s\'' % string) from err
+    if not 0.0 < value <= 1.0:
+        raise argparse.ArgumentTypeError(
+            'expecting factor in (0, 1] but got `%s\'' % string)
+    return value
+
+
+def percentile_range(string: str) -> typing.Tuple[float, float]:
+    try:
+        low, high = map(float, string.split(','))
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            'illegal percentile range `%s\'' % string) from err
+    if not 0.0 <= low < high <= 100.0:
+        raise argparse.ArgumentTypeError(
+            'expecting 0 <= LOW < HIGH <= 100 but got `%s\'' % string)
+    return low, high
+
+
+def positive_int(string: str) -> int:
+    try:
+        value = int(string)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            'illegal integer `%s\'' % string) from err
+    if value <= 0:
+        raise argparse.ArgumentTypeError(
+            'expecting positive integer but got `%s\'' % string)
+    return value
+
+
 stdout = object()
 
 
@@ -74,6 +152,7 @@ def make_parser():
                     'beginning of NPYZFILEs if necessary.')
     parser.add_argument('npyzfile', metavar='NPYZFILE', type=os.path.normpath,
                         help='the npy/npz file from which to render image(s)')
+    npyzcore.add_stats_argument(parser)
     dtypeopts = parser.add_argument_group('data type options')
     dtypeopts.add_argument('-T', '--dtype', default='uint8',
                            help='enforce an expected data type of the '
@@ -106,12 +185,22 @@ def make_parser():
                               'extracted tensor is of shape `(N,H,W,C)\', and '
                               '`NNHW\' means the extracted tensor is of shape '
                               '`(N1,N2,H,W)\'. Default to `%(default)s\'')
-    indopts.add_argument('-K', '--key',
-                         help='the npz data key; for simplicity, only one key'
-                              ' can be specified each time. This option will '
-                              'be omitted if NPYZFILE is an npy file, and '
-                              'will be mandatory if NPYZFILE is an npz file '
-                              'containing more than one key')
+    keyopts = indopts.add_mutually_exclusive_group()
+    keyopts.add_argument('-K', '--key', action='append',
+                         help='the npz data key; may be specified several '
+                              'times to render several keys in one pass. '
+                              'This option will be omitted if NPYZFILE is '
+                              'an npy file, and will be mandatory if '
+                              'NPYZFILE is an npz file containing more than '
+                              'one key and `--all-keys\' is not specified')
+    keyopts.add_argument('--all-keys', action='store_true',
+                         help='render all keys of the npz file. When '
+                              'rendering several keys, the archive is opened '
+                              'once, the keys are loaded one after another, '
+                              'and `-j\' shares one pool of workers among '
+                              'them; the images can only be written to '
+                              'TODIR, and OUT_TEMPLATE must contain the '
+                              '`key\' placeholder')
     indopts.add_argument('-I', '--index', metavar='SLICE_EXPR',
                          type=slice_expr, default=':',
                          help='the indexing expression if it\'s not intended '
@@ -122,6 +211,44 @@ def make_parser():
     rdropts.add_argument('-A', '--cmap', default='gray',
                          help='cmap to use if underlying images are '
                               'grayscale. Default to %(default)s')
+    rdropts.add_argument('--scale', type=scale_factor,
+                         help='shrink the images by a factor in (0, 1] by '
+                              'area averaging before encoding; all images of '
+                              'a chunk of the data are shrunk at once')
+    rdropts.add_argument('--max-size', metavar='PIXELS', type=positive_int,
+                         help='shrink the images as with `--scale\' so that '
+                              'neither side exceeds PIXELS; the smaller '
+                              'size wins if `--scale\' is also specified')
+    rdropts.add_argument('--auto-contrast', metavar='LOW,HIGH', nargs='?',
+                         type=percentile_range, const=(1.0, 99.0),
+                         help='stretch each image linearly so that its LOWth '
+                              'to HIGHth percentiles span the full range of '
+                              'colors, after clipping and instead of '
+                              'checking normalization; the percentiles are '
+                              'estimated from an evenly strided sample of '
+                              'at most %d pixels of each image. Default to '
+                              '`1,99\' if LOW,HIGH is left empty'
+                              % AUTO_CONTRAST_SAMPLES)
+    mtgopts = parser.add_argument_group(
+        'montage options',
+        'tile the images into sheets of ROWS by COLS images in row-major '
+        'order, each of which is encoded as one image. If there are more '
+        'than ROWS*COLS images, several sheets are made, where the only '
+        'positional placeholder of OUT_TEMPLATE is replaced by the sheet '
+        'number')
+    mtgopts.add_argument('-M', '--montage', metavar='ROWSxCOLS',
+                         type=grid_shape,
+                         help='the number of rows and columns of images per '
+                              'sheet, e.g. `8x16\'')
+    mtgopts.add_argument('--montage-padding', metavar='PIXELS',
+                         type=nonnegative_int, default=0,
+                         help='the number of blank pixels between adjacent '
+                              'images. Default to %(default)s')
+    mtgopts.add_argument('--montage-downscale', metavar='FACTOR',
+                         type=positive_int, default=1,
+                         help='shrink each image by FACTOR by averaging '
+                              'FACTOR-by-FACTOR blocks of pixels before '
+                              'tiling. Default to %(default)s')
     outopts = parser.add_argument_group('output options')
     outopts.add_argument('-o', '--tofile', type=os.path.normpath, nargs='?',
                          const=stdout,
@@ -155,11 +282,57 @@ def make_parser():
     outopts.add_argument('-F', '--output-format',
                          help='the image format to write; if specified, this '
                               'option overwrites the output format implied by '
-                              'OUT_TEMPLATE')
+                              'OUT_TEMPLATE. When writing to TOFILE or '
+                              'stdout, the frame sequence formats %s write '
+                              'all images in order as frames: `y4m\' and '
+                              '`rgb24\' (raw RGB frames) are meant to be '
+                              'piped into a video encoder such as ffmpeg, '
+                              'and `apng\' and `gif\' make an animation; '
+                              'note that `gif\' requires Pillow and holds '
+                              'all frames in memory'
+                              % ', '.join(map('`{}\''.format,
+                                              FRAME_FORMATS)))
+    outopts.add_argument('--fps', type=positive_int, default=25,
+                         help='the frame rate of frame sequence formats. '
+                              'Default to %(default)s')
     outopts.add_argument('--overwrite', action='store_true',
                          help='if not specified, abort whenever an existing '
                               'file exists; otherwise overwrite existing '
                               'files')
+    outopts.add_argument('--incremental', action='store_true',
+                         help='keep a cache of the hashes of the source '
+                              'bytes and rendering options of the images '
+                              'written under TODIR in the sidecar file `%s\' '
+                              'there, and only render the images that are '
+                              'new or have changed since; the files written '
+                              'by earlier incremental runs are overwritten '
+                              'when changed, regardless of `--overwrite\'. '
+                              'Not applicable with `--montage\''
+                              % RenderCache.FILENAME)
+    outopts.add_argument('-j', '--jobs', metavar='N', type=positive_int,
+                         default=1,
+                         help='encode images in parallel using a pool of N '
+                              'worker processes, each of which reads its '
+                              'images from the memory-mapped NPYZFILE. '
+                              'Effective only when writing separate images '
+                              'or pyramid tiles to TODIR. Default to '
+                              '%(default)s')
+    pyropts = parser.add_argument_group(
+        'pyramid options',
+        'write the only image to render as a Deep Zoom tile pyramid under '
+        'TODIR, for images too large to encode as a whole: the tiles of '
+        'each level are encoded from tile-sized windows of the level, and '
+        'each level is built by averaging 2-by-2 blocks of the level above, '
+        'down to a 1-by-1 pixel level 0. OUT_TEMPLATE is not used')
+    pyropts.add_argument('-Z', '--pyramid', metavar='NAME',
+                         help='write the descriptor `NAME.dzi\' and the '
+                              'tiles `NAME_files/LEVEL/COLUMN_ROW.FORMAT\' '
+                              'where FORMAT is OUTPUT_FORMAT, default to '
+                              '`png\'')
+    pyropts.add_argument('--tile-size', metavar='PIXELS', type=positive_int,
+                         default=256,
+                         help='the width and height of the tiles, an even '
+                              'number. Default to %(default)s')
     return parser
 
 
@@ -183,33 +356,83 @@ class InvalidOutputTemplate(Exception):
     pass
 
 
+def _load_npz_member(infile: typing.BinaryIO, zf: zipfile.ZipFile,
+                     infos: typing.Dict[str, zipfile.ZipInfo],
+                     key: str) -> np.ndarray:
+    """
+    Memory-map ``key`` of the npz file opened as ``infile`` and ``zf`` if
+    it's stored without compression, or otherwise read it into memory.
+    """
+    info = infos[key]
+    data = npyzcore.npz_member_memmap(infile, info)
+    if data is None:
+        with zf.open(info) as member:
+            data = npyzcore.read_npy(member)
+    return data
+
+
+@contextlib.contextmanager
+def open_npyz(filename: str, keys: typing.Optional[typing.List[str]],
+              all_keys: bool = False):
+    """
+    Open npy/npz file ``filename`` once to load the data of several keys.
+
+    :param filename: the npyzfile name
+    :param keys: the keys to use if ``filename`` is an npz file, or
+           ``None`` to use its only key
+    :param all_keys: ``True`` to use all keys of the npz file
+    :return: context manager of (``True`` if ``filename`` is an npy file,
+             the list of keys, function loading the data of a key), where
+             the key is ``None`` for an npy file. The data are
+             memory-mapped if possible, and are loaded only on demand
+    :raise NilKeyError: if no key is specified while the npz file has more
+           than one key
+    :raise KeyError: if any of ``keys`` is not found
+    :raise ValueError: if ``filename`` is a malformed npy file
+    :raise zipfile.BadZipFile: if ``filename`` is neither npy nor npz file
+    """
+    with open(filename, 'rb') as infile:
+        try:
+            npyzcore.read_npy_header(infile)
+        except npyzcore.NotNpyFileError:
+            infile.seek(0)
+        else:
+            data = npyzcore.load_npy(filename)
+            yield True, [None], lambda _: data
+            return
+        with zipfile.ZipFile(infile) as zf:
+            infos = {npyzcore.npz_member_key(info): info
+                     for info in zf.infolist()}
+            zkeys = list(infos)
+            if all_keys:
+                keys = zkeys
+            elif not keys:
+                if len(zkeys) > 1:
+                    raise NilKeyError
+                if not zkeys:
+                    raise KeyError
+                keys = zkeys
+            for key in keys:
+                if key not in zkeys:
+                    raise KeyError(key)
+            yield False, keys, functools.partial(_load_npz_member, infile,
+                                                 zf, infos)
+
+
 def loaddata(filename: str, key: typing.Optional[str]) \
         -> typing.Tuple[NpyzData, bool]:
     """
-    Load data and determine its file type.
+    Load data and determine its file type. The data are memory-mapped if
+    possible.
+
     :param filename: the npyzfile name
     :param key: the key to use if ``filename`` is an npz file
     :return: (data, ``True`` if ``filename`` is an npy file)
     :raise KeyError: if ``filename`` is an npz file and ``key`` is not found
     """
-    zdata = np.load(filename)
-    try:
-        zkeys = list(zdata.keys())
-    except AttributeError:
-        data = zdata
-        is_npy = True
-    else:
-        if key is None:
-            n_keys = len(zkeys)
-            if n_keys > 1:
-                raise NilKeyError
-            if n_keys == 0:
-                raise KeyError
-            data = zdata[zkeys[0]]
-        else:
-            data = zdata[key]
-        is_npy = False
-    return data, is_npy
+    with open_npyz(filename,
+                   None if key is None else [key]) as (is_npy, keys, load):
+        return load(keys[0]), is_npy
 
 
 def check_shape(subdata: np.ndarray, channels: str) \
@@ -244,61 +467,693 @@ def check_shape(subdata: np.ndarray, channels: str) \
     return subdata, ends_with_c
 
 
-def clip_data(data: np.ndarray,
-              expected_dtype: typing.Optional[np.dtype],
-              vmin: typing.Optional[float],
-              vmax: typing.Optional[float]) -> np.ndarray:
+def clip_bounds(dtype: np.dtype,
+                expected_dtype: typing.Optional[np.dtype],
+                vmin: typing.Optional[float],
+                vmax: typing.Optional[float]) \
+        -> typing.Tuple[typing.Optional[float], typing.Optional[float]]:
+    """
+    Check data type and cast the clipping bounds to it.
+
+    :param dtype: the data type of the data to clip
+    :raise UnexpectedDTypeError: if ``dtype`` is not ``expected_dtype``
+    """
     if expected_dtype is not None:
         expected_dtype = np.dtype(expected_dtype)
-        if expected_dtype != data.dtype:
+        if expected_dtype != dtype:
             raise UnexpectedDTypeError
         ty = expected_dtype
     else:
-        ty = data.dtype
+        ty = dtype
 
     if vmin is not None:
         vmin = np.array(vmin).astype(ty).item()
     if vmax is not None:
         vmax = np.array(vmax).astype(ty).item()
+    return vmin, vmax
+
+
+def clip_data(data: np.ndarray,
+              expected_dtype: typing.Optional[np.dtype],
+              vmin: typing.Optional[float],
+              vmax: typing.Optional[float]) -> np.ndarray:
+    vmin, vmax = clip_bounds(data.dtype, expected_dtype, vmin, vmax)
     if vmin is not None or vmax is not None:
         data = data.clip(vmin, vmax)
     return data
 
 
-def ensure_normalized(data: np.ndarray) -> None:
+def ensure_normalized(data: np.ndarray,
+                      vmin: typing.Optional[float] = None,
+                      vmax: typing.Optional[float] = None,
+                      chunk_size: int = CHUNK_SIZE) -> None:
+    """
+    Ensure ``data``, once clipped to [``vmin``, ``vmax``], is within the
+    normalized range. ``data`` is scanned in chunks of about ``chunk_size``
+    bytes with one min/max reduction each, and the scan stops at the first
+    chunk out of range.
+
+    :raise NotNormalizedError: if ``data`` is not normalized
+    """
+    if issubclass(data.dtype.type, np.integer):
+        kind, lo, hi = np.integer, 0, 255
+    elif issubclass(data.dtype.type, np.floating):
+        kind, lo, hi = np.floating, 0.0, 1.0
+    else:
+        return
+    for block in npyzcore.iter_blocks(data, chunk_size):
+        if not block.size:
+            continue
+        bmin, bmax = block.min(), block.max()
+        if vmin is not None:
+            bmin, bmax = max(bmin, vmin), max(bmax, vmin)
+        if vmax is not None:
+            bmin, bmax = min(bmin, vmax), min(bmax, vmax)
+        if bmin < lo or bmax > hi:
+            raise NotNormalizedError(kind)
+
+
+def norm_range(dtype: np.dtype) -> typing.Tuple[float, float]:
+    """The value range mapped to the full range of colors."""
+    if issubclass(dtype.type, np.integer):
+        return 0, 255
+    return 0.0, 1.0
+
+
+def needs_lut(dtype: np.dtype, ends_with_c: bool, cmap: str) -> bool:
+    """Whether gray images have to be mapped to colors through ``cmap``."""
+    return (not ends_with_c and bool(cmap)
+            and not (dtype == np.uint8 and cmap == 'gray'))
+
+
+@functools.lru_cache(maxsize=None)
+def make_lut(cmap: str) -> np.ndarray:
+    """
+    Build the RGB lookup table of ``cmap``, whose kth entry is the color of
+    the kth of ``LUT_SIZE`` equal-width bins of normalized values.
+
+    :raise ValueError: if ``cmap`` is not a known colormap
+    """
+    import matplotlib
+    try:
+        colormap = matplotlib.colormaps[cmap]
+    except AttributeError:
+        import matplotlib.cm
+        colormap = matplotlib.cm.get_cmap(cmap)
+    except KeyError as err:
+        raise ValueError(cmap) from err
+    levels = (np.arange(LUT_SIZE) + 0.5) / LUT_SIZE
+    return colormap(levels, bytes=True)[:, :3]
+
+
+@functools.lru_cache(maxsize=None)
+def uint8_levels() -> np.ndarray:
+    """The ``quantize`` bin indices of each uint8 value."""
+    return np.minimum(
+        np.arange(256) * LUT_SIZE // 255, LUT_SIZE - 1).astype(np.uint8)
+
+
+def quantize(data: np.ndarray) -> np.ndarray:
+    """
+    Quantize ``data`` into uint8 bin indices of ``LUT_SIZE`` bins over
+    ``norm_range``, the same way matplotlib normalizes data before looking
+    up its colormap. Out-of-range values fall into the end bins, and NaNs
+    into the first bin.
+    """
+    if data.dtype == np.uint8:
+        return uint8_levels().take(data)
+    lo, hi = norm_range(data.dtype)
+    levels = np.subtract(data, lo, dtype=np.result_type(data, np.float32))
+    levels *= LUT_SIZE / (hi - lo)
+    np.nan_to_num(levels, copy=False, nan=0.0)
+    np.clip(levels, 0, LUT_SIZE - 1, out=levels)
+    return levels.astype(np.uint8)
+
+
+def apply_cmap(data: np.ndarray, cmap: str) -> np.ndarray:
+    """
+    Map gray images of shape (..., H, W) to RGB images of shape
+    (..., H, W, 3) in one vectorized pass via the lookup table of ``cmap``.
+    """
+    return make_lut(cmap).take(quantize(data), axis=0)
+
+
+def thumbnail_size(height: int, width: int, scale: typing.Optional[float],
+                   max_size: typing.Optional[int]) \
+        -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    The size to which to shrink images of ``height`` by ``width`` so that
+    they're scaled by ``scale`` and fit in ``max_size``, or ``None`` if
+    they're not to be shrunk.
+    """
+    factor = 1.0
+    if scale is not None:
+        factor = scale
+    if max_size is not None:
+        factor = min(factor, max_size / max(height, width))
+    if factor >= 1.0:
+        return None
+    return (max(1, int(round(height * factor))),
+            max(1, int(round(width * factor))))
+
+
+@functools.lru_cache(maxsize=None)
+def area_weights(n_in: int, n_out: int) -> np.ndarray:
+    """
+    Matrix of shape (n_out, n_in) that resamples ``n_in`` pixels to
+    ``n_out`` by area averaging, i.e. by weighting each input pixel by its
+    overlap with each output pixel.
+    """
+    edges = np.arange(n_out + 1) * (n_in / n_out)
+    lo = np.maximum(edges[:-1, np.newaxis], np.arange(n_in))
+    hi = np.minimum(edges[1:, np.newaxis], np.arange(1, n_in + 1))
+    weights = np.clip(hi - lo, 0, None) * (n_out / n_in)
+    weights.flags.writeable = False
+    return weights
+
+
+def _resample_axis(data: np.ndarray, axis: int, n_out: int,
+                   dtype: np.dtype) -> np.ndarray:
+    n_in = data.shape[axis]
+    if n_in == n_out:
+        return data
+    if n_in % n_out == 0:
+        factor = n_in // n_out
+        blocks = data.reshape(data.shape[:axis] + (n_out, factor)
+                              + data.shape[axis + 1:])
+        return blocks.mean(axis=axis + 1, dtype=dtype)
+    weights = area_weights(n_in, n_out).astype(dtype, copy=False)
+    return np.moveaxis(np.tensordot(weights, data.astype(dtype, copy=False),
+                                    axes=([1], [axis])), 0, axis)
+
+
+def resize_images(data: np.ndarray, size: typing.Tuple[int, int],
+                  ends_with_c: bool) -> np.ndarray:
+    """
+    Shrink all images of ``data`` of canonical shape at once to ``size``,
+    i.e. (height, width), by area averaging. Integer shrinking factors
+    average blocks by reshaping; other factors resample by multiplying
+    with the ``area_weights`` matrices.
+    """
+    haxis = data.ndim - (3 if ends_with_c else 2)
+    dtype = np.float64 if data.dtype == np.float64 else np.float32
+    resized = _resample_axis(data, haxis, size[0], dtype)
+    resized = _resample_axis(resized, haxis + 1, size[1], dtype)
     if issubclass(data.dtype.type, np.integer):
-        if (data < 0).any() or (data > 255).any():
-            raise NotNormalizedError(np.integer)
-    if issubclass(data.dtype.type, np.floating):
-        if (data < 0.0).any() or (data > 1.0).any():
-            raise NotNormalizedError(np.floating)
+        resized = np.rint(resized)
+    return resized.astype(data.dtype, copy=False)
+
+
+def sample_percentiles(data: np.ndarray, n_lead: int,
+                       percentiles: typing.Tuple[float, float],
+                       n_samples: int = AUTO_CONTRAST_SAMPLES) \
+        -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Estimate the two ``percentiles`` of each image of ``data``, whose first
+    ``n_lead`` axes index the images, from an evenly strided sample of at
+    most about ``n_samples`` elements per image, with one ``np.partition``
+    over all images at once. Only finite samples count; if there are
+    others, the samples are sorted instead, with the others last, so that
+    the ranks may differ from image to image.
 
+    :return: the low and high percentiles, each of shape
+             ``data.shape[:n_lead]``
+    """
+    flat = data.reshape(data.shape[:n_lead] + (-1,))
+    stride = max(1, -(-flat.shape[-1] // n_samples))
+    sample = flat[..., ::stride]
+    finite = np.isfinite(sample) if sample.dtype.kind == 'f' else None
+    if finite is None or finite.all():
+        last = sample.shape[-1] - 1
+        kth = [int(round(p / 100.0 * last)) for p in percentiles]
+        parted = np.partition(sample, sorted(set(kth)), axis=-1)
+        return parted[..., kth[0]], parted[..., kth[1]]
+    ordered = np.sort(np.where(finite, sample, np.inf), axis=-1)
+    last = np.maximum(np.count_nonzero(finite, axis=-1) - 1, 0)
+    lo, hi = (np.take_along_axis(
+        ordered, np.rint(p / 100.0 * last).astype(np.intp)[..., None],
+        axis=-1)[..., 0] for p in percentiles)
+    return lo, hi
+
+
+def auto_contrast(data: np.ndarray, percentiles: typing.Tuple[float, float],
+                  ends_with_c: bool) -> np.ndarray:
+    """
+    Stretch each image of ``data`` of canonical shape so that its sampled
+    ``percentiles`` map to 0 and 255, quantizing to uint8 in the same pass.
+    Images of constant value map to 0.
+    """
+    n_lead = data.ndim - (3 if ends_with_c else 2)
+    lo, hi = sample_percentiles(data, n_lead, percentiles)
+    extra = (1,) * (data.ndim - n_lead)
+    lo = lo.reshape(lo.shape + extra)
+    span = (hi.reshape(hi.shape + extra) - lo).astype(np.float64)
+    scale = np.divide(255.0, span, out=np.zeros_like(span), where=span > 0)
+    levels = np.subtract(data, lo, dtype=np.result_type(data, np.float32))
+    levels *= scale.astype(levels.dtype)
+    np.nan_to_num(levels, copy=False, nan=0.0)
+    np.clip(levels, 0, 255, out=levels)
+    return np.rint(levels, out=levels).astype(np.uint8)
 
-def render_images(data: np.ndarray, ends_with_c: bool) \
+
+def transform_images(data: np.ndarray,
+                     vmin: typing.Optional[float],
+                     vmax: typing.Optional[float],
+                     lut_cmap: typing.Optional[str],
+                     size: typing.Optional[typing.Tuple[int, int]] = None,
+                     ends_with_c: bool = False,
+                     contrast: typing.Optional[typing.Tuple[float, float]]
+                     = None) -> np.ndarray:
+    """
+    Clip ``data``, shrink its images to ``size`` if any, stretch them to
+    uint8 as per the ``contrast`` percentiles if any, and map it to colors
+    through ``lut_cmap`` if any.
+    """
+    if vmin is not None or vmax is not None:
+        data = data.clip(vmin, vmax)
+    if size is not None:
+        data = resize_images(np.asarray(data), size, ends_with_c)
+    if contrast is not None:
+        data = auto_contrast(np.asarray(data), contrast, ends_with_c)
+    if lut_cmap:
+        data = apply_cmap(data, lut_cmap)
+    return data
+
+
+def image_ids(data: np.ndarray, ends_with_c: bool) \
+        -> typing.Iterator[typing.Tuple[int, ...]]:
+    ns = data.shape[:-(3 if ends_with_c else 2)]
+    return itertools.product(*map(range, ns))
+
+
+def render_images(data: np.ndarray, ends_with_c: bool,
+                  transform: typing.Optional[typing.Callable] = None,
+                  chunk_size: int = CHUNK_SIZE,
+                  imgids: typing.Optional[typing.Iterable] = None) \
         -> typing.Iterator[typing.Tuple[typing.Tuple[int, ...], np.ndarray]]:
+    """
+    Yield (image id, image) from ``data`` of canonical shape, for all
+    images or only those of ``imgids``. Images are read in batches of about
+    ``chunk_size`` bytes, and ``transform`` is applied to each batch as a
+    whole, so only the selected images of memory-mapped ``data`` are ever
+    read.
+    """
+    if transform is None:
+        transform = np.asarray
     ns = data.shape[:-(3 if ends_with_c else 2)]
-    indices = itertools.product(*map(range, ns))
-    if ns:
-        for imgid in indices:
-            yield imgid, data[imgid]
+    if not ns:
+        yield (), transform(np.asarray(data))
+        return
+    img_nbytes = data.nbytes // max(1, int(np.prod(ns)))
+    batch_len = max(1, chunk_size // max(1, img_nbytes))
+    indices = iter(image_ids(data, ends_with_c) if imgids is None
+                   else imgids)
+    while True:
+        imgids = list(itertools.islice(indices, batch_len))
+        if not imgids:
+            break
+        batch = transform(np.stack([data[imgid] for imgid in imgids]))
+        yield from zip(imgids, batch)
+
+
+def box_downscale(img: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Shrink image of shape (H, W[, C]) by integer ``factor`` by averaging
+    ``factor``-by-``factor`` blocks; trailing rows and columns that don't
+    fill a block are dropped.
+    """
+    height, width = img.shape[0] // factor, img.shape[1] // factor
+    blocks = img[:height * factor, :width * factor].reshape(
+        (height, factor, width, factor) + img.shape[2:])
+    shrunk = blocks.mean(axis=(1, 3))
+    if issubclass(img.dtype.type, np.integer):
+        shrunk = np.rint(shrunk)
+    return shrunk.astype(img.dtype)
+
+
+def montage_sheets(image_source, rows: int, cols: int, padding: int = 0,
+                   downscale: int = 1) \
+        -> typing.Iterator[typing.Tuple[typing.Tuple[int], np.ndarray]]:
+    """
+    Tile images from ``image_source`` into sheets of ``rows`` by ``cols``
+    images, with ``padding`` blank pixels in between, after shrinking each
+    image by ``downscale``. Only one sheet is held in memory at a time.
+
+    :return: iterator of ((sheet number,), sheet)
+    """
+    n_tiles = rows * cols
+    sheet = None
+    sheet_no = -1
+    for i, (_, img) in enumerate(image_source):
+        if downscale > 1:
+            img = box_downscale(img, downscale)
+        slot = i % n_tiles
+        if not slot:
+            if sheet is not None:
+                yield (sheet_no,), sheet
+            sheet_no += 1
+            height, width = img.shape[:2]
+            sheet = np.zeros(
+                (rows * height + (rows - 1) * padding,
+                 cols * width + (cols - 1) * padding) + img.shape[2:],
+                dtype=img.dtype)
+        row, col = divmod(slot, cols)
+        top, left = row * (height + padding), col * (width + padding)
+        sheet[top:top + height, left:left + width] = img
+    if sheet is not None:
+        yield (sheet_no,), sheet
+
+
+def halve(img: np.ndarray) -> np.ndarray:
+    """
+    Shrink image of shape (H, W[, C]) by 2 by averaging 2-by-2 blocks; odd
+    trailing rows and columns are averaged with themselves.
+    """
+    pad = [(0, img.shape[0] % 2), (0, img.shape[1] % 2)]
+    if any(after for _, after in pad):
+        img = np.pad(img, pad + [(0, 0)] * (img.ndim - 2), mode='edge')
+    return box_downscale(img, 2)
+
+
+def pyramid_levels(height: int, width: int) -> int:
+    """Number of levels of the pyramid down to a 1-by-1 image."""
+    return (max(height, width) - 1).bit_length() + 1
+
+
+def pyramid_tiles(img: np.ndarray, tile_size: int, workdir: str,
+                  transform: typing.Optional[typing.Callable] = None) \
+        -> typing.Iterator[typing.Tuple[int, int, int, np.ndarray]]:
+    """
+    Yield the tiles of the Deep Zoom pyramid of image ``img`` of shape
+    (H, W[, C]), from the full-resolution level down to level 0 of 1-by-1
+    pixel. ``img`` is read, and ``transform`` applied, in bands of
+    ``tile_size`` rows. Each level below is built by halving the bands of
+    the level above into an array memory-mapped under ``workdir``, so that
+    no level is ever held whole in memory.
+
+    :param tile_size: an even number of pixels
+    :return: iterator of (level, column, row, tile)
+    """
+    if transform is None:
+        transform = np.asarray
+    level = pyramid_levels(*img.shape[:2]) - 1
+    src = img
+    while True:
+        height, width = src.shape[:2]
+        below = None
+        for r0 in range(0, height, tile_size):
+            band = np.asarray(src[r0:r0 + tile_size])
+            if src is img:
+                band = transform(band)
+            for c0 in range(0, width, tile_size):
+                yield (level, c0 // tile_size, r0 // tile_size,
+                       band[:, c0:c0 + tile_size])
+            if level == 0:
+                continue
+            if below is None:
+                below = np.lib.format.open_memmap(
+                    os.path.join(workdir, '{}.npy'.format(level - 1)),
+                    mode='w+', dtype=band.dtype,
+                    shape=((height + 1) // 2, (width + 1) // 2)
+                    + band.shape[2:])
+            below[r0 // 2:(r0 + band.shape[0] + 1) // 2] = halve(band)
+        if below is None:
+            return
+        below.flush()
+        src = below
+        level -= 1
+
+
+def to_frame(img: np.ndarray, keep_alpha: bool = False) -> np.ndarray:
+    """
+    Convert image to uint8 gray of shape (H, W) or RGB(A) of shape
+    (H, W, 3[4]) for frame sequence formats.
+    """
+    if img.ndim == 3 and img.shape[2] not in (3, 4):
+        raise TypeError('cannot make frame of shape {}'.format(img.shape))
+    if img.dtype != np.uint8:
+        if issubclass(img.dtype.type, np.floating):
+            img = quantize(img)
+        else:
+            img = np.clip(img, 0, 255).astype(np.uint8)
+    if img.ndim == 3 and img.shape[2] == 4 and not keep_alpha:
+        img = img[..., :3]
+    return np.ascontiguousarray(img)
+
+
+def rgb_to_ycbcr(img: np.ndarray) -> np.ndarray:
+    """
+    Convert uint8 RGB image to planar BT.601 limited-range YCbCr of shape
+    (3, H, W).
+    """
+    rgb = img.reshape(-1, 3).astype(np.float32)
+    ycbcr = rgb @ np.array([[65.481, -37.797, 112.0],
+                            [128.553, -74.203, -93.786],
+                            [24.966, 112.0, -18.214]],
+                           dtype=np.float32) / 255
+    ycbcr += np.array([16, 128, 128], dtype=np.float32)
+    ycbcr = np.rint(ycbcr, out=ycbcr).astype(np.uint8)
+    return np.ascontiguousarray(ycbcr.T).reshape((3,) + img.shape[:2])
+
+
+def write_y4m(fp, frames, fps: int) -> None:
+    """Write frames as YUV4MPEG2, gray frames in mono and RGB in 4:4:4."""
+    for i, frame in enumerate(frames):
+        if not i:
+            colorspace = 'mono' if frame.ndim == 2 else '444'
+            fp.write('YUV4MPEG2 W{} H{} F{}:1 Ip A1:1 C{}\n'.format(
+                frame.shape[1], frame.shape[0], fps, colorspace).encode())
+        fp.write(b'FRAME\n')
+        if frame.ndim == 2:
+            fp.write(frame)
+        else:
+            fp.write(rgb_to_ycbcr(frame))
+
+
+def write_rgb24(fp, frames) -> None:
+    """Write frames as raw packed RGB, 3 bytes per pixel."""
+    for i, frame in enumerate(frames):
+        if frame.ndim == 2:
+            frame = np.repeat(frame[..., np.newaxis], 3, axis=2)
+        if not i:
+            logging.info('writing rgb24 frames of size %dx%d',
+                         frame.shape[1], frame.shape[0])
+        fp.write(frame)
+
+
+def write_apng(fp, frames, n_frames: int, fps: int) -> None:
+    """
+    Write frames as an animated PNG looping forever, encoding and writing
+    one frame at a time. The number of frames has to be known beforehand,
+    as it's recorded ahead of the frames.
+    """
+    seq = 0
+    for i, frame in enumerate(frames):
+        height, width = frame.shape[:2]
+        n_channels = frame.shape[2] if frame.ndim == 3 else 1
+        if not i:
+            ihdr = struct.pack('>IIBBBBB', width, height, 8,
+                               PNG_COLOR_TYPES[n_channels], 0, 0, 0)
+            fp.write(PNG_SIGNATURE)
+            fp.write(_png_chunk(b'IHDR', ihdr))
+            fp.write(_png_chunk(b'acTL', struct.pack('>II', n_frames, 0)))
+        fp.write(_png_chunk(b'fcTL', struct.pack(
+            '>IIIIIHHBB', seq, width, height, 0, 0, 1, fps, 0, 0)))
+        seq += 1
+        raw = np.zeros((height, 1 + width * n_channels), dtype=np.uint8)
+        raw[:, 1:] = frame.reshape(height, width * n_channels)
+        data = zlib.compress(raw, PNG_COMPRESS_LEVEL)
+        if not i:
+            fp.write(_png_chunk(b'IDAT', data))
+        else:
+            fp.write(_png_chunk(b'fdAT', struct.pack('>I', seq) + data))
+            seq += 1
+    if seq:
+        fp.write(_png_chunk(b'IEND', b''))
+
+
+def write_gif(fp, frames, fps: int) -> None:
+    """Write frames as an animated GIF looping forever via Pillow."""
+    from PIL import Image
+    frames = (Image.fromarray(frame) for frame in frames)
+    try:
+        first = next(frames)
+    except StopIteration:
+        return
+    first.save(fp, format='GIF', save_all=True, append_images=frames,
+               duration=1000 / fps, loop=0)
+
+
+def write_frames(image_source, fp, fmt: str, n_frames: int,
+                 fps: int) -> None:
+    """
+    Write all images from ``image_source`` to binary file ``fp`` as frames
+    in frame sequence format ``fmt``.
+    """
+    frames = (to_frame(img, keep_alpha=(fmt == 'apng'))
+              for _, img in image_source)
+    if fmt == 'y4m':
+        write_y4m(fp, frames, fps)
+    elif fmt == 'rgb24':
+        write_rgb24(fp, frames)
+    elif fmt == 'apng':
+        write_apng(fp, frames, n_frames, fps)
     else:
-        yield (), data
+        write_gif(fp, frames, fps)
 
 
-def write_images(image_source, todir: str, output_format: typing.Optional[str],
-                 cmap: str, ends_with_c: bool,
-                 is_npy: bool, key: typing.Optional[str],
-                 template: typing.Optional[str], overwrite: bool) -> None:
+def _pyplot():
+    """Import ``matplotlib.pyplot`` on demand, as it's slow to import."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def image_format(tofile, render_kwargs: dict) -> str:
+    try:
+        return render_kwargs['format'].lower()
+    except KeyError:
+        pass
+    try:
+        ext = os.path.splitext(tofile)[1]
+    except TypeError:
+        ext = ''
+    return ext[1:].lower() or 'png'
+
+
+def _png_chunk(tag: bytes, data) -> bytes:
+    crc = zlib.crc32(data, zlib.crc32(tag))
+    return b''.join([struct.pack('>I', len(data)), tag, bytes(data),
+                     struct.pack('>I', crc)])
+
+
+def encode_png(img: np.ndarray) -> bytes:
+    """
+    Encode uint8 image of shape (H, W), (H, W, 3) or (H, W, 4) as PNG.
+    """
+    height, width = img.shape[:2]
+    n_channels = img.shape[2] if img.ndim == 3 else 1
+    raw = np.zeros((height, 1 + width * n_channels), dtype=np.uint8)
+    raw[:, 1:] = img.reshape(height, width * n_channels)
+    ihdr = struct.pack('>IIBBBBB', width, height, 8,
+                       PNG_COLOR_TYPES[n_channels], 0, 0, 0)
+    return b''.join([
+        PNG_SIGNATURE,
+        _png_chunk(b'IHDR', ihdr),
+        _png_chunk(b'IDAT', zlib.compress(raw, PNG_COMPRESS_LEVEL)),
+        _png_chunk(b'IEND', b''),
+    ])
+
+
+def encode_pnm(img: np.ndarray, fmt: str) -> bytes:
+    """
+    Encode uint8 image of shape (H, W) or (H, W, 3) as binary PGM or PPM.
+    """
+    height, width = img.shape[:2]
+    if fmt == 'ppm' and img.ndim == 2:
+        img = np.repeat(img[..., np.newaxis], 3, axis=2)
+    magic = b'P6' if img.ndim == 3 else b'P5'
+    header = b'%s\n%d %d\n255\n' % (magic, width, height)
+    return header + np.ascontiguousarray(img).tobytes()
+
+
+def _fast_encodable(img: np.ndarray, fmt: str,
+                    render_kwargs: dict) -> bool:
+    """
+    Whether ``img`` is plain uint8 gray/RGB(A) data that can be encoded
+    directly, without going through matplotlib's colormap.
+    """
+    if img.dtype != np.uint8:
+        return False
+    if img.ndim == 2:
+        if render_kwargs.get('cmap') != 'gray':
+            return False
+    elif img.ndim != 3 or img.shape[2] not in (3, 4):
+        return False
+    if fmt == 'pgm':
+        return img.ndim == 2
+    if fmt in ('ppm', 'pnm'):
+        return img.ndim == 2 or img.shape[2] == 3
+    return True
+
+
+def _pillow_format(fmt: str) -> typing.Optional[str]:
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image.registered_extensions().get('.' + fmt)
+
+
+def _pillow_encode(img: np.ndarray, fmt: str) -> typing.Optional[bytes]:
+    """
+    Encode ``img`` in ``fmt`` by Pillow, or return ``None`` if Pillow isn't
+    installed, doesn't know ``fmt``, or can't store the image mode in it,
+    e.g. RGBA in JPEG, which matplotlib flattens instead.
+    """
+    pillow_format = _pillow_format(fmt)
+    if pillow_format is None:
+        return None
+    from PIL import Image
+    with io.BytesIO() as cbuf:
+        try:
+            Image.fromarray(np.ascontiguousarray(img)).save(
+                cbuf, format=pillow_format)
+        except (KeyError, OSError):
+            return None
+        return cbuf.getvalue()
+
+
+def save_image(tofile, img: np.ndarray, render_kwargs: dict) -> None:
+    """
+    Save ``img`` to ``tofile``, either a filename or a binary file object.
+    Plain uint8 gray (with the gray cmap) and RGB(A) images are encoded by
+    the builtin PNG/PGM/PPM encoder, or by Pillow if it's installed for
+    other formats; otherwise matplotlib is imported to apply the cmap.
+    """
+    with stats.phase('write'):
+        _save_image(tofile, img, render_kwargs)
+    if isinstance(tofile, str):
+        stats.add_written_file(tofile)
+
+
+def _save_image(tofile, img: np.ndarray, render_kwargs: dict) -> None:
+    fmt = image_format(tofile, render_kwargs)
+    if _fast_encodable(img, fmt, render_kwargs):
+        if fmt == 'png':
+            encoded = encode_png(img)
+        elif fmt in ('pgm', 'ppm', 'pnm'):
+            encoded = encode_pnm(img, fmt)
+        else:
+            encoded = _pillow_encode(img, fmt)
+        if encoded is not None:
+            if isinstance(tofile, str):
+                with open(tofile, 'wb') as outfile:
+                    outfile.write(encoded)
+            else:
+                tofile.write(encoded)
+            return
+    vmin, vmax = norm_range(img.dtype)
+    _pyplot().imsave(tofile, img, vmin=vmin, vmax=vmax, **render_kwargs)
+
+
+def name_images(image_source, todir: str, is_npy: bool,
+                key: typing.Optional[str], template: typing.Optional[str],
+                overwrite: bool) \
+        -> typing.Iterator[typing.Tuple[typing.Tuple[int, ...],
+                                        np.ndarray, str]]:
+    """
+    Attach output filename to each image from ``image_source``.
+
+    :return: iterator of (image id, image, filename)
+    :raise FileExistsError: if a file exists and not ``overwrite``
+    :raise InvalidOutputTemplate: if ``template`` doesn't fit image ids
+    """
     naming_kwargs = {}
     if not is_npy:
         naming_kwargs['key'] = key
 
-    render_kwargs = {}
-    if output_format:
-        render_kwargs['format'] = output_format
-    if not ends_with_c and cmap:
-        render_kwargs['cmap'] = cmap
-
     for imgid, img in image_source:
         try:
             name = template.format(*imgid, **naming_kwargs)
@@ -314,11 +1169,259 @@ def write_images(image_source, todir: str, output_format: typing.Optional[str],
         filename = os.path.join(todir, name)
         if not overwrite and os.path.isfile(filename):
             raise FileExistsError(filename)
-        if issubclass(img.dtype.type, np.integer):
-            vmin, vmax = 0, 255
-        else:
-            vmin, vmax = 0.0, 1.0
-        plt.imsave(filename, img, vmin=vmin, vmax=vmax, **render_kwargs)
+        yield imgid, img, filename
+
+
+def make_render_kwargs(output_format: typing.Optional[str], cmap: str,
+                       ends_with_c: bool) -> dict:
+    render_kwargs = {}
+    if output_format:
+        render_kwargs['format'] = output_format
+    if not ends_with_c and cmap:
+        render_kwargs['cmap'] = cmap
+    return render_kwargs
+
+
+def write_images(image_source, todir: str, output_format: typing.Optional[str],
+                 cmap: str, ends_with_c: bool,
+                 is_npy: bool, key: typing.Optional[str],
+                 template: typing.Optional[str], overwrite: bool,
+                 written: typing.Optional[typing.Callable] = None) -> None:
+    """
+    :param written: if not ``None``, called with each filename once it has
+           been written
+    """
+    render_kwargs = make_render_kwargs(output_format, cmap, ends_with_c)
+    for _, img, filename in name_images(image_source, todir, is_npy, key,
+                                        template, overwrite):
+        save_image(filename, img, render_kwargs)
+        if written is not None:
+            written(filename)
+
+
+class RenderCache:
+    """
+    The sidecar cache of content hashes of the images written under a
+    directory, keyed by their filenames relative to the directory. Each
+    hash digests the source bytes of an image along with the rendering
+    options.
+    """
+    FILENAME = '.npyz2img-cache.json'
+
+    def __init__(self, todir: str, options: dict) -> None:
+        self.todir = todir
+        self.path = os.path.join(todir, self.FILENAME)
+        self.options = json.dumps(options, sort_keys=True).encode()
+        self.staged = {}
+        try:
+            with open(self.path) as infile:
+                self.hashes = json.load(infile)['hashes']
+        except FileNotFoundError:
+            self.hashes = {}
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            logging.warning('ignored corrupted cache "%s" due to %s',
+                            self.path, err)
+            self.hashes = {}
+
+    def _name(self, filename: str) -> str:
+        return os.path.relpath(filename, self.todir)
+
+    def digest(self, img: np.ndarray) -> str:
+        h = hashlib.blake2b(self.options, digest_size=16)
+        h.update(str((img.shape, img.dtype.str)).encode())
+        h.update(np.ascontiguousarray(img).reshape(-1).view(np.uint8))
+        return h.hexdigest()
+
+    def is_tracked(self, filename: str) -> bool:
+        return self._name(filename) in self.hashes
+
+    def is_fresh(self, filename: str, digest: str) -> bool:
+        return (self.hashes.get(self._name(filename)) == digest
+                and os.path.isfile(filename))
+
+    def stage(self, filename: str, digest: str) -> None:
+        """Record the digest ``filename`` will have once written."""
+        self.staged[self._name(filename)] = digest
+
+    def commit(self, filename: str) -> None:
+        """Mark ``filename`` as written with its staged digest."""
+        name = self._name(filename)
+        self.hashes[name] = self.staged.pop(name)
+
+    def save(self) -> None:
+        with npyzcore.atomic_open(self.path, 'w') as outfile:
+            json.dump({'version': 1, 'hashes': self.hashes}, outfile)
+
+
+def find_stale_images(data: np.ndarray, ends_with_c: bool, todir: str,
+                      is_npy: bool, key: typing.Optional[str],
+                      template: typing.Optional[str], overwrite: bool,
+                      cache: RenderCache) \
+        -> typing.Iterator[typing.Tuple[typing.Tuple[int, ...], str, str]]:
+    """
+    Yield the images of ``data`` that are not up to date under ``todir``
+    according to ``cache``.
+
+    :return: iterator of (image id, filename, digest)
+    :raise FileExistsError: if a file not tracked by ``cache`` exists and
+           not ``overwrite``
+    """
+    imgid_source = ((imgid, None) for imgid in image_ids(data, ends_with_c))
+    named = name_images(imgid_source, todir, is_npy, key, template, True)
+    for imgid, _, filename in named:
+        if (not overwrite and not cache.is_tracked(filename)
+                and os.path.isfile(filename)):
+            raise FileExistsError(filename)
+        digest = cache.digest(data[imgid])
+        if not cache.is_fresh(filename, digest):
+            yield imgid, filename, digest
+
+
+_worker_sources = {}
+
+
+def _worker_source(spec: dict) -> np.ndarray:
+    """
+    Get the canonical-shaped, memory-mapped source of images described by
+    ``spec`` in a worker process, opening NPYZFILE on first use.
+    """
+    source_id = spec['npyzfile'], spec['key']
+    try:
+        return _worker_sources[source_id]
+    except KeyError:
+        pass
+    data, _ = loaddata(spec['npyzfile'], spec['key'])
+    subdata, _ = check_shape(data[spec['index']], spec['channels'])
+    _worker_sources[source_id] = subdata
+    return subdata
+
+
+def _encode_image_job(job) -> npyzcore.Stats:
+    global stats
+    stats = npyzcore.Stats(stats.prog)
+    spec, imgid, filename, render_kwargs = job
+    img = np.asarray(_worker_source(spec)[imgid])
+    img = transform_images(img, *spec['bounds'], spec['cmap'], spec['size'],
+                           spec['ends_with_c'], spec['contrast'])
+    save_image(filename, img, render_kwargs)
+    return stats
+
+
+def write_images_parallel(image_source, todir: str,
+                          output_format: typing.Optional[str],
+                          cmap: str, ends_with_c: bool,
+                          is_npy: bool, key: typing.Optional[str],
+                          template: typing.Optional[str], overwrite: bool,
+                          spec: dict, jobs: int,
+                          written: typing.Optional[typing.Callable] = None,
+                          pool: typing.Optional[multiprocessing.pool.Pool]
+                          = None) -> None:
+    """
+    Same as ``write_images`` but encode images over a pool of ``jobs``
+    worker processes. Only image ids and filenames are sent to the workers,
+    which read the images themselves from the source described by
+    ``spec``, a dict of ``npyzfile``, ``key``, ``index``, ``channels``,
+    ``bounds`` (the clipping bounds), ``cmap`` (the cmap to apply via
+    ``apply_cmap`` if any), ``size`` (the size to shrink images to if any),
+    ``ends_with_c`` (whether the source has a `C' axis) and ``contrast``
+    (the auto-contrast percentiles if any). At most ``2 * jobs`` images
+    are in flight, so that the naming checks still abort early.
+    ``written`` is called as in ``write_images``. The ``Stats`` of the
+    workers are merged into ``stats``.
+
+    :param pool: the pool of ``jobs`` workers to use, e.g. one shared among
+           several keys, or ``None`` to make one
+    """
+    render_kwargs = make_render_kwargs(output_format, cmap, ends_with_c)
+    with contextlib.ExitStack() as stack:
+        if pool is None:
+            pool = stack.enter_context(multiprocessing.Pool(jobs))
+        pending = collections.deque()
+
+        def wait_next():
+            filename, result = pending.popleft()
+            stats.merge(result.get())
+            if written is not None:
+                written(filename)
+
+        try:
+            for imgid, _, filename in name_images(
+                    image_source, todir, is_npy, key, template, overwrite):
+                pending.append((filename, pool.apply_async(
+                    _encode_image_job,
+                    ((spec, imgid, filename, render_kwargs),))))
+                while len(pending) > 2 * jobs:
+                    wait_next()
+        finally:
+            for _, result in pending:
+                result.wait()
+        while pending:
+            wait_next()
+
+
+def _encode_tile_job(job) -> npyzcore.Stats:
+    global stats
+    stats = npyzcore.Stats(stats.prog)
+    filename, tile, render_kwargs = job
+    save_image(filename, tile, render_kwargs)
+    return stats
+
+
+def write_pyramid(img: np.ndarray, todir: str, name: str, tile_size: int,
+                  transform: typing.Optional[typing.Callable],
+                  output_format: typing.Optional[str], cmap: str,
+                  ends_with_c: bool, overwrite: bool, jobs: int) -> None:
+    """
+    Write ``img`` as a Deep Zoom tile pyramid, i.e. the descriptor
+    ``NAME.dzi`` and the tiles ``NAME_files/LEVEL/COLUMN_ROW.FORMAT`` under
+    ``todir``. Tiles are encoded over a pool of ``jobs`` worker processes
+    if ``jobs`` is greater than 1, with at most ``2 * jobs`` tiles in
+    flight.
+
+    :raise FileExistsError: if the descriptor exists and not ``overwrite``
+    """
+    fmt = (output_format or 'png').lower()
+    descriptor = os.path.join(todir, name + '.dzi')
+    if not overwrite and os.path.isfile(descriptor):
+        raise FileExistsError(descriptor)
+    tiledir = os.path.join(todir, name + '_files')
+    render_kwargs = make_render_kwargs(output_format, cmap, ends_with_c)
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    pending = collections.deque()
+    try:
+        with tempfile.TemporaryDirectory(prefix='.npyz2img-',
+                                         dir=todir) as workdir:
+            made_level = None
+            for level, col, row, tile in pyramid_tiles(img, tile_size,
+                                                       workdir, transform):
+                leveldir = os.path.join(tiledir, str(level))
+                if level != made_level:
+                    os.makedirs(leveldir, exist_ok=True)
+                    made_level = level
+                filename = os.path.join(leveldir,
+                                        '{}_{}.{}'.format(col, row, fmt))
+                if pool is None:
+                    save_image(filename, tile, render_kwargs)
+                    continue
+                pending.append(pool.apply_async(
+                    _encode_tile_job,
+                    ((filename, np.ascontiguousarray(tile), render_kwargs),)))
+                while len(pending) > 2 * jobs:
+                    stats.merge(pending.popleft().get())
+            while pending:
+                stats.merge(pending.popleft().get())
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    with open(descriptor, 'w') as outfile:
+        outfile.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+            'Format="{}" Overlap="0" TileSize="{}">\n'
+            '  <Size Width="{}" Height="{}"/>\n'
+            '</Image>\n'.format(fmt, tile_size, img.shape[1], img.shape[0]))
+    stats.add_written_file(descriptor)
 
 
 def write_image(image_source, tofile: str, output_format: typing.Optional[str],
@@ -335,7 +1438,11 @@ def write_image(image_source, tofile: str, output_format: typing.Optional[str],
             if not overwrite:
                 raise FileExistsError(tofile)
             logging.warning('overwriting existing file "%s"', tofile)
-        plt.imsave(tofile, img, **render_kwargs)
+        # TOFILE may be NPYZFILE itself, memory-mapped as the source
+        with npyzcore.atomic_open(tofile) as outfile:
+            save_image(outfile, img, dict(
+                render_kwargs, format=image_format(tofile, render_kwargs)))
+        stats.add_written_file(tofile)
 
 
 def write_image_stdout(image_source, output_format: typing.Optional[str],
@@ -348,7 +1455,8 @@ def write_image_stdout(image_source, output_format: typing.Optional[str],
     try:
         _, img = next(image_source)
         with io.BytesIO() as cbuf:
-            plt.imsave(cbuf, img, **render_kwargs)
+            save_image(cbuf, img, render_kwargs)
+            stats.add_written(cbuf.tell())
             cbuf.seek(0)
             shutil.copyfileobj(cbuf, sys.stdout.buffer)
     except StopIteration:
@@ -363,22 +1471,27 @@ def write_image_stdout(image_source, output_format: typing.Optional[str],
                         'first one to stdout')
 
 
-def main():
-    logging.basicConfig(format='%(filename)s: %(levelname)s: %(message)s')
-    args = make_parser().parse_args()
-
+def _template_keys(template: str) -> typing.Set[str]:
+    """The names of the keyword placeholders in ``template``."""
     try:
-        data, is_npy = loaddata(args.npyzfile, args.key)
-    except NilKeyError:
-        logging.error('KEY not specified')
-        return ERROR_ARGS
-    except KeyError as err:
-        logging.warning('KEY not found -- %s', str(err))
-        return 0
-    except OSError:
-        logging.error('failed to load "%s"', args.npyzfile)
-        return ERROR_READ
+        return {field for _, field, _, _ in string.Formatter().parse(template)
+                if field}
+    except ValueError:
+        return set()
+
 
+def render_data(args: argparse.Namespace, data: np.ndarray, is_npy: bool,
+                key: typing.Optional[str], name_key: str,
+                pool: typing.Optional[multiprocessing.pool.Pool] = None) \
+        -> int:
+    """
+    Render the images of ``data`` loaded from ``key`` of NPYZFILE as per
+    ``args``.
+
+    :param name_key: the key to fill in OUT_TEMPLATE
+    :param pool: the pool of workers shared among keys, if any
+    :return: the error code
+    """
     try:
         subdata = data[args.index]
     except IndexError:
@@ -394,15 +1507,15 @@ def main():
         return ERROR_DATA
 
     try:
-        subdata = clip_data(subdata, args.dtype, args.vmin, args.vmax)
+        bounds = clip_bounds(subdata.dtype, args.dtype, args.vmin, args.vmax)
     except UnexpectedDTypeError:
         logging.error('expecting dtype %s but got %s',
                       args.dtype, str(subdata.dtype))
         return ERROR_DATA
 
-    if not args.force:
+    if not args.force and args.auto_contrast is None:
         try:
-            ensure_normalized(subdata)
+            ensure_normalized(subdata, *bounds)
         except NotNormalizedError as err:
             if err.args[0] == np.integer:
                 logging.error('int image not within range [0,256)')
@@ -410,8 +1523,68 @@ def main():
                 logging.error('float image not within range [0.0,1.0]')
             return ERROR_DATA
 
-    image_source = render_images(subdata, ends_with_c)
-    if args.tofile is stdout:
+    lut_cmap = None
+    if needs_lut(subdata.dtype if args.auto_contrast is None
+                 else np.dtype(np.uint8), ends_with_c, args.cmap):
+        lut_cmap = args.cmap
+        try:
+            make_lut(lut_cmap)
+        except ValueError:
+            logging.error('unknown cmap "%s"', lut_cmap)
+            return ERROR_ARGS
+
+    frame_format = None
+    if args.tofile is not None:
+        frame_format = image_format(
+            'img.png' if args.tofile is stdout else args.tofile,
+            {'format': args.output_format} if args.output_format else {})
+        if frame_format not in FRAME_FORMATS:
+            frame_format = None
+
+    n_images = int(np.prod(subdata.shape[:-(3 if ends_with_c else 2)]))
+    image_shape = subdata.shape[-(3 if ends_with_c else 2):]
+    size = thumbnail_size(*image_shape[:2], args.scale, args.max_size)
+    transform = functools.partial(transform_images, vmin=bounds[0],
+                                  vmax=bounds[1], lut_cmap=lut_cmap,
+                                  size=size, ends_with_c=ends_with_c,
+                                  contrast=args.auto_contrast)
+    source_ends_with_c = ends_with_c
+    image_source = render_images(subdata, ends_with_c, transform,
+                                 0 if frame_format else CHUNK_SIZE)
+    imgid_source = ((imgid, None) for imgid in image_ids(subdata, ends_with_c))
+    if lut_cmap:
+        ends_with_c = True
+    if args.montage:
+        image_source = montage_sheets(image_source, *args.montage,
+                                      args.montage_padding,
+                                      args.montage_downscale)
+        n_images = -(-n_images // (args.montage[0] * args.montage[1]))
+    if frame_format and args.tofile is stdout:
+        try:
+            write_frames(image_source,
+                         stats.counting_writer(sys.stdout.buffer),
+                         frame_format, n_images, args.fps)
+        except (TypeError, ImportError) as err:
+            logging.error('failed to write %s frames due to %s',
+                          frame_format, err)
+            return ERROR_DATA
+    elif frame_format:
+        if os.path.isfile(args.tofile):
+            if not args.overwrite:
+                logging.warning('file "%s" already exists; aborted',
+                                args.tofile)
+                return 0
+            logging.warning('overwriting existing file "%s"', args.tofile)
+        try:
+            with npyzcore.atomic_open(args.tofile) as outfile:
+                write_frames(image_source, outfile, frame_format, n_images,
+                             args.fps)
+        except (TypeError, ImportError) as err:
+            logging.error('failed to write %s frames due to %s',
+                          frame_format, err)
+            return ERROR_DATA
+        stats.add_written_file(args.tofile)
+    elif args.tofile is stdout:
         write_image_stdout(image_source, args.output_format, args.cmap,
                            ends_with_c)
     elif args.tofile is not None:
@@ -421,14 +1594,90 @@ def main():
         except FileExistsError as err:
             logging.warning('file "%s" already exists; aborted', err.args[0])
             return 0
+    elif args.pyramid:
+        if not os.path.isdir(args.todir):
+            logging.error('todir "%s" not found', args.todir)
+            return ERROR_ARGS
+        if (args.montage or args.incremental or args.scale is not None
+                or args.max_size is not None
+                or args.auto_contrast is not None):
+            logging.error('`--pyramid\' cannot be used with `--montage\', '
+                          '`--incremental\', `--scale\', `--max-size\' or '
+                          '`--auto-contrast\'')
+            return ERROR_ARGS
+        if args.tile_size % 2:
+            logging.error('tile size must be even but got %d', args.tile_size)
+            return ERROR_ARGS
+        if n_images != 1:
+            logging.error('`--pyramid\' renders exactly one image but got %d',
+                          n_images)
+            return ERROR_DATA
+        img = subdata[next(image_ids(subdata, source_ends_with_c))]
+        try:
+            write_pyramid(img, args.todir, args.pyramid, args.tile_size,
+                          transform, args.output_format, args.cmap,
+                          ends_with_c, args.overwrite, args.jobs)
+        except FileExistsError as err:
+            logging.warning('file "%s" already exists; aborted', err.args[0])
+            return 0
+        except TypeError as err:
+            logging.error('TypeError: %s', err)
+            return ERROR_DATA
     else:
         if not os.path.isdir(args.todir):
             logging.error('todir "%s" not found', args.todir)
             return ERROR_ARGS
+        if args.incremental and args.montage:
+            logging.error('`--incremental\' cannot be used with '
+                          '`--montage\'')
+            return ERROR_ARGS
+        cache = None
+        written = None
+        overwrite = args.overwrite
         try:
-            write_images(image_source, args.todir, args.output_format,
-                         args.cmap, ends_with_c, is_npy, args.key or '',
-                         args.out_template, args.overwrite)
+            if args.incremental:
+                cache = RenderCache(args.todir, {
+                    'bounds': [str(b) for b in bounds],
+                    'channels': args.channels,
+                    'cmap': args.cmap,
+                    'format': args.output_format,
+                    'size': size,
+                    'contrast': args.auto_contrast,
+                })
+                stale = list(find_stale_images(
+                    subdata, source_ends_with_c, args.todir, is_npy,
+                    name_key, args.out_template, args.overwrite, cache))
+                logging.info('%d of %d images to render', len(stale),
+                             n_images)
+                for _, filename, digest in stale:
+                    cache.stage(filename, digest)
+                stale_ids = [imgid for imgid, _, _ in stale]
+                image_source = render_images(subdata, source_ends_with_c,
+                                             transform, imgids=stale_ids)
+                imgid_source = ((imgid, None) for imgid in stale_ids)
+                written = cache.commit
+                overwrite = True
+            if args.jobs > 1 and not args.montage:
+                spec = {
+                    'npyzfile': args.npyzfile,
+                    'key': key,
+                    'index': args.index,
+                    'channels': args.channels,
+                    'bounds': bounds,
+                    'cmap': lut_cmap,
+                    'size': size,
+                    'ends_with_c': source_ends_with_c,
+                    'contrast': args.auto_contrast,
+                }
+                write_images_parallel(imgid_source, args.todir,
+                                      args.output_format, args.cmap,
+                                      ends_with_c, is_npy, name_key,
+                                      args.out_template, overwrite,
+                                      spec, args.jobs, written, pool)
+            else:
+                write_images(image_source, args.todir, args.output_format,
+                             args.cmap, ends_with_c, is_npy, name_key,
+                             args.out_template, overwrite, written)
         except FileExistsError as err:
             logging.warning('file "%s" already exists; aborted', err.args[0])
             return 0
@@ -441,9 +1690,64 @@ def main():
         except TypeError as err:
             logging.error('TypeError: %s', err)
             return ERROR_DATA
+        if cache is not None:
+            cache.save()
 
     return 0
 
 
+def main():
+    logging.basicConfig(format='%(filename)s: %(levelname)s: %(message)s')
+    args = make_parser().parse_args(
+        npyzcore.expand_stats_option(sys.argv[1:]))
+    stats.enable(args.stats)
+
+    with contextlib.ExitStack() as stack:
+        try:
+            with stats.phase('read'):
+                is_npy, keys, load = stack.enter_context(
+                    open_npyz(args.npyzfile, args.key, args.all_keys))
+        except NilKeyError:
+            logging.error('KEY not specified')
+            return ERROR_ARGS
+        except KeyError as err:
+            logging.warning('KEY not found -- %s', str(err))
+            return 0
+        except (OSError, ValueError, zipfile.BadZipFile):
+            logging.error('failed to load "%s"', args.npyzfile)
+            return ERROR_READ
+        stats.add_read_file(args.npyzfile)
+
+        if len(keys) > 1:
+            if args.tofile is not None or args.pyramid:
+                logging.error('several keys can only be rendered to TODIR')
+                return ERROR_ARGS
+            if (args.out_template is not None
+                    and 'key' not in _template_keys(args.out_template)):
+                logging.error('output template "%s" must contain the `key\' '
+                              'placeholder to render several keys',
+                              args.out_template)
+                return ERROR_ARGS
+
+        pool = None
+        if (len(keys) > 1 and args.jobs > 1 and not args.montage
+                and args.tofile is None and not args.pyramid):
+            pool = stack.enter_context(multiprocessing.Pool(args.jobs))
+        errno = 0
+        for key in keys:
+            name_key = key if args.key or args.all_keys else ''
+            with stats.phase('read'):
+                data = load(key)
+            # the images are written as they're rendered, so the time spent
+            # writing them is put in the nested `write' phase
+            with stats.phase('render'):
+                errno |= render_data(args, data, is_npy, key, name_key, pool)
+        return errno
+
+
 if __name__ == '__main__':
-    sys.exit(main())
+    try:
+        sys.exit(main())
+    except SystemExit as err:
+        stats.dump(err.code)
+        raise
@@ -0,0 +1,128 @@
+"""
+Thin client of ``npyzserver``, run by the launch scripts as::
+
+    python3 npyzclient.py /path/to/src/COMMAND.py ARGS...
+
+It forwards argv, cwd, environment and the stdin/stdout/stderr file
+descriptors of this process to the server, which runs COMMAND in a process
+forked from the one where numpy and friends have already been imported,
+and exits with the exit code of COMMAND. If the server is not running, or
+refuses the request, COMMAND is run by this process as if invoked directly.
+
+This module imports nothing heavy, since its startup time is paid on every
+call. It is not a command; the launch scripts run it from the directory the
+commands live in.
+"""
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+
+REQUEST_LENGTH = struct.Struct('<I')
+REPLY = struct.Struct('<i')
+FORWARDED_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP,
+                     signal.SIGQUIT)
+
+
+def default_socket_path():
+    """
+    The socket path from environment variable ``NPYZ_SOCKET``, default to
+    ``npyzutils-<uid>.sock`` under ``$XDG_RUNTIME_DIR`` or ``/tmp``. Keep in
+    sync with the launch scripts written by ``make-launch-scripts``.
+    """
+    path = os.environ.get('NPYZ_SOCKET')
+    if path:
+        return path
+    return os.path.join(
+        os.environ.get('XDG_RUNTIME_DIR') or '/tmp',
+        'npyzutils-{}.sock'.format(os.getuid()))
+
+
+def encode_request(request):
+    data = json.dumps(request).encode('utf-8')
+    return REQUEST_LENGTH.pack(len(data)) + data
+
+
+def recv_exactly(sock, n):
+    """
+    Receive exactly ``n`` bytes from ``sock``.
+
+    :raise EOFError: if the peer closes the connection before that
+    """
+    buf = bytearray()
+    while len(buf) < n:
+        data = sock.recv(n - len(buf))
+        if not data:
+            raise EOFError
+        buf += data
+    return bytes(buf)
+
+
+def run_in_process(script, args):
+    """Replace this process by running ``script`` directly."""
+    sys.stdout.flush()
+    os.execv(sys.executable, [sys.executable, script] + args)
+
+
+def run_on_server(sock, script, args):
+    """
+    Run ``script`` on the server connected as ``sock``.
+
+    :return: the exit code of ``script``, or ``None`` if the server refuses
+             or fails to start it
+    :raise EOFError: if the connection is lost once ``script`` has started
+    """
+    prog = os.path.splitext(os.path.basename(script))[0]
+    try:
+        request = {
+            'prog': prog,
+            'argv': args,
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        }
+        socket.send_fds(sock, [encode_request(request)], [0, 1, 2])
+        pid, = REPLY.unpack(recv_exactly(sock, REPLY.size))
+    except (OSError, EOFError):
+        return None
+    if pid <= 0:
+        return None
+
+    def forward(signum, _frame):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    for signum in FORWARDED_SIGNALS:
+        signal.signal(signum, forward)
+    code, = REPLY.unpack(recv_exactly(sock, REPLY.size))
+    return code
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.stderr.write('usage: npyzclient.py SCRIPT [ARG ...]\n')
+        sys.exit(1)
+    script, args = sys.argv[1], sys.argv[2:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(default_socket_path())
+    except OSError:
+        sock.close()
+        run_in_process(script, args)
+    with sock:
+        try:
+            code = run_on_server(sock, script, args)
+        except (OSError, EOFError):
+            sys.stderr.write('npyzclient.py: lost connection to npyzserver '
+                             'while running "{}"\n'.format(script))
+            sys.exit(1)
+    if code is None:
+        run_in_process(script, args)
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,730 @@
+"""
+Streaming npy/npz I/O shared by the npyzutils commands.
+
+The npy reader and writer are header-aware: headers are parsed and written
+on their own, and payloads are read and written in chunks, either via
+memory maps or via ``os.pread``, so that no command has to hold a whole
+array in memory only to copy it. The npz reader exposes where the payload
+of each member stored without compression lives in the archive.
+
+This module is not a command; the commands import it from the directory
+they live in.
+"""
+import ast
+import collections
+import contextlib
+import importlib.util
+import io
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import zipfile
+
+
+def lazy_import(name):
+    """
+    Import module ``name`` on first attribute access, so that ``--help``,
+    argument errors and header-only paths don't pay for importing it.
+    """
+    try:
+        return sys.modules[name]
+    except KeyError:
+        pass
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError('No module named {!r}'.format(name),
+                                  name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+np = lazy_import('numpy')
+json = lazy_import('json')
+mmap = lazy_import('mmap')
+resource = lazy_import('resource')
+
+DEFAULT_CHUNK_SIZE = 1 << 24
+
+NPY_MAGIC = b'\x93NUMPY'
+
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+class NotNpyFileError(Exception):
+    pass
+
+
+class NpyHeader(collections.namedtuple(
+        'NpyHeader', ['shape', 'fortran_order', 'descr', 'offset'])):
+    """
+    The header of an npy array, where ``offset`` is the position of the
+    payload relative to the start of the npy data. The ``dtype`` is parsed
+    from ``descr`` on access, so that reading only the shape doesn't import
+    numpy.
+    """
+    __slots__ = ()
+
+    @property
+    def dtype(self):
+        return np.lib.format.descr_to_dtype(self.descr)
+
+
+NpzMember = collections.namedtuple('NpzMember', ['key', 'info', 'header'])
+NpzMember.__doc__ = """\
+A member of an npz archive. ``header`` is the ``NpyHeader`` of the member
+with ``offset`` relative to the start of the archive if the member is
+stored without compression, and ``None`` otherwise."""
+
+
+def read_npy_header(fp):
+    """
+    Read the npy header from ``fp``, which need not be seekable, leaving
+    ``fp`` at the start of the payload.
+
+    :return: the ``NpyHeader``
+    :raise NotNpyFileError: if ``fp`` doesn't start with the npy magic
+    :raise ValueError: if the header is truncated or malformed
+    """
+    if fp.read(len(NPY_MAGIC)) != NPY_MAGIC:
+        raise NotNpyFileError
+    version = fp.read(2)
+    if len(version) < 2:
+        raise ValueError('truncated npy header')
+    len_size = 2 if version[0] == 1 else 4
+    header_len = fp.read(len_size)
+    if len(header_len) < len_size:
+        raise ValueError('truncated npy header')
+    header_len = int.from_bytes(header_len, byteorder='little')
+    header = fp.read(header_len)
+    if len(header) < header_len:
+        raise ValueError('truncated npy header')
+    header = header.decode('latin1' if version[0] in (1, 2) else 'utf-8')
+    try:
+        d = ast.literal_eval(header)
+        shape = tuple(d['shape'])
+        fortran_order = bool(d['fortran_order'])
+        descr = d['descr']
+    except (SyntaxError, ValueError, TypeError, KeyError) as err:
+        raise ValueError('malformed npy header: {}'.format(err)) from err
+    if (not all(isinstance(x, int) and x >= 0 for x in shape)
+            or not isinstance(descr, (str, list))):
+        raise ValueError('malformed npy header: {!r}'.format(d))
+    offset = len(NPY_MAGIC) + 2 + len_size + header_len
+    return NpyHeader(shape, fortran_order, descr, offset)
+
+
+def write_npy_header(fp, shape, dtype, fortran_order=False):
+    """Write the npy header of an array, in version 1.0 if it fits."""
+    header = {
+        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order': fortran_order,
+        'shape': tuple(shape),
+    }
+    try:
+        np.lib.format.write_array_header_1_0(fp, header)
+    except ValueError:
+        np.lib.format.write_array_header_2_0(fp, header)
+
+
+def npy_header_bytes(shape, dtype, fortran_order=False):
+    with io.BytesIO() as cbuf:
+        write_npy_header(cbuf, shape, dtype, fortran_order)
+        return cbuf.getvalue()
+
+
+def iter_blocks(arr, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield consecutive sub-arrays of ``arr`` in C order, each of about
+    ``chunk_size`` bytes unless a single element is larger.
+    """
+    if arr.ndim == 0 or arr.nbytes <= chunk_size:
+        yield arr
+        return
+    row_nbytes = arr.nbytes // arr.shape[0]
+    if row_nbytes > chunk_size:
+        for row in arr:
+            yield from iter_blocks(row, chunk_size)
+    else:
+        step = chunk_size // row_nbytes
+        for start in range(0, arr.shape[0], step):
+            yield arr[start:start + step]
+
+
+def iter_row_ranges(n_rows, row_nbytes, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield (start, stop) of consecutive ranges of ``n_rows`` rows, each of
+    about ``chunk_size`` bytes but at least one row.
+    """
+    step = max(1, chunk_size // max(1, row_nbytes))
+    for start in range(0, n_rows, step):
+        yield start, min(start + step, n_rows)
+
+
+def memmap_payload(filename, header, offset=0):
+    """
+    Memory-map the payload described by ``header`` read-only, where the npy
+    data start at ``offset`` of ``filename``.
+
+    :return: the memory-mapped array, or ``None`` if it can't be mapped,
+             i.e. if it's empty or of object dtype
+    """
+    dtype = header.dtype
+    if dtype.hasobject or not np.prod(header.shape, dtype=np.int64):
+        return None
+    return np.memmap(filename, dtype=dtype, mode='r',
+                     offset=offset + header.offset, shape=header.shape,
+                     order='F' if header.fortran_order else 'C')
+
+
+def prefetch(arr, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read the payload of ``arr`` into the page cache if it's memory-mapped,
+    so that touching it later doesn't wait on disk. The pages are touched
+    chunk by chunk, as ``MADV_WILLNEED`` alone reads ahead only so far.
+    """
+    mapped = getattr(arr, '_mmap', None)
+    if mapped is None:
+        return
+    with contextlib.suppress(AttributeError, OSError, ValueError):
+        mapped.madvise(mmap.MADV_WILLNEED)
+    raw = np.frombuffer(mapped, dtype=np.uint8)
+    try:
+        for start in range(0, raw.size, chunk_size):
+            raw[start:start + chunk_size:mmap.PAGESIZE].max()
+    finally:
+        del raw
+
+
+def iter_pread_chunks(fd, header, offset=0, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read the C-ordered payload described by ``header`` from file descriptor
+    ``fd``, where the npy data start at ``offset``, via ``os.pread`` in
+    chunks of whole rows of about ``chunk_size`` bytes, without touching
+    the file position.
+
+    :return: iterator of arrays of consecutive rows
+    :raise ValueError: if the payload is of object dtype or Fortran order
+    :raise EOFError: if the payload is truncated
+    """
+    dtype = header.dtype
+    if dtype.hasobject or header.fortran_order:
+        raise ValueError('cannot pread object or Fortran-ordered payload')
+    shape = header.shape or (1,)
+    row_shape = shape[1:]
+    row_nbytes = dtype.itemsize * int(np.prod(row_shape, dtype=np.int64))
+    base = offset + header.offset
+    for start, stop in iter_row_ranges(shape[0], row_nbytes, chunk_size):
+        nbytes = (stop - start) * row_nbytes
+        pos = base + start * row_nbytes
+        buf = bytearray()
+        while len(buf) < nbytes:
+            data = os.pread(fd, nbytes - len(buf), pos + len(buf))
+            if not data:
+                raise EOFError('truncated npy payload')
+            buf += data
+        chunk = np.frombuffer(buf, dtype=dtype)
+        yield chunk.reshape((stop - start,) + row_shape)
+
+
+def open_npy(filename, backend='mmap', chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Open the npy file ``filename`` for chunked reading.
+
+    :param backend: ``'mmap'`` to memory-map the payload, or ``'pread'`` to
+           read it with ``os.pread``, e.g. from network file systems where
+           memory maps perform poorly
+    :return: (the ``NpyHeader``, iterator of arrays of consecutive rows of
+             about ``chunk_size`` bytes)
+    :raise NotNpyFileError: if ``filename`` is not an npy file
+    """
+    with open(filename, 'rb') as infile:
+        header = read_npy_header(infile)
+    if backend == 'pread' and not header.fortran_order \
+            and not header.dtype.hasobject:
+        return header, _iter_pread_file(filename, header, chunk_size)
+    arr = memmap_payload(filename, header)
+    if arr is None:
+        arr = np.load(filename, allow_pickle=False)
+    return header, iter_blocks(arr.reshape(arr.shape or (1,)), chunk_size)
+
+
+def _iter_pread_file(filename, header, chunk_size):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        yield from iter_pread_chunks(fd, header, 0, chunk_size)
+    finally:
+        os.close(fd)
+
+
+def load_npy(filename, use_mmap=True):
+    """
+    Load the npy file ``filename``, memory-mapped read-only if
+    ``use_mmap`` and possible.
+
+    :raise NotNpyFileError: if ``filename`` is not an npy file
+    """
+    with open(filename, 'rb') as infile:
+        header = read_npy_header(infile)
+    if use_mmap:
+        arr = memmap_payload(filename, header)
+        if arr is not None:
+            return arr
+    return np.load(filename, allow_pickle=False)
+
+
+def read_npy(fp):
+    """
+    Read an npy array from ``fp``, which need not be seekable, e.g. a
+    member of a zip file or buffered stdin.
+
+    :raise NotNpyFileError: if ``fp`` doesn't start with the npy magic
+    :raise ValueError: if the data are truncated or malformed, or if the
+           array is of object dtype
+    """
+    header = read_npy_header(fp)
+    dtype = header.dtype
+    if dtype.hasobject:
+        raise ValueError('object arrays cannot be loaded without pickle')
+    nbytes = dtype.itemsize * int(np.prod(header.shape, dtype=np.int64))
+    buf = bytearray(nbytes)
+    view = memoryview(buf)
+    pos = 0
+    while pos < nbytes:
+        n = fp.readinto(view[pos:])
+        if not n:
+            raise ValueError('truncated npy payload')
+        pos += n
+    arr = np.frombuffer(buf, dtype=dtype)
+    return arr.reshape(header.shape,
+                       order='F' if header.fortran_order else 'C')
+
+
+def npz_member_header(infile, info):
+    """
+    Locate the payload of npz member ``info`` stored without compression.
+
+    :param infile: the npz file opened in binary mode
+    :param info: the ``zipfile.ZipInfo`` of the member
+    :return: the ``NpyHeader`` of the member with ``offset`` relative to
+             the start of ``infile``, or ``None`` if the member is
+             compressed or not an npy array
+    """
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    infile.seek(info.header_offset)
+    local_header = infile.read(ZIP_LOCAL_HEADER_SIZE)
+    if (len(local_header) < ZIP_LOCAL_HEADER_SIZE
+            or local_header[:4] != b'PK\x03\x04'):
+        return None
+    name_len = int.from_bytes(local_header[26:28], byteorder='little')
+    extra_len = int.from_bytes(local_header[28:30], byteorder='little')
+    start = info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_len + extra_len
+    infile.seek(start)
+    try:
+        header = read_npy_header(infile)
+    except (NotNpyFileError, ValueError):
+        return None
+    return header._replace(offset=start + header.offset)
+
+
+def npz_member_key(info):
+    key = info.filename
+    if key.endswith('.npy'):
+        key = key[:-4]
+    return key
+
+
+def npz_members(infile):
+    """
+    List the members of the npz file opened as ``infile``.
+
+    :return: list of ``NpzMember``
+    :raise zipfile.BadZipFile: if ``infile`` is not a zip file
+    """
+    with zipfile.ZipFile(infile) as zf:
+        infos = zf.infolist()
+    return [NpzMember(npz_member_key(info), info,
+                      npz_member_header(infile, info)) for info in infos]
+
+
+def npz_member_memmap(infile, info):
+    """
+    Memory-map the array of an npz member stored without compression.
+
+    :param infile: the npz file opened in binary mode
+    :param info: the ``zipfile.ZipInfo`` of the member
+    :return: the memory-mapped array, or ``None`` if it can't be mapped
+    """
+    header = npz_member_header(infile, info)
+    if header is None:
+        return None
+    dtype = header.dtype
+    if dtype.hasobject or not np.prod(header.shape, dtype=np.int64):
+        return None
+    return np.memmap(infile, dtype=dtype, mode='r',
+                     offset=header.offset, shape=header.shape,
+                     order='F' if header.fortran_order else 'C')
+
+
+def read_npz(infile, keys=None, use_mmap=False):
+    """
+    Read the members ``keys`` (default to all) of the npz file opened as
+    ``infile`` into a dict, memory-mapping those stored without compression
+    if ``use_mmap``, and reading the others into memory.
+
+    :raise KeyError: if any of ``keys`` is not found
+    :raise zipfile.BadZipFile: if ``infile`` is not a zip file
+    :raise NotNpyFileError: if any member is not an npy array
+    :raise ValueError: if any member is truncated or malformed
+    """
+    arrays = {}
+    with zipfile.ZipFile(infile) as zf:
+        infos = {npz_member_key(info): info for info in zf.infolist()}
+        for key in (infos if keys is None else keys):
+            info = infos[key]
+            arr = npz_member_memmap(infile, info) if use_mmap else None
+            if arr is None:
+                with zf.open(info) as member:
+                    arr = read_npy(member)
+            arrays[key] = arr
+    return arrays
+
+
+def load_npz(filename, keys=None, use_mmap=True):
+    """The ``read_npz`` of the npz file ``filename``."""
+    with open(filename, 'rb') as infile:
+        return read_npz(infile, keys, use_mmap)
+
+
+def packed_dtype(dtype):
+    """Drop the padding and the unselected fields from a structured dtype."""
+    if dtype.names is None:
+        return dtype
+    return np.dtype([(name, dtype.fields[name][0]) for name in dtype.names])
+
+
+def packed_bytes(arr, dtype):
+    """
+    Return the bytes of ``arr`` laid out in C order as ``dtype``, the
+    ``packed_dtype`` of ``arr``, as a zero-copy view if possible.
+    """
+    if arr.dtype == dtype:
+        packed = np.ascontiguousarray(arr)
+    else:
+        packed = np.empty(arr.shape, dtype=dtype)
+        packed[...] = arr
+    return packed.reshape(-1).view(np.uint8)
+
+
+def write_npy(fp, arr, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Write ``arr`` to ``fp`` in npy format block by block, so that strided
+    views of memory-mapped data are never copied at whole. Structured
+    records are written packed.
+    """
+    arr = np.asanyarray(arr)
+    if arr.dtype.hasobject:
+        np.lib.format.write_array(fp, arr)
+        return
+    dtype = packed_dtype(arr.dtype)
+    write_npy_header(fp, arr.shape, dtype)
+    for block in iter_blocks(arr, chunk_size):
+        fp.write(packed_bytes(block, dtype))
+
+
+def write_npz(fp, data, chunk_size=DEFAULT_CHUNK_SIZE, write_member=None):
+    """
+    Write dict ``data`` to ``fp`` in (uncompressed) npz format. ``fp`` need
+    not be seekable.
+
+    :param write_member: callable ``(member_fp, arr)`` to write the npy
+           bytes of each member in place of ``write_npy``
+    """
+    with zipfile.ZipFile(fp, 'w', allowZip64=True) as zf:
+        for key, arr in data.items():
+            with zf.open(key + '.npy', 'w', force_zip64=True) as member:
+                if write_member is None:
+                    write_npy(member, arr, chunk_size)
+                else:
+                    write_member(member, arr)
+
+
+@contextlib.contextmanager
+def atomic_path(filename):
+    """
+    Yield the name of a new temporary file in the directory of
+    ``filename`` to be written in its place, possibly by other processes.
+    Once done, the temporary file is synced to disk and replaces
+    ``filename`` atomically; on error it's removed, leaving ``filename``
+    intact.
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(
+        prefix='.{}.'.format(basename), suffix='.tmp', dir=dirname)
+    try:
+        try:
+            yield tmpname
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        try:
+            perm = stat.S_IMODE(os.stat(filename).st_mode)
+        except FileNotFoundError:
+            perm = 0o666 & ~current_umask()
+        os.chmod(tmpname, perm)
+        os.replace(tmpname, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmpname)
+        raise
+    with contextlib.suppress(OSError):
+        dirfd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+
+@contextlib.contextmanager
+def atomic_open(filename, mode='wb'):
+    """
+    Open a temporary file in the directory of ``filename`` for writing in
+    ``mode``, which replaces ``filename`` as in ``atomic_path`` once
+    written. This way ``filename`` may also be an input memory-mapped by
+    the writer.
+    """
+    with atomic_path(filename) as tmpname, open(tmpname, mode) as outfile:
+        yield outfile
+
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def read_stdin():
+    """
+    Buffer all of stdin, which is not seekable, into memory.
+
+    :return: the seekable ``io.BytesIO`` positioned at the start
+    """
+    cbuf = io.BytesIO()
+    shutil.copyfileobj(sys.stdin.buffer, cbuf)
+    cbuf.seek(0)
+    return cbuf
+
+
+def read_filenames(from_file):
+    """
+    Read filenames, one per line, from file ``from_file``, or from stdin if
+    it's ``'-'``.
+
+    :raise OSError: if ``from_file`` cannot be read
+    """
+    if from_file == '-':
+        return [x.rstrip('\n') for x in sys.stdin]
+    with open(from_file) as infile:
+        return [x.rstrip('\n') for x in infile]
+
+
+def add_stats_argument(parser):
+    """Add the ``--stats[=FILE]`` option read by ``Stats.enable``."""
+    parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='-',
+        metavar='FILE',
+        help=('on exit, write the wall and CPU time of each phase, the '
+              'number and size of the input and output files, and the '
+              'peak RSS as one JSON object to FILE, or to stderr if FILE '
+              'is omitted. FILE must be attached as `--stats=FILE\''))
+
+
+def expand_stats_option(argv):
+    """
+    Rewrite the bare ``--stats`` in ``argv`` as ``--stats=-``, so that it
+    never takes the argument following it as FILE.
+    """
+    argv = list(argv)
+    for i, arg in enumerate(argv):
+        if arg == '--':
+            break
+        if arg == '--stats':
+            argv[i] = '--stats=-'
+    return argv
+
+
+def _times():
+    """:return: (wall time, CPU time of self and reaped children)"""
+    t = os.times()
+    return time.perf_counter(), t.user + t.system + t.children_user \
+        + t.children_system
+
+
+class Stats:
+    """
+    Resource usage of a run of a command, written on exit as one JSON
+    object if enabled by ``--stats``. The CPU time of worker processes is
+    counted once they've been joined. Note that the payloads memory-mapped
+    in the ``read`` phase are mostly read from disk in the phases after it,
+    when first touched.
+    """
+
+    def __init__(self, prog):
+        self.prog = prog
+        self.filename = None
+        self.phases = collections.OrderedDict()
+        self.files_read = 0
+        self.bytes_read = 0
+        self.files_written = 0
+        self.bytes_written = 0
+        self._start = _times()
+        self._nested = []
+
+    @property
+    def enabled(self):
+        return self.filename is not None
+
+    def enable(self, filename):
+        """Write the stats to ``filename`` on ``dump``; ``'-'`` for stderr."""
+        self.filename = filename
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Add the time spent in the ``with`` block to phase ``name``, less
+        that spent in the phases nested in it.
+        """
+        start_wall, start_cpu = _times()
+        self._nested.append([0.0, 0.0])
+        try:
+            yield
+        finally:
+            end_wall, end_cpu = _times()
+            wall, cpu = end_wall - start_wall, end_cpu - start_cpu
+            nested_wall, nested_cpu = self._nested.pop()
+            times = self.phases.setdefault(name,
+                                           {'wall_s': 0.0, 'cpu_s': 0.0})
+            times['wall_s'] += wall - nested_wall
+            times['cpu_s'] += cpu - nested_cpu
+            if self._nested:
+                self._nested[-1][0] += wall
+                self._nested[-1][1] += cpu
+
+    def merge(self, other):
+        """Add the phase times and counts of ``other``, e.g. of a worker."""
+        for name, times in other.phases.items():
+            merged = self.phases.setdefault(name,
+                                            {'wall_s': 0.0, 'cpu_s': 0.0})
+            merged['wall_s'] += times['wall_s']
+            merged['cpu_s'] += times['cpu_s']
+        self.files_read += other.files_read
+        self.bytes_read += other.bytes_read
+        self.files_written += other.files_written
+        self.bytes_written += other.bytes_written
+
+    def add_read(self, nbytes):
+        self.files_read += 1
+        self.bytes_read += nbytes
+
+    def add_read_file(self, filename):
+        with contextlib.suppress(OSError):
+            self.add_read(os.path.getsize(filename))
+
+    def add_written(self, nbytes):
+        self.files_written += 1
+        self.bytes_written += nbytes
+
+    def add_written_file(self, filename):
+        with contextlib.suppress(OSError):
+            self.add_written(os.path.getsize(filename))
+
+    def counting_writer(self, fp):
+        """
+        Return a writer to ``fp`` counting the bytes written through it
+        towards ``bytes_written``, or ``fp`` itself if not enabled.
+        """
+        if not self.enabled:
+            return fp
+        self.files_written += 1
+        return _CountingWriter(fp, self)
+
+    def report(self, exit_code):
+        wall, cpu = _times()
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return collections.OrderedDict([
+            ('prog', self.prog),
+            ('argv', sys.argv[1:]),
+            ('exit_code', exit_code),
+            ('wall_s', wall - self._start[0]),
+            ('cpu_s', cpu - self._start[1]),
+            ('phases', self.phases),
+            ('files_read', self.files_read),
+            ('bytes_read', self.bytes_read),
+            ('files_written', self.files_written),
+            ('bytes_written', self.bytes_written),
+            ('max_rss_bytes', scale * resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss),
+            ('max_rss_children_bytes', scale * resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss),
+        ])
+
+    def dump(self, exit_code):
+        """Write the stats if enabled; ``exit_code`` is that of the run."""
+        if not self.enabled:
+            return
+        text = json.dumps(self.report(exit_code)) + '\n'
+        if self.filename == '-':
+            # sys.stderr is closed by the commands on broken pipe, but its
+            # file descriptor is left open
+            with contextlib.suppress(OSError, ValueError):
+                sys.stderr.flush()
+            with contextlib.suppress(OSError):
+                os.write(2, text.encode('utf-8'))
+            return
+        try:
+            with open(self.filename, 'w') as outfile:
+                outfile.write(text)
+        except OSError as err:
+            logging.warning('failed to write stats to "%s" due to %s',
+                            self.filename, err)
+
+
+class _CountingWriter:
+    """
+    Count the bytes written to ``fp``, but not those written again after
+    seeking back, as ``zipfile`` does to seekable files.
+    """
+
+    def __init__(self, fp, stats):
+        self._fp = fp
+        self._stats = stats
+        try:
+            self._pos = fp.tell()
+        except OSError:
+            self._pos = 0
+        self._end = self._pos
+
+    def write(self, data):
+        n = self._fp.write(data)
+        self._pos += n
+        if self._pos > self._end:
+            self._stats.bytes_written += self._pos - self._end
+            self._end = self._pos
+        return n
+
+    def seek(self, *args):
+        self._pos = self._fp.seek(*args)
+        return self._pos
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
@@ -1,14 +1,24 @@
 #!/usr/bin/env python3
-import pdb
 import argparse
-import shutil
 import sys
-import io
+import re
+import ast
+import operator
+import zipfile
 import logging
+import collections
+import itertools
 
-import numpy as np
 from sliceparser import parse_slice
 
+import flo2npy
+import npyzcore
+from npyzcore import DEFAULT_CHUNK_SIZE
+
+np = npyzcore.lazy_import('numpy')
+multiprocessing = npyzcore.lazy_import('multiprocessing')
+futures = npyzcore.lazy_import('concurrent.futures')
+
 ERRNO_ARGS = 1
 ERRNO_READ = 2
 ERRNO_DATA = 4
@@ -17,8 +27,19 @@ ERRNO_INT = 130
 
 errno = 0
 
+stats = npyzcore.Stats('npyzindex')
+
 LOGGING_LEVEL = logging.WARNING
 
+WHERE_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
 
 class ArgumentParser(argparse.ArgumentParser):
     def error(self, message):
@@ -30,8 +51,11 @@ class ArgumentParser(argparse.ArgumentParser):
 def make_parser():
     parser = ArgumentParser(
         prog='npyzindex',
-        description='Index subarray from npy/npz files.')
-    parser.add_argument(
+        description=('Index subarray from npy/npz files, or from .flo '
+                     'optical flow files read as npy arrays of shape '
+                     '`(H, W, 2)\'.'))
+    selectopts = parser.add_mutually_exclusive_group()
+    selectopts.add_argument(
         '-e',
         '--index-expr',
         dest='indexexprs',
@@ -50,7 +74,46 @@ def make_parser():
               'Multiple `-e\' options can be appended to form a '
               'sequence of sampling. For example, `-e2 -e:,3\' picks the '
               'third row and then the fourth column of the array, which is '
-              'equivalent to `-e2,3\''))
+              'equivalent to `-e2,3\'. INDEX of the form `.NAME\' picks '
+              'field NAME from a structured array, e.g. `-e.x\''))
+    selectopts.add_argument(
+        '-w',
+        '--where',
+        dest='wheres',
+        metavar='[KEY]OP VALUE',
+        type=_where_expr,
+        action='append',
+        help=('select the rows (along the first axis) where the predicate '
+              'holds, where OP is one of `==\', `!=\', `<\', `<=\', `>\' '
+              'and `>=\', and VALUE is a Python literal. For example, '
+              '`-w\'label == 3\'\' selects from all keys of an npz the rows '
+              'whose `label\' equals 3, and `-w\'>0.9\'\' selects from an '
+              'npy the rows greater than 0.9. For a structured npy, KEY '
+              'is the name of a field, e.g. `-w\'x > 0\'\'. A '
+              'multi-dimensional row '
+              'matches if all of its elements satisfy the predicate. '
+              'Multiple `-w\' options are combined with logical AND. The '
+              'predicate is evaluated chunk by chunk over memory-mapped '
+              'data and the matching rows are streamed to the output, so '
+              'that memory use is bounded by CHUNK_SIZE. Cannot be used '
+              'together with `-e\''))
+    parser.add_argument(
+        '-f',
+        '--fields',
+        metavar='NAME[,NAME...]',
+        type=_field_names,
+        help=('project structured arrays onto the comma-separated fields '
+              'before indexing or filtering. Only the bytes of the selected '
+              'fields are read from memory-mapped input, and the output '
+              'records are packed without the unselected fields'))
+    parser.add_argument(
+        '--chunk-size',
+        metavar='BYTES',
+        type=_positive_int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=('the approximate number of bytes per array to process at a '
+              'time when streaming rows with `-w\' or writing the output. '
+              'Default to %(default)s'))
     parser.add_argument(
         '-T',
         '--from-file',
@@ -75,6 +138,27 @@ def make_parser():
               'If not specified as `-O-\' but input is from stdin, it will '
               'be treated as if `-O-\' were specified. Default to '
               '`%(default)s\''))
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        metavar='N',
+        type=_positive_int,
+        default=1,
+        help=('index up to N NPYZFILEs in parallel using a pool of N '
+              'worker processes. Effective only if the output is not '
+              'stdout. Default to %(default)s'))
+    parser.add_argument(
+        '--read-ahead',
+        metavar='N',
+        type=_nonnegative_int,
+        default=1,
+        help=('when indexing NPYZFILEs one at a time, load up to N '
+              'NPYZFILEs in the background while the current one is being '
+              'indexed and written, prefetching their whole memory-mapped '
+              'payloads from disk; `0\' disables reading ahead, e.g. when '
+              'indexing small parts of large files. Default to '
+              '%(default)s'))
+    npyzcore.add_stats_argument(parser)
     parser.add_argument(
         'npyzfiles',
         metavar='NPYZFILE',
@@ -94,40 +178,96 @@ def make_parser():
 
 
 def _output_suffix(string):
-    if string == '-' or string.startswith('.'):
+    if string in ('', '-') or string.startswith('.'):
         return string
     raise argparse.ArgumentTypeError
 
 
+def _positive_int(string):
+    try:
+        value = int(string)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            'illegal integer `{}\''.format(string)) from err
+    if value <= 0:
+        raise argparse.ArgumentTypeError(
+            'expecting positive integer but got `{}\''.format(string))
+    return value
+
+
+def _nonnegative_int(string):
+    try:
+        value = int(string)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(
+            'illegal integer `{}\''.format(string)) from err
+    if value < 0:
+        raise argparse.ArgumentTypeError(
+            'expecting non-negative integer but got `{}\''.format(string))
+    return value
+
+
+class FieldIndex(str):
+    """The field name in INDEX of the form `.NAME'."""
+
+
+def _compile_index(expr):
+    if expr.startswith('.'):
+        if not expr[1:]:
+            raise ValueError('empty field name')
+        return FieldIndex(expr[1:])
+    return parse_slice(expr)
+
+
 def _slice_expr(string):
     try:
         key, expr = string.split('/', maxsplit=1)
     except ValueError:
         expr = string
         try:
-            compiled_expr = parse_slice(expr)
+            compiled_expr = _compile_index(expr)
         except ValueError as err:
             raise argparse.ArgumentTypeError(
                 'illegal INDEX `{}\''.format(string)) from err
         return compiled_expr
     else:
         try:
-            compiled_expr = parse_slice(expr)
+            compiled_expr = _compile_index(expr)
         except ValueError as err:
             raise argparse.ArgumentTypeError(
                 'illegal KEYEDINDEX `{}\''.format(string)) from err
         return key, compiled_expr
 
 
+def _field_names(string):
+    names = [x.strip() for x in string.split(',')]
+    if not all(names):
+        raise argparse.ArgumentTypeError(
+            'illegal FIELDS `{}\''.format(string))
+    return names
+
+
+def _where_expr(string):
+    matched = re.fullmatch(r'\s*([^<>=!\s]*)\s*(==|!=|<=|>=|<|>)\s*(.+?)\s*',
+                           string)
+    if not matched:
+        raise argparse.ArgumentTypeError(
+            'illegal predicate `{}\''.format(string))
+    key, op, value = matched.groups()
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError) as err:
+        raise argparse.ArgumentTypeError(
+            'illegal VALUE in predicate `{}\''.format(string)) from err
+    return key or None, op, value
+
+
 def decide_input_files(args):
     global errno
     filenames = []
-    if args.from_file == '-':
-        filenames.extend(x.rstrip('\n') for x in sys.stdin)
-    elif args.from_file:
+    if args.from_file:
         try:
-            with open(args.from_file) as infile:
-                filenames.extend(x.rstrip('\n') for x in infile)
+            filenames.extend(npyzcore.read_filenames(args.from_file))
         except OSError as err:
             logging.warning('failed to load NPYZFILEs from "%s" due to %s',
                             args.from_file, err)
@@ -154,17 +294,24 @@ def decide_output_files(args, filenames):
 
 
 def read_data(filename=None):
-    global errno
+    """
+    Read NPYZFILE ``filename``, or stdin if ``filename`` is ``None``, into
+    memory. Errors are logged rather than set in ``errno``, since this may
+    run in the read-ahead thread.
 
+    :return: the array, or the dict of arrays of an npz file, or ``None``
+             if it fails to load
+    """
     data = None
     if filename is None:
-        with io.BytesIO() as cbuf:
-            shutil.copyfileobj(sys.stdin.buffer, cbuf)
-            cbuf.seek(0)
+        with npyzcore.read_stdin() as cbuf:
+            stats.add_read(cbuf.getbuffer().nbytes)
+            if flo2npy.is_flo(cbuf):
+                return _read_flo(cbuf, '/dev/stdin')
             try:
                 with np.load(cbuf) as infile:
                     data = {k: infile[k] for k in infile.keys()}
-            except AttributeError:
+            except (AttributeError, TypeError):
                 logging.info(
                     'failed to read "/dev/stdin" as npz file, trying reading '
                     'as npy file')
@@ -175,17 +322,21 @@ def read_data(filename=None):
                     logging.error(
                         'failed to read "/dev/stdin" as npy/npz file due to '
                         '%s; skipped', err)
-                    errno |= ERRNO_READ
             except OSError as err:
                 logging.error(
                     'failed to read "/dev/stdin" as npy/npz file due to %s; '
                     'skipped', err)
-                errno |= ERRNO_READ
     else:
+        try:
+            with open(filename, 'rb') as infile:
+                if flo2npy.is_flo(infile):
+                    return _read_flo(infile, filename)
+        except OSError:
+            pass
         try:
             with np.load(filename) as infile:
                 data = {k: infile[k] for k in infile.keys()}
-        except AttributeError:
+        except (AttributeError, TypeError):
             logging.info(
                 'failed to read "%s" as npz file, trying reading '
                 'as npy file', filename)
@@ -195,18 +346,55 @@ def read_data(filename=None):
                 logging.error(
                     'failed to read "%s" as npy/npz file due to %s; '
                     'skipped', filename, err)
-                errno |= ERRNO_READ
         except OSError as err:
             logging.error(
                 'failed to read "%s" as npy/npz file due to %s; '
                 'skipped', filename, err)
-            errno |= ERRNO_READ
     return data
 
 
+def _read_flo(infile, filename, use_mmap=False):
+    """
+    Read the .flo file opened as ``infile`` as an npy array of shape
+    (H, W, 2), memory-mapping ``filename`` if ``use_mmap``.
+
+    :return: the array, or ``None`` if it fails to load
+    """
+    try:
+        if use_mmap:
+            return flo2npy.memmap_flo(filename)
+        return flo2npy.read_flo(infile)
+    except flo2npy.TruncatedFloFileError:
+        logging.error('failed to read "%s" as truncated flo file; skipped',
+                      filename)
+    except (flo2npy.IllegalFloFileError, OSError) as err:
+        logging.error('failed to read "%s" as flo file due to %s; skipped',
+                      filename, err)
+    return None
+
+
+def project_fields(fields, data):
+    """
+    Project structured array(s) onto ``fields`` without copying; the result
+    keeps the layout of the original records until written.
+    """
+    if isinstance(data, dict):
+        return {k: project_fields(fields, data[k]) for k in data}
+    if data.dtype.names is None:
+        logging.error('cannot select fields %s from data of non-structured '
+                      'dtype %s', fields, data.dtype)
+        sys.exit(errno | ERRNO_DATA)
+    try:
+        return data[fields]
+    except (KeyError, ValueError) as err:
+        logging.error('failed to select fields %s from data of dtype %s due '
+                      'to %s', fields, data.dtype, err)
+        sys.exit(errno | ERRNO_DATA)
+
+
 def index_data(exprs, data):
     for expr in exprs:
-        if isinstance(expr[0], str):
+        if isinstance(expr, tuple) and isinstance(expr[0], str):
             key, expr = expr
             try:
                 data = data[key]
@@ -216,17 +404,17 @@ def index_data(exprs, data):
         if isinstance(data, dict):
             try:
                 data = {k: data[k][expr] for k in data}
-            except IndexError:
+            except (IndexError, ValueError):
                 logging.error(
                     'IndexError occurs when indexing data of '
                     'shape %s using compiled INDEX `%s',
-                    {k: data.shape
+                    {k: data[k].shape
                      for k in data}, expr)
                 sys.exit(errno | ERRNO_DATA)
         else:
             try:
                 data = data[expr]
-            except IndexError:
+            except (IndexError, ValueError):
                 logging.error(
                     'IndexError occurs when indexing data of '
                     'shape %s using compiled INDEX `%s', data.shape, expr)
@@ -234,84 +422,344 @@ def index_data(exprs, data):
     return data
 
 
-def write_data(data, outfilename=None):
+def write_data(data, outfilename=None, chunk_size=DEFAULT_CHUNK_SIZE):
     global errno
+    fmt = 'npz' if isinstance(data, dict) else 'npy'
+    write = npyzcore.write_npz if isinstance(data, dict) \
+        else npyzcore.write_npy
     if outfilename:
+        try:
+            with npyzcore.atomic_open(outfilename) as outfile:
+                write(outfile, data, chunk_size)
+        except OSError as err:
+            logging.error(
+                'failed to save data to "%s" in %s format due to '
+                '%s; skipped', outfilename, fmt, err)
+            errno |= ERRNO_WRITE
+        else:
+            stats.add_written_file(outfilename)
+            logging.info('saved data to "%s" in %s format', outfilename, fmt)
+    else:
+        try:
+            write(stats.counting_writer(sys.stdout.buffer), data, chunk_size)
+        except BrokenPipeError:
+            raise
+        except OSError as err:
+            logging.error(
+                'failed to save data to "/dev/stdout" in '
+                '%s format due to %s; skipped', fmt, err)
+            errno |= ERRNO_WRITE
+        else:
+            logging.info('saved data to "/dev/stdout" in %s format', fmt)
+
+
+def read_data_mmap(filename):
+    """
+    Same as ``read_data`` but memory-map the npy or flo file, or the npz
+    members stored without compression, rather than reading them into
+    memory.
+    """
+    try:
+        with open(filename, 'rb') as infile:
+            if flo2npy.is_flo(infile):
+                return _read_flo(infile, filename, use_mmap=True)
+    except OSError:
+        pass
+    try:
+        data = np.load(filename, mmap_mode='r')
+    except (OSError, ValueError) as err:
+        logging.error(
+            'failed to read "%s" as npy/npz file due to %s; '
+            'skipped', filename, err)
+        return None
+    if not hasattr(data, 'keys'):
+        return data
+    arrays = {}
+    try:
+        with data, open(filename, 'rb') as infile, \
+                zipfile.ZipFile(infile) as zf:
+            for info in zf.infolist():
+                key = npyzcore.npz_member_key(info)
+                arr = npyzcore.npz_member_memmap(infile, info)
+                if arr is None:
+                    logging.info(
+                        'cannot memory-map key "%s" of "%s"; reading it '
+                        'into memory', key, filename)
+                    arr = data[key]
+                arrays[key] = arr
+    except (OSError, ValueError, zipfile.BadZipFile) as err:
+        logging.error(
+            'failed to read "%s" as npz file due to %s; skipped',
+            filename, err)
+        return None
+    return arrays
+
+
+def check_where(wheres, data):
+    """
+    Ensure the predicate keys exist, either as keys of an npz or as fields
+    of a structured npy, that the predicates apply to the dtypes of their
+    arrays, and that all arrays share the number of rows, or exit with
+    ``ERRNO_DATA``.
+    """
+    for key, op, value in wheres:
+        if isinstance(data, dict) and key is None:
+            logging.error('KEY is required in predicate for npz file')
+            sys.exit(errno | ERRNO_DATA)
         if isinstance(data, dict):
-            try:
-                with open(outfilename, 'wb') as outfile:
-                    np.savez(outfile, **data)
-            except OSError as err:
-                logging.error(
-                    'failed to save data to "%s" in npz format due to '
-                    '%s; skipped', outfilename, err)
-                errno |= ERRNO_WRITE
-            else:
-                logging.info('saved data to "%s" in npz format', outfilename)
+            keys = data
         else:
-            try:
-                with open(outfilename, 'wb') as outfile:
-                    np.save(outfile, data)
-            except OSError as err:
-                logging.error(
-                    'failed to save data to "%s" in npy format due to '
-                    '%s; skipped', outfilename, err)
-                errno |= ERRNO_WRITE
-            logging.info('saved data to "%s" in npy format', outfilename)
+            keys = data.dtype.names or ()
+        if key is not None and key not in keys:
+            logging.error('KeyError occurs for key "%s"', key)
+            sys.exit(errno | ERRNO_DATA)
+        arr = data if key is None else data[key]
+        try:
+            # no rows are needed to find out if the operator applies
+            WHERE_OPERATORS[op](arr[:0], value)
+        except (TypeError, ValueError) as err:
+            logging.error('cannot apply predicate `%s%s %r\' to data of '
+                          'dtype %s due to %s', key or '', op, value,
+                          arr.dtype, err)
+            sys.exit(errno | ERRNO_DATA)
+    arrays = data.values() if isinstance(data, dict) else [data]
+    n_rows = {arr.shape[:1] for arr in arrays}
+    if len(n_rows) > 1 or () in n_rows:
+        logging.error(
+            'cannot select rows from data of shape %s as they don\'t share '
+            'the first axis',
+            {k: v.shape for k, v in data.items()}
+            if isinstance(data, dict) else data.shape)
+        sys.exit(errno | ERRNO_DATA)
+
+
+def iter_row_ranges(data, chunk_size):
+    """
+    Yield ``(start, stop)`` ranges of rows, each of which amounts to about
+    ``chunk_size`` bytes of the widest array in ``data``.
+    """
+    arrays = list(data.values()) if isinstance(data, dict) else [data]
+    row_nbytes = max(arr.itemsize * int(np.prod(arr.shape[1:]))
+                     for arr in arrays)
+    n_rows = arrays[0].shape[0] if arrays else 0
+    return npyzcore.iter_row_ranges(n_rows, row_nbytes, chunk_size)
+
+
+def row_mask(wheres, data, start, stop):
+    """
+    Evaluate the predicates over rows ``start`` to ``stop``.
+
+    :return: boolean mask of length ``stop - start``
+    """
+    mask = np.ones(stop - start, dtype=bool)
+    for key, op, value in wheres:
+        rows = data[start:stop] if key is None else data[key][start:stop]
+        cond = np.asarray(WHERE_OPERATORS[op](rows, value))
+        if cond.ndim > 1:
+            cond = cond.reshape(cond.shape[0], -1).all(axis=1)
+        mask &= cond
+    return mask
+
+
+def _write_matched_rows(fp, wheres, data, arr, ranges, n_matched):
+    dtype = npyzcore.packed_dtype(arr.dtype)
+    npyzcore.write_npy_header(fp, (n_matched,) + arr.shape[1:], dtype)
+    for start, stop in ranges:
+        rows = arr[start:stop][row_mask(wheres, data, start, stop)]
+        fp.write(npyzcore.packed_bytes(rows, dtype))
+
+
+def write_matched(wheres, data, fp, chunk_size):
+    """
+    Stream the rows of ``data`` where ``wheres`` hold to ``fp`` in npy/npz
+    format. The predicates are evaluated once to count the matching rows
+    and once more for each array while writing, so that neither the mask
+    nor the result is ever held in memory at whole.
+    """
+    ranges = list(iter_row_ranges(data, chunk_size))
+    n_matched = sum(int(np.count_nonzero(row_mask(wheres, data, start, stop)))
+                    for start, stop in ranges)
+    logging.debug('matched %d rows', n_matched)
+    if isinstance(data, dict):
+        npyzcore.write_npz(
+            fp, data, write_member=lambda member, arr: _write_matched_rows(
+                member, wheres, data, arr, ranges, n_matched))
     else:
-        with io.BytesIO() as cbuf:
-            if isinstance(data, dict):
-                try:
-                    np.savez(cbuf, **data)
-                except OSError as err:
-                    logging.error(
-                        'failed to save data to "/dev/stdout" in '
-                        'npz format due to %s; skipped', err)
-                    errno |= ERRNO_WRITE
-                    return
-                else:
-                    logging.info('saved data to "/dev/stdout" in npz format')
-            else:
-                try:
-                    np.save(cbuf, data)
-                except OSError as err:
-                    logging.error(
-                        'failed to save data to "/dev/stdout" in '
-                        'npy format due to %s; skipped', err)
-                    errno |= ERRNO_WRITE
-                    return
-                else:
-                    logging.info('saved data to "/dev/stdout" in npy format')
-            cbuf.seek(0)
-            shutil.copyfileobj(cbuf, sys.stdout.buffer)
+        _write_matched_rows(fp, wheres, data, data, ranges, n_matched)
+
+
+def load_data(filename=None):
+    """
+    Memory-map ``filename``, or read stdin into memory if ``filename`` is
+    ``None``. Memory-mapping is safe even if ``filename`` is to be
+    overwritten in place, as the output replaces it rather than truncating
+    it.
+    """
+    if filename is None:
+        return read_data()
+    data = read_data_mmap(filename)
+    if data is not None:
+        stats.add_read_file(filename)
+    return data
+
+
+def write_matched_data(wheres, data, outfilename=None,
+                       chunk_size=DEFAULT_CHUNK_SIZE):
+    global errno
+    fmt = 'npz' if isinstance(data, dict) else 'npy'
+    if outfilename:
+        try:
+            with npyzcore.atomic_open(outfilename) as outfile:
+                write_matched(wheres, data, outfile, chunk_size)
+        except OSError as err:
+            logging.error(
+                'failed to save data to "%s" in %s format due to '
+                '%s; skipped', outfilename, fmt, err)
+            errno |= ERRNO_WRITE
+        else:
+            stats.add_written_file(outfilename)
+            logging.info('saved data to "%s" in %s format', outfilename, fmt)
+    else:
+        write_matched(wheres, data, stats.counting_writer(sys.stdout.buffer),
+                      chunk_size)
+        logging.info('saved data to "/dev/stdout" in %s format', fmt)
+
+
+def process_data(args, data, outfilename=None):
+    """Project, index or filter, and then write ``data``."""
+    with stats.phase('index'):
+        if args.fields:
+            data = project_fields(args.fields, data)
+        if args.wheres:
+            check_where(args.wheres, data)
+        else:
+            data = index_data(args.indexexprs or [], data)
+    with stats.phase('write'):
+        if args.wheres:
+            # the rows are filtered as they're written
+            write_matched_data(args.wheres, data, outfilename,
+                               args.chunk_size)
+        else:
+            write_data(data, outfilename, args.chunk_size)
+
+
+def index_file(args, data, outfilename=None):
+    """
+    Process ``data`` loaded from one NPYZFILE, or ``None`` if it failed to
+    load. An error with one NPYZFILE is logged and the rest are processed
+    all the same, whether serially or in parallel.
+
+    :return: the errno bits raised while processing it
+    """
+    if data is None:
+        return ERRNO_READ
+    try:
+        process_data(args, data, outfilename)
+    except SystemExit as err:
+        return err.code or 0
+    return 0
+
+
+def load_data_ahead(filename=None):
+    """
+    Same as ``load_data`` but also have the kernel read the memory-mapped
+    payloads into the page cache, to be run ahead in the background.
+    """
+    data = load_data(filename)
+    if isinstance(data, dict):
+        for arr in data.values():
+            npyzcore.prefetch(arr)
+    else:
+        npyzcore.prefetch(data)
+    return data
+
+
+def iter_read_ahead(filenames, outfilenames, depth):
+    """
+    Yield ``(data, outfilename)`` for each pair of ``filenames`` and
+    ``outfilenames`` in order, while loading up to ``depth`` of the
+    following files, payloads included, in a background thread. ``data``
+    is ``None`` if the file failed to load.
+    """
+    pairs = zip(filenames, outfilenames)
+    if not depth:
+        for filename, outfilename in pairs:
+            with stats.phase('read'):
+                data = load_data(filename)
+            yield data, outfilename
+        return
+    with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = collections.deque(
+            (executor.submit(load_data_ahead, filename), outfilename)
+            for filename, outfilename in itertools.islice(pairs, depth + 1))
+        while pending:
+            future, outfilename = pending.popleft()
+            for next_filename, next_outfilename in itertools.islice(pairs, 1):
+                pending.append((executor.submit(load_data_ahead,
+                                                next_filename),
+                                next_outfilename))
+            with stats.phase('read'):
+                data = future.result()
+            yield data, outfilename
+
+
+def _init_worker():
+    logging.basicConfig(
+        format='%(filename)s: %(levelname)s: %(message)s', level=LOGGING_LEVEL)
+
+
+def _index_file_job(job):
+    """
+    Read, index/filter and write one NPYZFILE in a worker process.
+
+    :param job: tuple of (parsed arguments, filename, output filename)
+    :return: tuple of (the errno bits raised while processing the file, the
+             ``Stats`` of processing it)
+    """
+    global errno, stats
+    args, filename, outfilename = job
+    errno = 0
+    stats = npyzcore.Stats(stats.prog)
+    with stats.phase('read'):
+        data = load_data(filename)
+    errno |= index_file(args, data, outfilename)
+    return errno, stats
+
+
+def index_files_parallel(args, filenames, outfilenames, jobs):
+    global errno
+    jobs_args = [(args, filename, outfilename)
+                 for filename, outfilename in zip(filenames, outfilenames)]
+    with multiprocessing.Pool(jobs, initializer=_init_worker) as pool:
+        for job_errno, job_stats in pool.imap_unordered(_index_file_job,
+                                                        jobs_args):
+            errno |= job_errno
+            stats.merge(job_stats)
 
 
 def main():
+    global errno
     logging.basicConfig(
         format='%(filename)s: %(levelname)s: %(message)s', level=LOGGING_LEVEL)
-    args = make_parser().parse_args()
-    filenames = decide_input_files(args)
-    logging.debug('input filenames = %s', filenames or '/dev/stdin')
-    outfilenames = decide_output_files(args, filenames)
-    logging.debug('output filenames = %s', outfilenames)
-    if filenames and outfilenames:
-        for filename, outfilename in zip(filenames, outfilenames):
-            data = read_data(filename)
-            if data is not None:
-                data = index_data(args.indexexprs, data)
-                write_data(data, outfilename)
-    elif filenames:
+    args = make_parser().parse_args(
+        npyzcore.expand_stats_option(sys.argv[1:]))
+    stats.enable(args.stats)
+    with stats.phase('decide_inputs'):
+        filenames = decide_input_files(args)
+        logging.debug('input filenames = %s', filenames or '/dev/stdin')
+        outfilenames = decide_output_files(args, filenames)
+        logging.debug('output filenames = %s', outfilenames)
+    if filenames and outfilenames and args.jobs > 1 and len(filenames) > 1:
+        # the phases are summed over the workers
+        index_files_parallel(args, filenames, outfilenames,
+                             min(args.jobs, len(filenames)))
+        return
+    if filenames and not outfilenames:
         assert len(filenames) == 1, filenames
-        for filename in filenames:  # pylint: disable=not-an-iterable
-            data = read_data(filename)
-            if data is not None:
-                data = index_data(args.indexexprs, data)
-                write_data(data)
-    else:
-        data = read_data()
-        if data is not None:
-            data = index_data(args.indexexprs, data)
-            write_data(data)
+    for data, outfilename in iter_read_ahead(filenames or [None],
+                                             outfilenames or [None],
+                                             args.read_ahead):
+        errno |= index_file(args, data, outfilename)
 
 
 if __name__ == '__main__':
@@ -325,4 +773,5 @@ if __name__ == '__main__':
         sys.stderr.close()
         errno |= ERRNO_WRITE
     finally:
+        stats.dump(errno)
         sys.exit(errno)
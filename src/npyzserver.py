@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+import argparse
+import atexit
+import contextlib
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import traceback
+import types
+
+import npyzclient
+
+ERRNO_ARGS = 1
+ERRNO_SOCKET = 2
+ERRNO_INT = 130
+
+LOGGING_LEVEL = logging.INFO
+
+COMMANDS = ('flo2npy', 'npycat', 'npyz2img', 'npyzindex', 'npyzshape',
+            'npzcat')
+PRELOAD_MODULES = ('numpy', 'matplotlib', 'PIL.Image')
+MAX_REQUEST_SIZE = 1 << 24
+RECV_SIZE = 1 << 16
+
+PEERCRED = struct.Struct('3i')
+
+errno = 0
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        self.print_usage(sys.stderr)
+        args = {'prog': self.prog, 'message': message}
+        self.exit(ERRNO_ARGS, '{prog}: error: {message}\n'.format(**args))
+
+
+def make_parser():
+    parser = ArgumentParser(
+        prog='npyzserver',
+        description=('Serve the npyzutils commands from a resident process '
+                     'listening on a Unix domain socket, where numpy and '
+                     'friends are imported once, so that the launch '
+                     'scripts, which use the server if it\'s running, '
+                     'skip the interpreter and import startup on every '
+                     'call. Each call runs in a process forked from the '
+                     'server, in the cwd, environment, stdin, stdout and '
+                     'stderr of the caller. The server runs in the '
+                     'foreground until interrupted or stopped by '
+                     '`--stop\'.'))
+    parser.add_argument(
+        '-s',
+        '--socket',
+        metavar='PATH',
+        default=npyzclient.default_socket_path(),
+        help=('the socket to listen on, default to %(default)s. Note that '
+              'the launch scripts only look for the socket at the default '
+              'path, which is `$NPYZ_SOCKET\' if set, or otherwise '
+              '`npyzutils-<uid>.sock\' under `$XDG_RUNTIME_DIR\' or '
+              '`/tmp\''))
+    parser.add_argument(
+        '--stop',
+        action='store_true',
+        help='stop the server listening on PATH and exit')
+    return parser
+
+
+def exit_code(code):
+    """Convert the ``SystemExit.code`` to exit code as the interpreter."""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code & 0xff
+    try:
+        print(code, file=sys.stderr)
+    except (OSError, ValueError):
+        pass
+    return 1
+
+
+def preload():
+    """
+    Import numpy and friends, and then the commands. The former go first,
+    lest the commands register them to be imported lazily in every child.
+    """
+    for name in PRELOAD_MODULES + COMMANDS:
+        try:
+            importlib.import_module(name)
+        except ImportError as err:
+            logging.warning('failed to preload "%s" due to %s', name, err)
+
+
+def load_command(codes, prog):
+    """
+    Compile the script of command ``prog``, reusing the code cached in
+    dict ``codes`` unless the script has been modified since.
+
+    :return: (the script path, the code)
+    :raise OSError: if the script cannot be read
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        prog + '.py')
+    mtime = os.stat(path).st_mtime_ns
+    try:
+        cached_mtime, code = codes[prog]
+    except KeyError:
+        pass
+    else:
+        if cached_mtime == mtime:
+            return path, code
+    with open(path, 'rb') as infile:
+        code = compile(infile.read(), path, 'exec')
+    codes[prog] = mtime, code
+    return path, code
+
+
+def check_peer(conn):
+    """
+    :raise PermissionError: if the peer of ``conn`` is another user, where
+           that can be told
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return
+    _, uid, _ = PEERCRED.unpack(conn.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size))
+    if uid != os.getuid():
+        raise PermissionError('connection from uid {}'.format(uid))
+
+
+def recv_request(conn):
+    """
+    Receive a request along with the file descriptors sent by the client.
+
+    :return: (the request, the list of file descriptors)
+    :raise EOFError: if the connection is closed before the whole request
+    :raise ValueError: if the request is malformed
+    """
+    size = npyzclient.REQUEST_LENGTH.size
+    data, fds, _, _ = socket.recv_fds(conn, RECV_SIZE, 3)
+    try:
+        if not data:
+            raise EOFError
+        if len(data) < size:
+            data += npyzclient.recv_exactly(conn, size - len(data))
+        length, = npyzclient.REQUEST_LENGTH.unpack(data[:size])
+        if length > MAX_REQUEST_SIZE:
+            raise ValueError('request of {} bytes'.format(length))
+        if len(data) < size + length:
+            data += npyzclient.recv_exactly(conn, size + length - len(data))
+        request = json.loads(data[size:size + length].decode('utf-8'))
+        if not isinstance(request, dict):
+            raise ValueError('request not a JSON object')
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return request, fds
+
+
+def is_runnable(request, fds):
+    return (request.get('prog') in COMMANDS
+            and len(fds) == 3
+            and isinstance(request.get('argv'), list)
+            and all(isinstance(x, str) for x in request['argv'])
+            and isinstance(request.get('cwd'), str)
+            and isinstance(request.get('env'), dict)
+            and all(isinstance(k, str) and isinstance(v, str)
+                    for k, v in request['env'].items()))
+
+
+def _reset_stdio():
+    sys.stdin = open(0, 'r', closefd=False)
+    sys.stdout = open(1, 'w', buffering=1 if os.isatty(1) else -1,
+                      closefd=False)
+    sys.stderr = open(2, 'w', buffering=1, errors='backslashreplace',
+                      closefd=False)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(logging.WARNING)
+
+
+def run_command(path, code, request, fds):
+    """
+    Run command script ``path`` compiled as ``code`` in a forked process
+    as if it's run by the client, and exit the process with its exit code.
+    """
+    for signum in (signal.SIGCHLD, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.pthread_sigmask(signal.SIG_SETMASK, ())
+    try:
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        _reset_stdio()
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.chdir(request['cwd'])
+    except OSError as err:
+        print('npyzserver.py: failed to set up "{}" due to {}'.format(
+            request['prog'], err), file=sys.stderr)
+        os._exit(1)
+    sys.argv = [path] + request['argv']
+    module = types.ModuleType('__main__')
+    module.__file__ = path
+    sys.modules['__main__'] = module
+    try:
+        exec(code, module.__dict__)
+        returncode = 0
+    except SystemExit as err:
+        returncode = exit_code(err.code)
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    atexit._run_exitfuncs()
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+    os._exit(returncode)
+
+
+class Server:
+    """
+    The server listening on a Unix domain socket, which forks a process per
+    request and replies the pid of the process and then its exit code.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.codes = {}
+        self.children = {}
+        self.listener = None
+
+    def bind(self):
+        """
+        :raise FileExistsError: if another server is listening on the path
+        """
+        with contextlib.suppress(FileNotFoundError), \
+                socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(self.path)
+            except ConnectionRefusedError:
+                logging.info('removing stale socket "%s"', self.path)
+                os.unlink(self.path)
+            else:
+                raise FileExistsError(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.listener.listen()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path)
+
+    def report(self, pid, status):
+        """Reply the exit code of child ``pid`` as a shell would tell."""
+        code = os.waitstatus_to_exitcode(status)
+        if code < 0:
+            code = 128 - code
+        conn = self.children.pop(pid, None)
+        if conn is not None:
+            with contextlib.suppress(OSError):
+                conn.sendall(npyzclient.REPLY.pack(code))
+            conn.close()
+
+    def reap(self, _signum=None, _frame=None):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self.report(pid, status)
+
+    def drain(self):
+        """Wait for the running commands to finish."""
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            self.report(pid, status)
+
+    def serve_forever(self):
+        signal.signal(signal.SIGCHLD, self.reap)
+        while True:
+            conn, _ = self.listener.accept()
+            if self.handle(conn):
+                return
+
+    def handle(self, conn):
+        """
+        Handle a request on ``conn``.
+
+        :return: ``True`` if the server is requested to stop
+        """
+        try:
+            check_peer(conn)
+            request, fds = recv_request(conn)
+        except (OSError, EOFError, ValueError, UnicodeDecodeError) as err:
+            logging.warning('dropped request due to %s', err)
+            conn.close()
+            return False
+        if request.get('stop'):
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            return True
+        if not is_runnable(request, fds):
+            logging.warning('refused to run "%s"', request.get('prog'))
+            for fd in fds:
+                os.close(fd)
+            with contextlib.suppress(OSError):
+                conn.sendall(npyzclient.REPLY.pack(0))
+            conn.close()
+            return False
+        try:
+            path, code = load_command(self.codes, request['prog'])
+        except (OSError, SyntaxError) as err:
+            logging.error('failed to load "%s" due to %s', request['prog'],
+                          err)
+            for fd in fds:
+                os.close(fd)
+            with contextlib.suppress(OSError):
+                conn.sendall(npyzclient.REPLY.pack(0))
+            conn.close()
+            return False
+        for stream in (sys.stdout, sys.stderr):
+            stream.flush()
+        # block SIGCHLD until the child is registered, lest it be reaped
+        # before its connection is known
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD})
+        try:
+            pid = os.fork()
+            if not pid:
+                self.listener.close()
+                conn.close()
+                for other in self.children.values():
+                    other.close()
+                run_command(path, code, request, fds)
+            for fd in fds:
+                os.close(fd)
+            self.children[pid] = conn
+            with contextlib.suppress(OSError):
+                conn.sendall(npyzclient.REPLY.pack(pid))
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGCHLD})
+        logging.debug('running "%s" as pid %d', request['prog'], pid)
+        return False
+
+
+def stop_server(path):
+    """
+    :raise OSError: if there's no server listening on ``path``
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(npyzclient.encode_request({'stop': True}))
+        while sock.recv(RECV_SIZE):
+            pass
+
+
+def main():
+    global errno
+    logging.basicConfig(
+        format='%(filename)s: %(levelname)s: %(message)s', level=LOGGING_LEVEL)
+    args = make_parser().parse_args()
+    if args.stop:
+        try:
+            stop_server(args.socket)
+        except OSError as err:
+            logging.error('failed to stop server on "%s" due to %s',
+                          args.socket, err)
+            errno |= ERRNO_SOCKET
+        return
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(errno))
+    server = Server(args.socket)
+    try:
+        server.bind()
+    except FileExistsError:
+        logging.error('another server is listening on "%s"', args.socket)
+        errno |= ERRNO_SOCKET
+        return
+    except OSError as err:
+        logging.error('failed to listen on "%s" due to %s', args.socket, err)
+        errno |= ERRNO_SOCKET
+        return
+    try:
+        preload()
+        logging.info('listening on "%s"', args.socket)
+        server.serve_forever()
+        server.close()
+        server.drain()
+    finally:
+        server.close()
+    logging.info('stopped')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        errno |= ERRNO_INT
+    sys.exit(errno)
@@ -1,13 +1,11 @@
 #!/usr/bin/env python3
 import sys
-import io
-import ast
-import shutil
 import zipfile
 import argparse
 import logging
 
-import numpy as np
+import flo2npy
+import npyzcore
 
 ERRNO_ARGS = 1
 ERRNO_READ = 2
@@ -15,6 +13,8 @@ ERRNO_INT = 130
 
 errno = 0
 
+stats = npyzcore.Stats('npyzshape')
+
 LOGGING_LEVEL = logging.WARNING
 
 
@@ -28,7 +28,9 @@ class ArgumentParser(argparse.ArgumentParser):
 def make_parser():
     parser = ArgumentParser(
         prog='npyzshape',
-        description=('Inspect array shapes of npy or npz files. The output '
+        description=('Inspect array shapes of npy, npz or .flo optical flow '
+                     'files, the last of which are of shape `(H, W, 2)\'. '
+                     'The output '
                      'will be of format `<filename>\\t<key/empty-if-npy>\\t'
                      '<shape>/\"<scalar>"\\n\' for each line. If the input '
                      'is from stdin, `<filename>\\t\' will be omitted in '
@@ -37,69 +39,39 @@ def make_parser():
         'npyzfiles',
         nargs='*',
         metavar='NPYZFILE',
-        help=('the npy/npz files to inspect shapes, or leave '
-              'empty to read from stdin raw bytes of an npy '
-              'or npz file. Note that reading from stdin '
+        help=('the npy/npz/flo files to inspect shapes, or '
+              'leave empty to read from stdin raw bytes of an '
+              'npy, npz or flo file. Note that reading from stdin '
               'requires loading the entire file into memory, '
               'since stdin is not seekable, whereas reading '
               'from regular files need not'))
+    npyzcore.add_stats_argument(parser)
     return parser
 
 
-class NotNpyFileError(Exception):
-    pass
-
-
 def get_shape_npy(infile):
     global errno
-    magic = infile.read(6)
-    if magic != b'\x93NUMPY':
-        raise NotNpyFileError
-    try:
-        major = infile.read(1)[0]
-    except IndexError:
-        errno |= ERRNO_READ
-        return
-    try:
-        _ = infile.read(1)[0]
-    except IndexError:
-        errno |= ERRNO_READ
-        return
-    if major == 1:
-        headerlen = infile.read(2)
-        if len(headerlen) < 2:
-            errno |= ERRNO_READ
-            return
-        headerlen = int.from_bytes(headerlen, byteorder='little', signed=False)
-    else:
-        headerlen = infile.read(4)
-        if len(headerlen) < 4:
-            errno |= ERRNO_READ
-            return
-        headerlen = int.from_bytes(headerlen, byteorder='little', signed=False)
-    header = infile.read(headerlen)
-    if len(header) < headerlen:
-        errno |= ERRNO_READ
-        return
-    if major in (1, 2):
-        header = header.decode('latin1')
-    else:
-        header = header.decode('utf-8')
-    header = ast.literal_eval(header)
     try:
-        shape = header['shape']
-    except KeyError:
+        header = npyzcore.read_npy_header(infile)
+    except ValueError:
         errno |= ERRNO_READ
-        return
-    return shape
+        return None
+    return header.shape
 
 
 def inspect_file(infile):
     global errno
     try:
         shape = get_shape_npy(infile)
-    except NotNpyFileError:
+    except npyzcore.NotNpyFileError:
         infile.seek(0)
+        if flo2npy.is_flo(infile):
+            try:
+                h, w = flo2npy.read_header(infile)
+            except flo2npy.IllegalFloFileError:
+                errno |= ERRNO_READ
+                return None
+            return (h, w, 2)
         shape = {}
         try:
             with zipfile.ZipFile(infile, 'r') as zf:
@@ -111,7 +83,7 @@ def inspect_file(infile):
                             key = filename
                         try:
                             shape[key] = get_shape_npy(infile)
-                        except NotNpyFileError:
+                        except npyzcore.NotNpyFileError:
                             pass
         except zipfile.BadZipFile:
             errno |= ERRNO_READ
@@ -123,50 +95,57 @@ def inspect_file(infile):
 
 
 def main():
+    global errno
     logging.basicConfig(
         format='%(filename)s: %(levelname)s: %(message)s', level=LOGGING_LEVEL)
-    args = make_parser().parse_args()
+    args = make_parser().parse_args(
+        npyzcore.expand_stats_option(sys.argv[1:]))
+    stats.enable(args.stats)
+    outfile = stats.counting_writer(sys.stdout)
     if args.npyzfiles:
         for filename in args.npyzfiles:
             try:
-                with open(filename, 'rb') as infile:
+                with stats.phase('read'), open(filename, 'rb') as infile:
                     shape = inspect_file(infile)
+                    stats.add_read(infile.seek(0, 2))
             except OSError as err:
                 logging.error('failed to load "%s" due to %s; skipped',
                               filename, err)
                 errno |= ERRNO_READ
             else:
                 if shape is None:
-                    logging.error('failed to load "%s" as either npy or npz '
+                    logging.error('failed to load "%s" as npy, npz or flo '
                                   'file; skipped', filename)
                     errno |= ERRNO_READ
                 elif shape == {}:
                     logging.warning('failed to find any npy file in "%s" '
                                     'loaded as npz file; skipped', filename)
                 else:
-                    try:
-                        for k, v in shape.items():
-                            print(filename, k, v, sep='\t')
-                    except AttributeError:
-                        print(filename, '', shape, sep='\t')
+                    with stats.phase('write'):
+                        try:
+                            for k, v in shape.items():
+                                print(filename, k, v, sep='\t', file=outfile)
+                        except AttributeError:
+                            print(filename, '', shape, sep='\t',
+                                  file=outfile)
     else:
-        with io.BytesIO() as cbuf:
-            shutil.copyfileobj(sys.stdin.buffer, cbuf)
-            cbuf.seek(0)
+        with stats.phase('read'), npyzcore.read_stdin() as cbuf:
             shape = inspect_file(cbuf)
+            stats.add_read(cbuf.getbuffer().nbytes)
         if shape is None:
-            logging.error('failed to load "/dev/stdin" as either npy or '
-                          'npz file')
+            logging.error('failed to load "/dev/stdin" as npy, npz or '
+                          'flo file')
             errno |= ERRNO_READ
         elif shape == {}:
             logging.warning('failed to find any npy file in "/dev/stdin" '
                             'loaded as npz file')
         else:
-            try:
-                for k, v in shape.items():
-                    print(k, v, sep='\t')
-            except AttributeError:
-                print('', shape, sep='\t')
+            with stats.phase('write'):
+                try:
+                    for k, v in shape.items():
+                        print(k, v, sep='\t', file=outfile)
+                except AttributeError:
+                    print('', shape, sep='\t', file=outfile)
 
 
 if __name__ == '__main__':
@@ -177,4 +156,5 @@ if __name__ == '__main__':
     except BrokenPipeError:
         sys.stderr.close()
     finally:
+        stats.dump(errno)
         sys.exit(errno)
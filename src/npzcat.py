@@ -3,10 +3,13 @@ import sys
 import io
 import shutil
 import collections
+import zipfile
 import argparse
 import logging
 
-import numpy as np
+import npyzcore
+
+np = npyzcore.lazy_import('numpy')
 
 ERRNO_ARGS = 1
 ERRNO_READ = 2
@@ -16,6 +19,8 @@ ERRNO_INT = 130
 
 errno = 0
 
+stats = npyzcore.Stats('npzcat')
+
 LOGGING_LEVEL = logging.WARNING
 
 
@@ -79,6 +84,7 @@ def make_parser():
         help=('read filenames to concatenate/stack from FILE;'
               ' use `-\' to denote stdin. In either case '
               'the filenames should be placed one per line'))
+    npyzcore.add_stats_argument(parser)
     parser.add_argument(
         'npzfiles',
         nargs='*',
@@ -98,15 +104,9 @@ def make_parser():
 def decide_input_files(args):
     global errno
     filenames = []
-    if args.from_file == '-':
-        filenames.extend(x.rstrip('\n') for x in sys.stdin)
-        if not filenames and not args.npzfiles:
-            logging.info('nothing to load; aborted')
-            sys.exit(errno)
-    elif args.from_file:
+    if args.from_file:
         try:
-            with open(args.from_file) as infile:
-                filenames.extend(x.rstrip('\n') for x in infile)
+            filenames.extend(npyzcore.read_filenames(args.from_file))
         except OSError as err:
             logging.warning('failed to load NPZFILEs from "%s" due to %s',
                             args.from_file, err)
@@ -120,65 +120,45 @@ def decide_input_files(args):
     return filenames or None
 
 
+def load_data(filename, keys):
+    """
+    Load arrays of ``keys`` (default to all) from npz file ``filename``, or
+    from stdin if ``filename`` is ``None``.
+    """
+    name = filename or '/dev/stdin'
+    try:
+        if filename:
+            data = npyzcore.load_npz(filename, keys)
+            stats.add_read_file(filename)
+            return data
+        with npyzcore.read_stdin() as cbuf:
+            data = npyzcore.read_npz(cbuf, keys)
+            stats.add_read(cbuf.getbuffer().nbytes)
+            return data
+    except (zipfile.BadZipFile, npyzcore.NotNpyFileError):
+        logging.error('failed to load "%s" as npz file', name)
+        sys.exit(errno | ERRNO_READ)
+    except KeyError as err:
+        logging.error('failed to load "%s" due to %s', name, err)
+        sys.exit(errno | ERRNO_DATA)
+    except (OSError, ValueError) as err:
+        logging.error('failed to load "%s" due to %s', name, err)
+        sys.exit(errno | ERRNO_READ)
+
+
 def read_data(filenames, keys=None):
     all_data = collections.OrderedDict()
-    if filenames:
-        for filename in filenames:
+    for filename in (filenames or [None]):
+        data = load_data(filename, keys)
+        if keys is None:
+            keys = list(data)
+        for k in keys:
             try:
-                data = np.load(filename)
-            except OSError as err:
-                logging.error('failed to load "%s" due to %s', filename, err)
-                sys.exit(errno | ERRNO_READ)
-            if not hasattr(data, 'keys'):
-                logging.error('failed to load "%s" as npz file', filename)
-                sys.exit(errno | ERRNO_READ)
-            if keys is None:
-                keys = list(data.keys())
-            for k in keys:
-                try:
-                    arr = data[k]
-                except KeyError as err:
-                    logging.error('failed to load "%s" due to %s', filename,
-                                  err)
-                    sys.exit(errno | ERRNO_DATA)
-                try:
-                    all_data[k].append(arr)
-                except KeyError:
-                    all_data[k] = []
-                    all_data[k].append(data[k])
-                    logging.debug(
-                        'loaded data of key "%s" of shape %s '
-                        'from "%s"', k, data[k].shape, filename)
-            data.close()
-    else:
-        with io.BytesIO() as cbuf:
-            shutil.copyfileobj(sys.stdin.buffer, cbuf)
-            cbuf.seek(0)
-            try:
-                data = np.load(cbuf)
-            except OSError as err:
-                logging.error('failed to load "/dev/stdin" due to %s', err)
-                sys.exit(errno | ERRNO_READ)
-            if not hasattr(data, 'keys'):
-                logging.error('failed to load "/dev/stdin" as npz file')
-                sys.exit(errno | ERRNO_READ)
-            if keys is None:
-                keys = list(data.keys())
-            for k in keys:
-                try:
-                    arr = data[k]
-                except KeyError as err:
-                    logging.error('failed to load "/dev/stdin" due to %s', err)
-                    sys.exit(errno | ERRNO_DATA)
-                try:
-                    all_data[k].append(arr)
-                except KeyError:
-                    all_data[k] = []
-                    all_data[k].append(data[k])
-                    logging.debug(
-                        'loaded data of key "%s" of shape %s '
-                        'from "/dev/stdin"', k, data[k].shape)
-            data.close()
+                all_data[k].append(data[k])
+            except KeyError:
+                all_data[k] = [data[k]]
+                logging.debug('loaded data of key "%s" of shape %s from "%s"',
+                              k, data[k].shape, filename or '/dev/stdin')
     return all_data
 
 
@@ -234,17 +214,18 @@ def write_data(args, result):
                         sys.exit(errno | ERRNO_WRITE)
                 if csv_rows == 0:
                     try:
-                        with open(args.output, 'w') as outfile:
+                        with npyzcore.atomic_open(args.output, 'w') as outfile:
                             print(*result.keys(), sep=',', file=outfile)
                     except OSError as err:
                         logging.error(
                             'failed to write result to "%s" due '
                             'to %s', args.output, err)
                         sys.exit(errno | ERRNO_WRITE)
+                    stats.add_written_file(args.output)
                     logging.info('written result to "%s"', args.output)
                 else:
                     try:
-                        with open(args.output, 'w') as outfile:
+                        with npyzcore.atomic_open(args.output, 'w') as outfile:
                             print(*result.keys(), sep=',', file=outfile)
                             np.savetxt(
                                 outfile,
@@ -255,10 +236,11 @@ def write_data(args, result):
                             'failed to write result to "%s" due '
                             'to %s', args.output, err)
                         sys.exit(errno | ERRNO_WRITE)
+                    stats.add_written_file(args.output)
                     logging.info('written result to "%s"', args.output)
             else:
                 try:
-                    with open(args.output, 'w') as outfile:
+                    with npyzcore.atomic_open(args.output, 'w') as outfile:
                         for i, k in enumerate(result):
                             if i:
                                 print(file=outfile)
@@ -276,15 +258,17 @@ def write_data(args, result):
                         'failed to write result of key "%s" to "%s"'
                         'due to %s', k, args.output, err)
                     sys.exit(errno | ERRNO_WRITE)
+                stats.add_written_file(args.output)
                 logging.info('written result to "%s"', args.output)
         else:
             try:
-                with open(args.output, 'wb') as outfile:
-                    np.savez(outfile, **result)
+                with npyzcore.atomic_open(args.output) as outfile:
+                    npyzcore.write_npz(outfile, result)
             except OSError as err:
                 logging.error('failed to write result to "%s" due to %s',
                               args.output, err)
                 sys.exit(errno | ERRNO_WRITE)
+            stats.add_written_file(args.output)
             logging.info('written result to "%s"', args.output)
     else:
         if args.textwrite:
@@ -318,6 +302,7 @@ def write_data(args, result):
                         sys.exit(errno | ERRNO_WRITE)
                 if csv_rows == 0:
                     print(*result.keys(), sep=',')
+                    stats.add_written(len(','.join(result.keys())) + 1)
                     logging.info('written result to "/dev/stdout"')
                 else:
                     with io.StringIO() as cbuf:
@@ -326,6 +311,7 @@ def write_data(args, result):
                             cbuf,
                             np.stack(list(result.values()), axis=1),
                             delimiter=',')
+                        stats.add_written(cbuf.tell())
                         cbuf.seek(0)
                         shutil.copyfileobj(cbuf, sys.stdout)
                     logging.info('written result to "/dev/stdout"')
@@ -342,28 +328,33 @@ def write_data(args, result):
                                 'failed to write result of key "%s" to '
                                 '"/dev/stdout" due to %s', k, err)
                             sys.exit(errno | ERRNO_WRITE)
+                    stats.add_written(cbuf.tell())
                     cbuf.seek(0)
                     shutil.copyfileobj(cbuf, sys.stdout)
                     logging.info('written result to "/dev/stdout"')
         else:
-            with io.BytesIO() as cbuf:
-                np.savez(cbuf, **result)
-                cbuf.seek(0)
-                shutil.copyfileobj(cbuf, sys.stdout.buffer)
+            npyzcore.write_npz(stats.counting_writer(sys.stdout.buffer),
+                               result)
             logging.info('written result to "/dev/stdout"')
 
 
 def main():
     logging.basicConfig(
         format='%(filename)s: %(levelname)s: %(message)s', level=LOGGING_LEVEL)
-    args = make_parser().parse_args()
-    filenames = decide_input_files(args)
-    all_data = read_data(filenames, args.keys)
+    args = make_parser().parse_args(
+        npyzcore.expand_stats_option(sys.argv[1:]))
+    stats.enable(args.stats)
+    with stats.phase('decide_inputs'):
+        filenames = decide_input_files(args)
+    with stats.phase('read'):
+        all_data = read_data(filenames, args.keys)
     if not all_data:
         logging.debug('loaded nothing; aborted')
         return
-    result = merge_data(args, all_data)
-    write_data(args, result)
+    with stats.phase('merge'):
+        result = merge_data(args, all_data)
+    with stats.phase('write'):
+        write_data(args, result)
 
 
 if __name__ == '__main__':
@@ -377,4 +368,5 @@ if __name__ == '__main__':
         sys.stderr.close()
         errno |= ERRNO_WRITE
     finally:
+        stats.dump(errno)
         sys.exit(errno)
@@ -0,0 +1,52 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                         'bench')
+sys.path.insert(0, BENCH_DIR)
+import startup  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def startup_scenarios(tmp_path_factory):
+    paths = startup.make_dataset(str(tmp_path_factory.mktemp('startup')))
+    return startup.make_scenarios(paths)
+
+
+def test_startup_imports(startup_scenarios):
+    # the module counts are deterministic, unlike the times, which are left
+    # to running bench/startup.py itself
+    env = dict(os.environ)
+    bare = len(startup.imported_modules([sys.executable, '-c', 'pass'], env))
+    for prog, name, args in startup_scenarios:
+        cmd = [sys.executable, os.path.join(startup.SRC_DIR, prog + '.py')]
+        modules = startup.imported_modules(cmd + args, env)
+        heavy = {x.split('.')[0] for x in modules} \
+            & set(startup.HEAVY_MODULES)
+        assert not heavy, (prog, name)
+        assert len(modules) - bare <= startup.BUDGETS[prog][1], (prog, name)
+
+
+def test_suite(tmp_path):
+    results = tmp_path / 'results.json'
+    proc = subprocess.run(
+        [sys.executable, os.path.join(BENCH_DIR, 'suite.py'), 'run',
+         '--size', '1', '--files', '3', '--many', '5', '--image-size', '16',
+         '--repeat', '1', '--workdir', str(tmp_path / 'work'),
+         '-o', str(results)],
+        stdin=subprocess.DEVNULL, capture_output=True)
+    assert proc.returncode == 0, proc.stderr.decode()
+    report = json.loads(results.read_text())
+    assert len(report['results']) >= 9
+    for result in report['results']:
+        assert result['returncodes'] == [0], result['name']
+        assert result['wall_s'] > 0
+    proc = subprocess.run(
+        [sys.executable, os.path.join(BENCH_DIR, 'suite.py'), 'compare',
+         str(results), str(results)],
+        stdin=subprocess.DEVNULL, capture_output=True)
+    assert proc.returncode == 0, proc.stderr.decode()
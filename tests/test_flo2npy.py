@@ -0,0 +1,154 @@
+import io
+import os
+import struct
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src')
+
+
+def run_flo2npy(*args):
+    return subprocess.run(
+        [sys.executable, os.path.join(SRC_DIR, 'flo2npy.py')] + list(args),
+        stdin=subprocess.DEVNULL, capture_output=True)
+
+
+def write_flo(path, flow):
+    h, w = flow.shape[:2]
+    with open(path, 'wb') as outfile:
+        outfile.write(struct.pack('<fii', 202021.25, w, h))
+        outfile.write(flow.astype('<f4').tobytes())
+
+
+def make_flow(h=4, w=5, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 10, (h, w, 2)).astype(np.float32)
+
+
+def test_stack(tmp_path):
+    flows = [make_flow(seed=i) for i in range(3)]
+    flofiles = []
+    for i, flow in enumerate(flows):
+        flofiles.append(str(tmp_path / '{}.flo'.format(i)))
+        write_flo(flofiles[-1], flow)
+    for jobs in ('1', '2'):
+        stack = tmp_path / 'stack-{}.npy'.format(jobs)
+        index = tmp_path / 'stack-{}.txt'.format(jobs)
+        proc = run_flo2npy('--stack', str(stack), '--stack-index',
+                           str(index), '-j', jobs, *flofiles)
+        assert proc.returncode == 0, proc.stderr.decode()
+        np.testing.assert_array_equal(np.load(stack), np.stack(flows))
+        assert index.read_text() == ''.join(
+            '{}\t{}\n'.format(i, f) for i, f in enumerate(flofiles))
+
+
+def test_stack_failure_keeps_existing_stack(tmp_path):
+    write_flo(tmp_path / 'a.flo', make_flow())
+    write_flo(tmp_path / 'b.flo', make_flow(h=3))
+    stack = tmp_path / 'stack.npy'
+    np.save(stack, np.zeros(3))
+    proc = run_flo2npy('--stack', str(stack), str(tmp_path / 'a.flo'),
+                       str(tmp_path / 'b.flo'))
+    assert proc.returncode == 4
+    np.testing.assert_array_equal(np.load(stack), np.zeros(3))
+    assert sorted(os.listdir(tmp_path)) == ['a.flo', 'b.flo', 'stack.npy']
+
+
+def test_stack_nothing(tmp_path):
+    (tmp_path / 'empty').mkdir()
+    proc = run_flo2npy('--stack', str(tmp_path / 'stack.npy'),
+                       str(tmp_path / 'empty'))
+    assert proc.returncode == 1
+    assert b'no FLOFILE to stack' in proc.stderr
+    assert b'Traceback' not in proc.stderr
+    assert not (tmp_path / 'stack.npy').exists()
+
+
+def test_convert(tmp_path):
+    flow = make_flow()
+    flow[0, 0] = np.nan
+    write_flo(tmp_path / 'a.flo', flow)
+    proc = run_flo2npy(str(tmp_path / 'a.flo'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    result = np.load(tmp_path / 'a.flo.npy')
+    assert result.dtype == np.float32
+    np.testing.assert_array_equal(result, flow)
+    proc = run_flo2npy('-O', '-', str(tmp_path / 'a.flo'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    np.testing.assert_array_equal(np.load(io.BytesIO(proc.stdout)), flow)
+
+
+def test_convert_truncated(tmp_path):
+    write_flo(tmp_path / 'a.flo', make_flow())
+    data = (tmp_path / 'a.flo').read_bytes()
+    (tmp_path / 'a.flo').write_bytes(data[:-4])
+    proc = run_flo2npy(str(tmp_path / 'a.flo'))
+    assert proc.returncode == 6
+    assert b'truncated flow file' in proc.stderr
+    assert not (tmp_path / 'a.flo.npy').exists()
+
+
+def test_batch(tmp_path):
+    flows = {}
+    for rel in ('a.flo', 'sub/b.flo', 'sub/deeper/c.flo'):
+        path = tmp_path / 'in' / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        flows[rel] = make_flow(seed=len(flows))
+        write_flo(path, flows[rel])
+    (tmp_path / 'in' / 'bad.flo').write_bytes(b'garbage')
+    for jobs in ('1', '3'):
+        out = tmp_path / 'out{}'.format(jobs)
+        out.mkdir()
+        proc = run_flo2npy('-j', jobs, '-O', str(out), str(tmp_path / 'in'))
+        assert proc.returncode & 2, proc.stderr.decode()
+        assert b'bad.flo' in proc.stderr
+        for rel, flow in flows.items():
+            np.testing.assert_array_equal(np.load(out / (rel + '.npy')),
+                                          flow)
+
+
+def test_float16(tmp_path):
+    flow = make_flow()
+    flow[1, 1] = np.nan
+    write_flo(tmp_path / 'a.flo', flow)
+    proc = run_flo2npy('-E', 'float16', str(tmp_path / 'a.flo'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    result = np.load(tmp_path / 'a.flo.npy')
+    assert result.dtype == np.float16
+    known = ~np.isnan(flow)
+    error = np.abs(result[known].astype(np.float32) - flow[known]).max()
+    assert error <= np.abs(flow[known]).max() * 2.0 ** -11
+    assert np.isnan(result[1, 1]).all()
+    reported = float(proc.stderr.decode().rsplit(' ', 1)[1])
+    assert reported == pytest.approx(error, rel=1e-5)
+
+
+def test_float16_overflow(tmp_path):
+    flow = make_flow()
+    flow[2, 3, 0] = 70000.0
+    write_flo(tmp_path / 'a.flo', flow)
+    (tmp_path / 'a.flo.npy').write_bytes(b'old')
+    proc = run_flo2npy('-E', 'float16', str(tmp_path / 'a.flo'))
+    assert proc.returncode == 4
+    assert b'out of the range of float16' in proc.stderr
+    assert (tmp_path / 'a.flo.npy').read_bytes() == b'old'
+
+
+def test_int16(tmp_path):
+    flow = make_flow()
+    flow[0, 1] = 1e10
+    write_flo(tmp_path / 'a.flo', flow)
+    proc = run_flo2npy('-E', 'int16', str(tmp_path / 'a.flo'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    with np.load(tmp_path / 'a.flo.npz') as npz:
+        encoded, scale = npz['flow'], npz['scale']
+    assert encoded.dtype == np.int16 and scale.dtype == np.float32
+    assert (encoded[0, 1] == -32768).all()
+    known = np.abs(flow) < 1e9
+    assert scale == pytest.approx(np.abs(flow[known]).max() / 32767)
+    error = np.abs(encoded[known] * scale - flow[known]).max()
+    assert error <= scale / 2 * 1.001
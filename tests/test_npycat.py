@@ -0,0 +1,68 @@
+import io
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src')
+
+
+def run_npycat(*args):
+    return subprocess.run(
+        [sys.executable, os.path.join(SRC_DIR, 'npycat.py')] + list(args),
+        stdin=subprocess.DEVNULL, capture_output=True)
+
+
+def test_concatenate(tmp_path):
+    a = np.arange(12, dtype=np.int32).reshape(3, 4)
+    b = np.asfortranarray(np.arange(8, dtype=np.int32).reshape(2, 4))
+    np.save(tmp_path / 'a.npy', a)
+    np.save(tmp_path / 'b.npy', b)
+    proc = run_npycat(str(tmp_path / 'a.npy'), str(tmp_path / 'b.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    np.testing.assert_array_equal(np.load(io.BytesIO(proc.stdout)),
+                                  np.concatenate([a, b]))
+    proc = run_npycat('-s', '-d', '1', '-O', str(tmp_path / 's.npy'),
+                      str(tmp_path / 'a.npy'), str(tmp_path / 'a.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    np.testing.assert_array_equal(np.load(tmp_path / 's.npy'),
+                                  np.stack([a, a], axis=1))
+
+
+def test_output_is_input(tmp_path):
+    a = np.arange(10.0)
+    np.save(tmp_path / 'a.npy', a)
+    proc = run_npycat('-O', str(tmp_path / 'a.npy'), str(tmp_path / 'a.npy'),
+                      str(tmp_path / 'a.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    np.testing.assert_array_equal(np.load(tmp_path / 'a.npy'),
+                                  np.concatenate([a, a]))
+    assert os.listdir(tmp_path) == ['a.npy']
+
+
+def test_stats(tmp_path):
+    np.save(tmp_path / 'a.npy', np.arange(100))
+    proc = run_npycat('--stats=' + str(tmp_path / 'stats.json'), '-O',
+                      str(tmp_path / 'b.npy'), str(tmp_path / 'a.npy'),
+                      str(tmp_path / 'a.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    stats = json.loads((tmp_path / 'stats.json').read_text())
+    assert stats['prog'] == 'npycat'
+    assert stats['exit_code'] == 0
+    assert stats['files_read'] == 2
+    assert stats['bytes_read'] == 2 * os.path.getsize(tmp_path / 'a.npy')
+    assert stats['files_written'] == 1
+    assert stats['bytes_written'] == os.path.getsize(tmp_path / 'b.npy')
+    assert {'read', 'merge', 'write'} <= set(stats['phases'])
+    assert stats['max_rss_bytes'] > 0
+
+
+def test_stats_on_error(tmp_path):
+    proc = run_npycat('--stats', str(tmp_path / 'missing.npy'))
+    assert b'failed to load' in proc.stderr
+    stats = json.loads(proc.stderr.decode().splitlines()[-1])
+    assert stats['exit_code'] == proc.returncode
+    assert stats['files_read'] == stats['files_written'] == 0
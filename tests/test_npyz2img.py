@@ -0,0 +1,236 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src')
+
+
+def run_npyz2img(*args):
+    return subprocess.run(
+        [sys.executable, os.path.join(SRC_DIR, 'npyz2img.py')] + list(args),
+        stdin=subprocess.DEVNULL, capture_output=True)
+
+
+def test_rgba_to_jpeg(tmp_path):
+    pytest.importorskip('PIL')
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    npyfile = tmp_path / 'rgba.npy'
+    np.save(npyfile, rng.integers(0, 256, (2, 8, 8, 4), dtype=np.uint8))
+    proc = run_npyz2img('-C', 'NHWC', '-P', 'i{}.jpg', '-d', str(tmp_path),
+                        str(npyfile))
+    assert proc.returncode == 0, proc.stderr.decode()
+    assert b'Traceback' not in proc.stderr
+    for i in range(2):
+        with Image.open(tmp_path / 'i{}.jpg'.format(i)) as img:
+            assert img.format == 'JPEG'
+            assert img.mode == 'RGB'
+            assert img.size == (8, 8)
+
+
+def test_auto_contrast_ignores_nan(tmp_path):
+    pytest.importorskip('PIL')
+    from PIL import Image
+    data = np.arange(64, dtype=np.float32).reshape(8, 8)
+    data[-1] = np.nan
+    np.save(tmp_path / 'nan.npy', data)
+    proc = run_npyz2img('-C', 'HW', '-T', 'float32', '--auto-contrast=0,100',
+                        '-P', 'nan.png', '-d', str(tmp_path),
+                        str(tmp_path / 'nan.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    with Image.open(tmp_path / 'nan.png') as img:
+        pixels = np.asarray(img)
+    expected = np.rint(np.arange(56) * (255 / 55)).astype(np.uint8)
+    np.testing.assert_array_equal(pixels[:-1].ravel(), expected)
+    np.testing.assert_array_equal(pixels[-1], 0)
+
+
+def read_image(path):
+    image = pytest.importorskip('PIL.Image')
+    with image.open(path) as img:
+        return np.asarray(img)
+
+
+def save_gray_images(path, n=6, h=8, w=10, seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 256, (n, h, w), dtype=np.uint8)
+    np.save(path, data)
+    return data
+
+
+def test_jobs_match_serial(tmp_path):
+    data = save_gray_images(tmp_path / 'g.npy')
+    for jobs in ('1', '3'):
+        (tmp_path / jobs).mkdir()
+        proc = run_npyz2img('-C', 'NHW', '-j', jobs, '-d',
+                            str(tmp_path / jobs), str(tmp_path / 'g.npy'))
+        assert proc.returncode == 0, proc.stderr.decode()
+    for i, img in enumerate(data):
+        name = 'img-{}.png'.format(i)
+        np.testing.assert_array_equal(read_image(tmp_path / '3' / name), img)
+        assert ((tmp_path / '1' / name).read_bytes()
+                == (tmp_path / '3' / name).read_bytes())
+
+
+def test_png_without_matplotlib(tmp_path):
+    data = save_gray_images(tmp_path / 'g.npy', n=2)
+    blocker = tmp_path / 'blocker' / 'matplotlib'
+    blocker.mkdir(parents=True)
+    (blocker / '__init__.py').write_text('raise ImportError("blocked")\n')
+    env = dict(os.environ, PYTHONPATH=str(tmp_path / 'blocker'))
+    proc = subprocess.run(
+        [sys.executable, os.path.join(SRC_DIR, 'npyz2img.py'), '-C', 'NHW',
+         '-d', str(tmp_path), str(tmp_path / 'g.npy')],
+        stdin=subprocess.DEVNULL, capture_output=True, env=env)
+    assert proc.returncode == 0, proc.stderr.decode()
+    for i, img in enumerate(data):
+        np.testing.assert_array_equal(
+            read_image(tmp_path / 'img-{}.png'.format(i)), img)
+
+
+def test_cmap(tmp_path):
+    matplotlib = pytest.importorskip('matplotlib')
+    data = save_gray_images(tmp_path / 'g.npy', n=2)
+    proc = run_npyz2img('-C', 'NHW', '-A', 'viridis', '-d', str(tmp_path),
+                        str(tmp_path / 'g.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    colormap = matplotlib.colormaps['viridis']
+    for i, img in enumerate(data):
+        expected = colormap(img / 255.0, bytes=True)[..., :3]
+        result = read_image(tmp_path / 'img-{}.png'.format(i))
+        assert result.shape == img.shape + (3,)
+        assert np.abs(result.astype(int) - expected).max() <= 3
+
+
+def test_not_normalized(tmp_path):
+    data = np.linspace(-0.5, 1.5, 80, dtype=np.float32).reshape(8, 10)
+    np.save(tmp_path / 'f.npy', data)
+    np.save(tmp_path / 'clipped.npy', data.clip(0, 1))
+    proc = run_npyz2img('-C', 'HW', '-T', 'float32', '-d', str(tmp_path),
+                        str(tmp_path / 'f.npy'))
+    assert proc.returncode == 4
+    assert b'float image not within range' in proc.stderr
+    for name, opts in (('f', ['-l', '0', '-u', '1']), ('clipped', [])):
+        proc = run_npyz2img('-C', 'HW', '-T', 'float32', *opts, '-P',
+                            name + '.png', '-d', str(tmp_path),
+                            str(tmp_path / (name + '.npy')))
+        assert proc.returncode == 0, proc.stderr.decode()
+    assert ((tmp_path / 'f.png').read_bytes()
+            == (tmp_path / 'clipped.png').read_bytes())
+
+
+def test_montage(tmp_path):
+    data = save_gray_images(tmp_path / 'g.npy', n=5)
+    proc = run_npyz2img('-C', 'NHW', '-M', '2x2', '--montage-padding', '1',
+                        '-P', 'sheet-{}.png', '-d', str(tmp_path),
+                        str(tmp_path / 'g.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    sheets = [read_image(tmp_path / 'sheet-{}.png'.format(i))
+              for i in range(2)]
+    assert not (tmp_path / 'sheet-2.png').exists()
+    for sheet in sheets:
+        assert sheet.shape == (8 * 2 + 1, 10 * 2 + 1)
+    for i, img in enumerate(data):
+        row, col = divmod(i % 4, 2)
+        tile = sheets[i // 4][row * 9:row * 9 + 8, col * 11:col * 11 + 10]
+        np.testing.assert_array_equal(tile, img)
+    assert not sheets[0][8].any() and not sheets[0][:, 10].any()
+    assert not sheets[1][:, 11:].any()
+
+
+def test_frames_to_stdout(tmp_path):
+    data = save_gray_images(tmp_path / 'g.npy')
+    proc = run_npyz2img('-C', 'NHW', '-F', 'rgb24', '-o', '--',
+                        str(tmp_path / 'g.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    frames = np.frombuffer(proc.stdout, dtype=np.uint8)
+    np.testing.assert_array_equal(frames.reshape(data.shape + (3,)),
+                                  np.repeat(data[..., None], 3, axis=-1))
+
+    proc = run_npyz2img('-C', 'NHW', '-F', 'y4m', '--fps', '30', '-o', '--',
+                        str(tmp_path / 'g.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    header, _, body = proc.stdout.partition(b'\n')
+    assert header.startswith(b'YUV4MPEG2 W10 H8 F30:1 ')
+    chunks = body.split(b'FRAME\n')
+    assert chunks[0] == b'' and len(chunks) == len(data) + 1
+
+
+def test_incremental(tmp_path):
+    data = save_gray_images(tmp_path / 'g.npy', n=3)
+    out = tmp_path / 'out'
+    out.mkdir()
+
+    def render(*opts):
+        proc = run_npyz2img('-C', 'NHW', '--incremental', *opts, '-d',
+                            str(out), str(tmp_path / 'g.npy'))
+        assert proc.returncode == 0, proc.stderr.decode()
+        return {name: os.stat(out / name).st_mtime_ns
+                for name in os.listdir(out)}
+
+    first = render()
+    assert sorted(first) == ['.npyz2img-cache.json', 'img-0.png',
+                             'img-1.png', 'img-2.png']
+    os.utime(out / 'img-0.png', ns=(1, 1))
+    os.utime(out / 'img-2.png', ns=(1, 1))
+    data[1] = 255 - data[1]
+    np.save(tmp_path / 'g.npy', data)
+    second = render()
+    assert second['img-0.png'] == second['img-2.png'] == 1
+    np.testing.assert_array_equal(read_image(out / 'img-1.png'), data[1])
+    # another colormap invalidates all of them
+    third = render('-A', 'viridis')
+    assert third['img-0.png'] != 1 and third['img-2.png'] != 1
+    assert read_image(out / 'img-0.png').shape == (8, 10, 3)
+
+
+def test_pyramid(tmp_path):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (40, 60), dtype=np.uint8)
+    np.save(tmp_path / 'big.npy', img)
+    proc = run_npyz2img('-C', 'HW', '-Z', 'pyr', '--tile-size', '16', '-d',
+                        str(tmp_path), str(tmp_path / 'big.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    dzi = (tmp_path / 'pyr.dzi').read_text()
+    assert 'TileSize="16"' in dzi and 'Width="60" Height="40"' in dzi
+    levels = sorted(map(int, os.listdir(tmp_path / 'pyr_files')))
+    assert levels == list(range(7))
+    top = tmp_path / 'pyr_files' / '6'
+    rows = []
+    for row in range(3):
+        rows.append(np.concatenate([
+            read_image(top / '{}_{}.png'.format(col, row))
+            for col in range(4)], axis=1))
+    np.testing.assert_array_equal(np.concatenate(rows, axis=0), img)
+    assert read_image(tmp_path / 'pyr_files' / '0' / '0_0.png').shape[:2] \
+        == (1, 1)
+
+
+def test_all_keys(tmp_path):
+    rng = np.random.default_rng(0)
+    data = {'a': rng.integers(0, 256, (2, 8, 8), dtype=np.uint8),
+            'b': rng.integers(0, 256, (3, 8, 8), dtype=np.uint8)}
+    np.savez(tmp_path / 'z.npz', **data)
+    proc = run_npyz2img('-C', 'NHW', '--all-keys', '-j', '2', '-d',
+                        str(tmp_path), str(tmp_path / 'z.npz'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    for key, arr in data.items():
+        for i, img in enumerate(arr):
+            np.testing.assert_array_equal(
+                read_image(tmp_path / 'img-{}_{}.png'.format(key, i)), img)
+
+
+def test_scale(tmp_path):
+    data = save_gray_images(tmp_path / 'g.npy', n=2)
+    proc = run_npyz2img('-C', 'NHW', '--scale', '0.5', '-d', str(tmp_path),
+                        str(tmp_path / 'g.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    expected = np.rint(data.reshape(2, 4, 2, 5, 2).mean(axis=(2, 4)))
+    for i in range(2):
+        result = read_image(tmp_path / 'img-{}.png'.format(i))
+        assert result.shape == (4, 5)
+        assert np.abs(result - expected[i]).max() <= 1
@@ -0,0 +1,190 @@
+import io
+import os
+import sys
+import zipfile
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import npyzcore  # noqa: E402
+
+
+class Unseekable(io.RawIOBase):
+    """A stream that can only be read or written forward, like a pipe."""
+
+    def __init__(self, data=b''):
+        self.cbuf = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def readinto(self, b):
+        return self.cbuf.readinto(b)
+
+    def write(self, b):
+        return self.cbuf.write(b)
+
+
+def npy_bytes(arr):
+    with io.BytesIO() as cbuf:
+        np.save(cbuf, arr)
+        return cbuf.getvalue()
+
+
+ARRAYS = [
+    np.arange(24, dtype='<i4').reshape(2, 3, 4),
+    np.asfortranarray(np.arange(12, dtype='>f8').reshape(3, 4)),
+    np.zeros((0, 5), dtype=np.uint8),
+    np.array(3.5),
+    np.zeros(4, dtype=[('a', '<i2'), ('b', '<f4', (2,))]),
+]
+
+
+@pytest.mark.parametrize('arr', ARRAYS)
+def test_read_npy_header(arr):
+    data = npy_bytes(arr)
+    fp = Unseekable(data)
+    header = npyzcore.read_npy_header(fp)
+    assert header.shape == arr.shape
+    assert header.dtype == arr.dtype
+    assert header.fortran_order == (arr.flags.f_contiguous
+                                    and not arr.flags.c_contiguous)
+    assert data[header.offset:] == fp.read()
+
+
+@pytest.mark.parametrize('arr', ARRAYS)
+def test_read_npy(arr):
+    result = npyzcore.read_npy(io.BufferedReader(Unseekable(npy_bytes(arr))))
+    assert result.dtype == arr.dtype
+    np.testing.assert_array_equal(result, arr)
+
+
+@pytest.mark.filterwarnings('ignore:Stored array in format 2.0')
+def test_read_npy_header_version_2():
+    arr = np.zeros(3, dtype=[('f{}'.format(i), '<i1') for i in range(7000)])
+    data = npy_bytes(arr)
+    assert data[6] == 2
+    header = npyzcore.read_npy_header(io.BytesIO(data))
+    assert header.shape == (3,)
+    assert header.dtype == arr.dtype
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'not an npy file',
+])
+def test_read_npy_header_not_npy(data):
+    with pytest.raises(npyzcore.NotNpyFileError):
+        npyzcore.read_npy_header(io.BytesIO(data))
+
+
+@pytest.mark.parametrize('cut', [7, 9, 20])
+def test_read_npy_header_truncated(cut):
+    data = npy_bytes(np.arange(3))
+    with pytest.raises(ValueError):
+        npyzcore.read_npy_header(io.BytesIO(data[:cut]))
+
+
+def test_read_npy_truncated_payload():
+    data = npy_bytes(np.arange(30))
+    with pytest.raises(ValueError):
+        npyzcore.read_npy(io.BytesIO(data[:-1]))
+
+
+@pytest.mark.parametrize('arr', ARRAYS)
+def test_write_npy(arr):
+    with io.BytesIO() as cbuf:
+        npyzcore.write_npy(cbuf, arr, chunk_size=16)
+        result = np.load(io.BytesIO(cbuf.getvalue()))
+    np.testing.assert_array_equal(result, arr)
+
+
+def test_write_npy_strided_view():
+    arr = np.arange(1000, dtype=np.int16).reshape(10, 100)[::3, 1::7]
+    with io.BytesIO() as cbuf:
+        npyzcore.write_npy(cbuf, arr, chunk_size=8)
+        np.testing.assert_array_equal(np.load(io.BytesIO(cbuf.getvalue())),
+                                      arr)
+
+
+def make_npz(path, compress):
+    data = {
+        'a': np.arange(10, dtype=np.float32),
+        'b': np.arange(6, dtype='>i8').reshape(2, 3),
+        'empty': np.zeros((0, 2)),
+    }
+    (np.savez_compressed if compress else np.savez)(path, **data)
+    return data
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_load_npz(tmp_path, compress, use_mmap):
+    data = make_npz(tmp_path / 'a.npz', compress)
+    result = npyzcore.load_npz(str(tmp_path / 'a.npz'), use_mmap=use_mmap)
+    assert list(result) == list(data)
+    for key, arr in data.items():
+        assert result[key].dtype == arr.dtype
+        np.testing.assert_array_equal(result[key], arr)
+    mapped = isinstance(result['a'], np.memmap)
+    assert mapped == (use_mmap and not compress)
+
+
+def test_load_npz_keys(tmp_path):
+    data = make_npz(tmp_path / 'a.npz', False)
+    result = npyzcore.load_npz(str(tmp_path / 'a.npz'), ['b'])
+    assert list(result) == ['b']
+    np.testing.assert_array_equal(result['b'], data['b'])
+    with pytest.raises(KeyError):
+        npyzcore.load_npz(str(tmp_path / 'a.npz'), ['c'])
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_npz_members(tmp_path, compress):
+    data = make_npz(tmp_path / 'a.npz', compress)
+    with open(tmp_path / 'a.npz', 'rb') as infile:
+        members = npyzcore.npz_members(infile)
+        assert [m.key for m in members] == list(data)
+        for member in members:
+            if compress:
+                assert member.header is None
+                continue
+            assert member.header.shape == data[member.key].shape
+            infile.seek(member.header.offset)
+            payload = infile.read(data[member.key].nbytes)
+            assert payload == data[member.key].tobytes()
+
+
+def test_read_npz_not_zip():
+    with pytest.raises(zipfile.BadZipFile):
+        npyzcore.read_npz(io.BytesIO(npy_bytes(np.arange(3))))
+
+
+def test_write_npz_unseekable():
+    data = {'x': np.arange(5), 'y': np.ones((2, 2), dtype=np.uint8)}
+    fp = Unseekable()
+    npyzcore.write_npz(fp, data)
+    with np.load(io.BytesIO(fp.cbuf.getvalue())) as npz:
+        assert sorted(npz.files) == ['x', 'y']
+        for key, arr in data.items():
+            np.testing.assert_array_equal(npz[key], arr)
+
+
+def test_atomic_open_keeps_file_on_error(tmp_path):
+    path = tmp_path / 'out.bin'
+    path.write_bytes(b'old')
+    with pytest.raises(RuntimeError):
+        with npyzcore.atomic_open(str(path)) as outfile:
+            outfile.write(b'new')
+            raise RuntimeError
+    assert path.read_bytes() == b'old'
+    assert os.listdir(tmp_path) == ['out.bin']
+    with npyzcore.atomic_open(str(path)) as outfile:
+        outfile.write(b'new')
+    assert path.read_bytes() == b'new'
+    assert os.listdir(tmp_path) == ['out.bin']
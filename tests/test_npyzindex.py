@@ -0,0 +1,194 @@
+import io
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src')
+
+
+def run_npyzindex(*args, stdin=None):
+    return subprocess.run(
+        [sys.executable, os.path.join(SRC_DIR, 'npyzindex.py')] + list(args),
+        input=stdin, stdin=None if stdin is not None else subprocess.DEVNULL,
+        capture_output=True)
+
+
+def make_records(n=6):
+    rec = np.zeros(n, dtype=[('a', '<i4'), ('b', '<f4')])
+    rec['a'] = np.arange(n)
+    rec['b'] = np.arange(n) / 2
+    return rec
+
+
+def test_where_on_field_of_structured_npy(tmp_path):
+    rec = make_records()
+    np.save(tmp_path / 'rec.npy', rec)
+    proc = run_npyzindex('-w', 'a > 3', '-O', '-', str(tmp_path / 'rec.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    np.testing.assert_array_equal(np.load(io.BytesIO(proc.stdout)),
+                                  rec[rec['a'] > 3])
+
+
+def test_where_on_projected_field(tmp_path):
+    rec = make_records()
+    np.save(tmp_path / 'rec.npy', rec)
+    proc = run_npyzindex('-f', 'a', '-w', 'a >= 4', '-O', '-',
+                         str(tmp_path / 'rec.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    result = np.load(io.BytesIO(proc.stdout))
+    assert result.dtype.names == ('a',)
+    np.testing.assert_array_equal(result['a'], [4, 5])
+
+
+def test_where_value_of_wrong_type(tmp_path):
+    np.save(tmp_path / 'a.npy', np.arange(10))
+    proc = run_npyzindex('-w', "< 'a'", '-O', '-', str(tmp_path / 'a.npy'))
+    assert proc.returncode == 4
+    assert b'cannot apply predicate' in proc.stderr
+    assert not proc.stdout
+
+
+def test_where_on_whole_records(tmp_path):
+    np.save(tmp_path / 'rec.npy', make_records())
+    proc = run_npyzindex('-f', 'a', '-w', '> 5', '-O', '-',
+                         str(tmp_path / 'rec.npy'))
+    assert proc.returncode == 4
+    assert b'cannot apply predicate' in proc.stderr
+    assert not proc.stdout
+
+
+def test_where_on_missing_field(tmp_path):
+    np.save(tmp_path / 'rec.npy', make_records())
+    proc = run_npyzindex('-f', 'b', '-w', 'a > 3', '-O', '-',
+                         str(tmp_path / 'rec.npy'))
+    assert proc.returncode == 4
+    assert b'KeyError occurs for key "a"' in proc.stderr
+
+
+def test_jobs_match_serial(tmp_path):
+    rng = np.random.default_rng(0)
+    arrays = {'{}.npy'.format(i): rng.random((5 + i, 3)) for i in range(6)}
+    arrays['short.npy'] = np.arange(2)
+    for name, arr in arrays.items():
+        np.save(tmp_path / name, arr)
+    # the files that fail come first, as they must not end the run
+    names = ['short.npy', 'missing.npy'] + sorted(arrays)[:-1]
+    (tmp_path / 'list.txt').write_text(''.join(
+        str(tmp_path / name) + '\n' for name in names))
+    results = []
+    for opts in (['--read-ahead', '0'], [], ['-j', '3']):
+        suffix = '.j{}'.format(len(results))
+        proc = run_npyzindex('-e', '4', '-O', suffix, '-T',
+                             str(tmp_path / 'list.txt'), *opts)
+        assert b'Traceback' not in proc.stderr
+        assert b'data of shape (2,)' in proc.stderr
+        assert b'missing.npy' in proc.stderr
+        outputs = {}
+        for name, arr in arrays.items():
+            outfile = tmp_path / (name + suffix)
+            if name == 'short.npy':
+                assert not outfile.exists()
+            else:
+                outputs[name] = np.load(outfile)
+                np.testing.assert_array_equal(outputs[name], arr[4])
+        results.append((proc.returncode, outputs))
+    # the index error and the read error of one file each, not an abort
+    assert [code for code, _ in results] == [6, 6, 6]
+    assert all(outputs.keys() == results[0][1].keys()
+               for _, outputs in results)
+
+
+def test_fields(tmp_path):
+    rec = np.zeros(4, dtype=[('a', '<i4'), ('b', '<f8'), ('c', 'u1', (3,))])
+    rec['a'] = np.arange(4)
+    rec['b'] = np.arange(4) * 1.5
+    rec['c'] = np.arange(12).reshape(4, 3)
+    np.save(tmp_path / 'rec.npy', rec)
+    proc = run_npyzindex('-f', 'c,a', '-e', '1:3', '-O', '-',
+                         str(tmp_path / 'rec.npy'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    result = np.load(io.BytesIO(proc.stdout))
+    assert result.dtype == np.dtype([('c', 'u1', (3,)), ('a', '<i4')])
+    np.testing.assert_array_equal(result['a'], rec['a'][1:3])
+    np.testing.assert_array_equal(result['c'], rec['c'][1:3])
+
+
+def test_fields_of_npz(tmp_path):
+    rec = make_records()
+    np.savez(tmp_path / 'rec.npz', x=rec, y=rec[::-1])
+    proc = run_npyzindex('-f', 'b', '-O', '-', str(tmp_path / 'rec.npz'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    with np.load(io.BytesIO(proc.stdout)) as npz:
+        np.testing.assert_array_equal(npz['x']['b'], rec['b'])
+        np.testing.assert_array_equal(npz['y']['b'], rec['b'][::-1])
+        assert npz['x'].dtype.names == ('b',)
+
+
+def test_unknown_field(tmp_path):
+    np.save(tmp_path / 'rec.npy', make_records())
+    proc = run_npyzindex('-f', 'z', '-O', '-', str(tmp_path / 'rec.npy'))
+    assert proc.returncode == 4
+    assert not proc.stdout
+
+
+def test_where_npz_streamed_in_chunks(tmp_path):
+    label = np.arange(1000) % 7
+    data = np.arange(3000, dtype=np.float32).reshape(1000, 3)
+    np.savez(tmp_path / 'a.npz', label=label, data=data)
+    proc = run_npyzindex('-w', 'label == 3', '-w', 'label != 0',
+                         '--chunk-size', '100', '-O', '-',
+                         str(tmp_path / 'a.npz'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    with np.load(io.BytesIO(proc.stdout)) as npz:
+        np.testing.assert_array_equal(npz['label'], label[label == 3])
+        np.testing.assert_array_equal(npz['data'], data[label == 3])
+
+
+def test_in_place(tmp_path):
+    arr = np.arange(100).reshape(10, 10)
+    np.save(tmp_path / 'a.npy', arr)
+    np.savez(tmp_path / 'a.npz', x=arr, y=arr * 2)
+    proc = run_npyzindex('-e', '::2,1', str(tmp_path / 'a.npy'),
+                         str(tmp_path / 'a.npz'), '-O')
+    assert proc.returncode == 0, proc.stderr.decode()
+    np.testing.assert_array_equal(np.load(tmp_path / 'a.npy'), arr[::2, 1])
+    with np.load(tmp_path / 'a.npz') as npz:
+        np.testing.assert_array_equal(npz['x'], arr[::2, 1])
+        np.testing.assert_array_equal(npz['y'], arr[::2, 1] * 2)
+    assert sorted(os.listdir(tmp_path)) == ['a.npy', 'a.npz']
+
+
+def test_in_place_failure_keeps_input(tmp_path):
+    arr = np.arange(10)
+    np.save(tmp_path / 'a.npy', arr)
+    proc = run_npyzindex('-e', '20', str(tmp_path / 'a.npy'), '-O')
+    assert proc.returncode == 4
+    np.testing.assert_array_equal(np.load(tmp_path / 'a.npy'), arr)
+    assert os.listdir(tmp_path) == ['a.npy']
+
+
+def test_stdin_to_stdout(tmp_path):
+    arr = np.arange(60, dtype='>u2').reshape(3, 4, 5)
+    cbuf = io.BytesIO()
+    np.save(cbuf, arr)
+    proc = run_npyzindex('-e', ':,:,::-2', stdin=cbuf.getvalue())
+    assert proc.returncode == 0, proc.stderr.decode()
+    result = np.load(io.BytesIO(proc.stdout))
+    assert result.dtype == arr.dtype
+    np.testing.assert_array_equal(result, arr[:, :, ::-2])
+
+
+def test_flo(tmp_path):
+    flow = np.arange(4 * 5 * 2, dtype=np.float32).reshape(4, 5, 2)
+    with open(tmp_path / 'a.flo', 'wb') as outfile:
+        outfile.write(np.array([202021.25], '<f4').tobytes())
+        outfile.write(np.array([5, 4], '<i4').tobytes())
+        outfile.write(flow.tobytes())
+    proc = run_npyzindex('-e', '1:3,:,0', '-O', '-',
+                         str(tmp_path / 'a.flo'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    np.testing.assert_array_equal(np.load(io.BytesIO(proc.stdout)),
+                                  flow[1:3, :, 0])
@@ -0,0 +1,85 @@
+import io
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src')
+
+# run a command on the server only, without falling back to running it
+# directly, and exit with 99 if the server refused it
+CLIENT = '''\
+import socket, sys
+sys.path.insert(0, {src!r})
+import npyzclient
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+sock.connect(npyzclient.default_socket_path())
+code = npyzclient.run_on_server(sock, sys.argv[1], sys.argv[2:])
+sys.exit(99 if code is None else code)
+'''
+
+
+@pytest.fixture
+def server(tmp_path):
+    sock = str(tmp_path / 'npyz.sock')
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(SRC_DIR, 'npyzserver.py'), '-s', sock],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while not os.path.exists(sock):
+            assert proc.poll() is None, 'npyzserver exited early'
+            assert time.monotonic() < deadline, 'npyzserver not listening'
+            time.sleep(0.05)
+        yield sock
+    finally:
+        subprocess.run([sys.executable,
+                        os.path.join(SRC_DIR, 'npyzserver.py'), '-s', sock,
+                        '--stop'], capture_output=True)
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def run_on_server(sock, cwd, script, *args, stdin=None):
+    env = dict(os.environ, NPYZ_SOCKET=sock)
+    return subprocess.run(
+        [sys.executable, '-c', CLIENT.format(src=SRC_DIR),
+         os.path.join(SRC_DIR, script)] + list(args),
+        input=stdin, cwd=cwd, env=env, capture_output=True)
+
+
+def test_stdio_cwd_and_exit_code(server, tmp_path):
+    arr = np.arange(24).reshape(4, 6)
+    cbuf = io.BytesIO()
+    np.save(cbuf, arr)
+    proc = run_on_server(server, tmp_path, 'npyzindex.py', '-e', '1:3',
+                         stdin=cbuf.getvalue())
+    assert proc.returncode == 0, proc.stderr.decode()
+    np.testing.assert_array_equal(np.load(io.BytesIO(proc.stdout)), arr[1:3])
+
+    # relative paths resolve against the cwd of the caller
+    np.save(tmp_path / 'a.npy', arr)
+    proc = run_on_server(server, tmp_path, 'npyzshape.py', 'a.npy')
+    assert proc.returncode == 0, proc.stderr.decode()
+    assert proc.stdout == b'a.npy\t\t(4, 6)\n'
+
+    proc = run_on_server(server, tmp_path, 'npyzindex.py', '-e', '9',
+                         '-O', '-', 'a.npy')
+    assert proc.returncode == 4
+    assert b'IndexError' in proc.stderr
+    assert not proc.stdout
+
+
+def test_refuses_unknown_command(server, tmp_path):
+    script = tmp_path / 'npyzevil.py'
+    script.write_text('')
+    proc = run_on_server(server, tmp_path, str(script))
+    assert proc.returncode == 99
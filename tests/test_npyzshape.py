@@ -0,0 +1,40 @@
+import os
+import struct
+import subprocess
+import sys
+
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src')
+
+
+def run_npyzshape(*args):
+    return subprocess.run(
+        [sys.executable, os.path.join(SRC_DIR, 'npyzshape.py')] + list(args),
+        stdin=subprocess.DEVNULL, capture_output=True)
+
+
+def test_shapes(tmp_path):
+    np.save(tmp_path / 'a.npy', np.zeros((2, 3), dtype=np.uint8))
+    np.savez_compressed(tmp_path / 'b.npz', x=np.zeros(4), y=np.zeros((1, 5)))
+    with open(tmp_path / 'c.flo', 'wb') as outfile:
+        outfile.write(struct.pack('<fii', 202021.25, 7, 6))
+        outfile.write(np.zeros((6, 7, 2), dtype='<f4').tobytes())
+    proc = run_npyzshape(*(str(tmp_path / name)
+                           for name in ('a.npy', 'b.npz', 'c.flo')))
+    assert proc.returncode == 0, proc.stderr.decode()
+    assert proc.stdout.decode().splitlines() == [
+        '{}\t\t(2, 3)'.format(tmp_path / 'a.npy'),
+        '{}\tx\t(4,)'.format(tmp_path / 'b.npz'),
+        '{}\ty\t(1, 5)'.format(tmp_path / 'b.npz'),
+        '{}\t\t(6, 7, 2)'.format(tmp_path / 'c.flo'),
+    ]
+
+
+def test_truncated_flo(tmp_path):
+    with open(tmp_path / 'c.flo', 'wb') as outfile:
+        outfile.write(struct.pack('<fii', 202021.25, 7, 6))
+    proc = run_npyzshape(str(tmp_path / 'c.flo'))
+    assert proc.returncode != 0
+    assert not proc.stdout
@@ -0,0 +1,35 @@
+import io
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src')
+
+
+def run_npzcat(*args):
+    return subprocess.run(
+        [sys.executable, os.path.join(SRC_DIR, 'npzcat.py')] + list(args),
+        stdin=subprocess.DEVNULL, capture_output=True)
+
+
+def test_concatenate(tmp_path):
+    np.savez(tmp_path / 'a.npz', x=np.arange(3), y=np.ones((2, 2)))
+    np.savez_compressed(tmp_path / 'b.npz', x=np.arange(4), y=np.zeros((1, 2)))
+    proc = run_npzcat(str(tmp_path / 'a.npz'), str(tmp_path / 'b.npz'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    with np.load(io.BytesIO(proc.stdout)) as npz:
+        np.testing.assert_array_equal(npz['x'], [0, 1, 2, 0, 1, 2, 3])
+        np.testing.assert_array_equal(npz['y'], [[1, 1], [1, 1], [0, 0]])
+
+
+def test_output_is_input(tmp_path):
+    np.savez(tmp_path / 'a.npz', x=np.arange(3))
+    proc = run_npzcat('-O', str(tmp_path / 'a.npz'), str(tmp_path / 'a.npz'),
+                      str(tmp_path / 'a.npz'))
+    assert proc.returncode == 0, proc.stderr.decode()
+    with np.load(tmp_path / 'a.npz') as npz:
+        np.testing.assert_array_equal(npz['x'], [0, 1, 2, 0, 1, 2])
+    assert os.listdir(tmp_path) == ['a.npz']
@@ -1,5 +1,5 @@
 #!/bin/bash
-find src/ -maxdepth 1 -mindepth 1 -type f \
+find src/ -maxdepth 1 -mindepth 1 -type f ! -name npyzcore.py ! -name npyzclient.py \
 | while read -r filename; do
 	prog="$(basename "$filename")"
 	echo "# $prog" > doc/$prog.txt